@@ -42,6 +42,13 @@ import yaml
 from src.utils import *
 import os
 import glob
+import time
+from src.RunManifest import RunManifest
+from src.Downloader import Downloader
+from src.ArchiveIndex import ArchiveIndex
+from src.ProductStore import ProductStore
+from src.CatalogCache import CatalogCache
+from src import Profiler
 
 logger = logging.getLogger('LoggerS12Mosaicker')
 logging.basicConfig(level=logging.INFO)
@@ -64,17 +71,113 @@ class Sen12Mosaicker():
     self.creds_json,\
     self.geojson_file = read_main_config(self.conf_yaml)
 
+    date_conf = read_config_section(self.conf_yaml, 'DATE', {'ts_step': None, 'closed': 'both'})
+    self.ts_step, self.ts_closed = date_conf['ts_step'], date_conf['closed']
+
+    # 'greedy': largest intersections first, 'weighted': cover of least download cost
+    self.selection_conf = read_config_section(self.conf_yaml, 'SELECTION', {'mode': 'greedy', 'cloud_weight': 1., 'on_disk_weight': 0.,
+                                                                            'disk_tolerance': 0.05, 'download_budget_gb': None})
+    # uuids and estimated bytes of the downloads planned so far
+    self.planned_uuids = set()
+    self.download_estimates = {}
+
     self.footprint = geojson_to_footprint(self.geojson_file)
 
-    self.api = authenticate_oah(self.creds_json)
+    # local archives of zips, their products are used instead of downloading them again
+    archive_conf = read_config_section(self.conf_yaml, 'ARCHIVE', {'enabled': False, 'folders': [], 'index': 'archive_index.sqlite',
+                                                                   'update': True, 'offline': False})
+    self.archive = None
+    if archive_conf['enabled']:
+      self.archive = ArchiveIndex(archive_conf['index'], archive_conf['folders'])
+      if archive_conf['update']:
+        self.archive.update()
+
+    # products and clipped bands shared by all runs, the interval folders get links
+    store_conf = read_config_section(self.conf_yaml, 'STORE', {'enabled': False, 'folder': 'product_store', 'max_size_gb': 500, 'link': 'hard'})
+    self.store = ProductStore(**{key: store_conf[key] for key in ('folder', 'max_size_gb', 'link')}) if store_conf['enabled'] else None
+
+    # running offline from the catalog cache (or the archive) doesn't need the hub
+    cache = get_catalog_cache(self.conf_yaml)
+    offline = (cache is not None and cache.offline) or (self.archive is not None and archive_conf['offline'])
+    self.api = None if offline else authenticate_oah(self.creds_json)
+
+    # record of the stages of the run, to resume it where it stopped
+    self.manifest = None
+    if read_config_section(self.conf_yaml, 'RUN_MANIFEST', {'enabled': True})['enabled']:
+      if not os.path.exists(self.output_folder):
+        os.makedirs(self.output_folder)
+      self.manifest = RunManifest(os.path.join(self.output_folder, 'run_manifest.sqlite'))
 
   def get_intervals(self):
     self.min_date = datetime.datetime.strptime(self.min_date, "%Y%m%d")
     self.max_date = datetime.datetime.strptime(self.max_date, "%Y%m%d")
-    self.ts_intervals = chunk_dates(self.min_date, self.max_date, self.ts_delta)
+    self.ts_intervals = chunk_dates(self.min_date, self.max_date, self.ts_delta, self.ts_step)
+
+  def get_query_key(self):
+    """
+    key of the query of the run, a stored query result is only reused for the same footprint, dates and query kwargs
+    """
+    return CatalogCache.get_key(self.footprint, (self.min_date, self.max_date), read_query_kwargs(self.conf_yaml))
+
+  def get_query_paths(self):
+    return [os.path.join(self.output_folder, 'query_{0}.pkl'.format(sensor)) for sensor in ('s2', 's1')]
 
   def get_products(self):
-    self.products_s2, self.products_s1 = query_products(self.api, (self.min_date, self.max_date), self.conf_yaml, self.footprint)
+    key = self.get_query_key()
+    paths = self.get_query_paths()
+    if self.manifest is not None and self.manifest.is_done('', '', 'query'):
+      record = self.manifest.get('', '', 'query')
+      if (record['result'] or {}).get('key') == key:
+        logger.info('\tquery already done, reading its result from the output folder')
+        self.products_s2, self.products_s1 = [pd.read_pickle(path) for path in paths]
+        return
+
+    started = time.time()
+    self.products_s2, self.products_s1 = query_products(self.api, (self.min_date, self.max_date), self.conf_yaml, self.footprint, self.archive)
+    if self.manifest is not None:
+      for products, path in zip((self.products_s2, self.products_s1), paths):
+        with atomic_output(path) as tmp_path:
+          products.to_pickle(tmp_path)
+      self.manifest.set('', '', 'query', 'done', outputs=paths, result={'key': key, 's2': len(self.products_s2), 's1': len(self.products_s1)},
+                        started=started)
+
+  def get_selection_params(self):
+    """
+    parameters of the selection of the scenes of an interval, a stored selection is only reused for the same ones
+    """
+    params = {'min_coverage': self.min_coverage, 'mode': self.selection_conf['mode']}
+    if self.selection_conf['mode'] == 'weighted':
+      params.update({'cloud_weight': self.selection_conf['cloud_weight'], 'on_disk_weight': self.selection_conf['on_disk_weight']})
+    else:
+      params['disk_tolerance'] = self.selection_conf['disk_tolerance']
+    return params
+
+  def select_interval(self, interval, chunk_s2, chunk_s1):
+    """
+    returns:
+        - the s2 and s1 coverages of the interval, taken from the run manifest if they were already selected with the same parameters
+    """
+    name = os.path.basename(self.get_interval_folder(interval))
+    params = self.get_selection_params()
+    if self.manifest is not None:
+      record = self.manifest.get(name, '', 'select')
+      if record is not None and record['status'] == 'done' and record['result'].get('params') == params:
+        s2_coverage, s1_coverage = coverage_from_uuids(chunk_s2, record['result']['s2']), coverage_from_uuids(chunk_s1, record['result']['s1'])
+        if s2_coverage is not None and s1_coverage is not None:
+          return s2_coverage, s1_coverage
+
+    started = time.time()
+    weights = None
+    if self.selection_conf['mode'] == 'weighted':
+      # scenes planned for other intervals are downloaded once, they cost nothing here
+      weights = {'cloud_weight': self.selection_conf['cloud_weight'], 'on_disk_weight': self.selection_conf['on_disk_weight'],
+                 'free_uuids': self.planned_uuids}
+    with Profiler.stage('select', name):
+      s2_coverage, s1_coverage = get_complete_coverage_of_AOI(products=chunk_s2, aoi_fp=self.footprint, logger=logger, min_coverage=self.min_coverage, weights=weights, disk_tolerance=self.selection_conf['disk_tolerance']), get_complete_coverage_of_AOI(products=chunk_s1, aoi_fp=self.footprint, logger=logger, min_coverage=self.min_coverage, weights=weights, disk_tolerance=self.selection_conf['disk_tolerance'])
+    if self.manifest is not None:
+      self.manifest.set(name, '', 'select', 'done', result={'s2': coverage_to_uuids(s2_coverage), 's1': coverage_to_uuids(s1_coverage), 'params': params},
+                        started=started)
+    return s2_coverage, s1_coverage
 
   def get_scenes_todownload(self):
       """
@@ -82,48 +185,83 @@ class Sen12Mosaicker():
           - two lists of s2 and s1 scenes to download
       """
       if (not self.products_s1.empty) and (not self.products_s2.empty):  
-        products_chunks_s2 = get_products_chunks(self.products_s2, self.ts_intervals)
-        products_chunks_s1 = get_products_chunks(self.products_s1, self.ts_intervals)
+        index_s2 = TemporalIndex(self.products_s2)
+        index_s1 = TemporalIndex(self.products_s1)
+        counts_s2 = index_s2.get_counts(self.ts_intervals, self.ts_closed)
+        counts_s1 = index_s1.get_counts(self.ts_intervals, self.ts_closed)
+
+        chunks = zip(self.ts_intervals, counts_s2, counts_s1,
+                     index_s2.iter_chunks(self.ts_intervals, self.ts_closed), index_s1.iter_chunks(self.ts_intervals, self.ts_closed))
 
-        for i in range(len(self.ts_intervals)):    #len(self.ts_intervals = len(product_chunks))
+        for interval, count_s2, count_s1, chunk_s2, chunk_s1 in chunks:
           
-          if (not products_chunks_s1[i].empty) and (not products_chunks_s2[i].empty):
-            s2_coverage, s1_coverage = get_complete_coverage_of_AOI(products=products_chunks_s2[i], aoi_fp=self.footprint, logger=logger, min_coverage=self.min_coverage), get_complete_coverage_of_AOI(products=products_chunks_s1[i], aoi_fp=self.footprint, logger=logger, min_coverage=self.min_coverage)
+          if count_s1 and count_s2:
+            s2_coverage, s1_coverage = self.select_interval(interval, chunk_s2, chunk_s1)
             
             if not isinstance(s2_coverage[-1],str):
-              self.list_ts_pairs.append((self.ts_intervals[i],s2_coverage, s1_coverage))
+              self.plan_interval(interval, s2_coverage, s1_coverage)
             else:
               logger.info('incomplete mosaic in this interval... skipping')
 
+        logger.info('\t{0} intervals selected, {1:.2f} GB to download'.format(len(self.list_ts_pairs), sum(self.download_estimates.values()) / 2.**30))
       else:
         logger.info('No products meeting requirements available')
 
+  def plan_interval(self, interval, s2_coverage, s1_coverage):
+    """
+    adds the interval to the time series, unless its downloads would exceed the download budget of the run
+    """
+    name = os.path.basename(self.get_interval_folder(interval))
+    estimate = estimate_download_bytes(s2_coverage + s1_coverage, self.planned_uuids)
+    budget = self.selection_conf['download_budget_gb']
+    if budget is not None and sum(self.download_estimates.values()) + estimate > budget * 2**30:
+      logger.info('\t{0}: {1:.2f} GB to download would exceed the download budget... skipping'.format(name, estimate / 2.**30))
+      return False
+
+    logger.info('\t{0}: {1:.2f} GB to download'.format(name, estimate / 2.**30))
+    self.download_estimates[name] = estimate
+    self.planned_uuids.update(uuid for uuid in coverage_to_uuids(s2_coverage + s1_coverage) if uuid != 'incomplete')
+    self.list_ts_pairs.append((interval,s2_coverage, s1_coverage))
+    return True
+
   
-  def download_scenes(self):
-    if not os.path.exists(self.output_folder):
-      os.mkdir(self.output_folder)
-    
-    for pair in self.list_ts_pairs:
-      interval, s2_list, s1_list = pair
+  def get_interval_folder(self, interval):
+    min_date = datetime.datetime.strftime(interval[0], "%Y%m%d")
+    max_date = datetime.datetime.strftime(interval[1], "%Y%m%d")
+    return self.output_folder + '/{0}_{1}'.format(min_date,max_date)
 
-      min_date = datetime.datetime.strftime(interval[0], "%Y%m%d")
-      max_date = datetime.datetime.strftime(interval[1], "%Y%m%d")
-      folder_path = self.output_folder + '/{0}_{1}'.format(min_date,max_date)
-      os.mkdir(folder_path)
-      os.mkdir(folder_path + '/S1')
-      os.mkdir(folder_path + '/S2')
-      
-      for s2 in s2_list:
-        try:
-          self.api.download(s2['uuid'], folder_path + '/S2')
-        except:
-          continue
-      for s1 in s1_list:
-        try:
-          self.api.download(s1['uuid'], folder_path + '/S1')
-        except:
-          continue
+  def get_download_jobs(self, pairs=None):
+    """
+    returns:
+        - list of (uuid, folder, local zip or None) for the selected S2 and S1 scenes of pairs (default: all the intervals)
+    """
+    local_path = lambda scene: scene['local_path'] if isinstance(scene.get('local_path'), str) else None
+    jobs = []
+    for pair in (self.list_ts_pairs if pairs is None else pairs):
+      interval, s2_list, s1_list = pair
+      folder_path = self.get_interval_folder(interval)
 
+      jobs += [(s2['uuid'], folder_path + '/S2', local_path(s2)) for s2 in s2_list if not isinstance(s2, str)]
+      jobs += [(s1['uuid'], folder_path + '/S1', local_path(s1)) for s1 in s1_list if not isinstance(s1, str)]
+    return jobs
 
+  def get_selected_zips(self, folder, sensor):
+    """
+    returns:
+        - the zips of the sensor ('S1' or 'S2') scenes selected for the interval of folder, as linked there by the downloads,
+          None if folder is not the folder of an interval. The processors take these instead of every zip of the folder,
+          which may hold products of an earlier selection
+    """
+    for interval, s2_list, s1_list in self.list_ts_pairs:
+      if self.get_interval_folder(interval) == folder:
+        scenes = s2_list if sensor == 'S2' else s1_list
+        return [os.path.join(folder, sensor, os.path.basename(scene['local_path']) if isinstance(scene.get('local_path'), str) else scene['title'] + '.zip')
+                for scene in scenes if not isinstance(scene, str)]
+    return None
 
+  def get_downloader(self):
+    download_conf = read_config_section(self.conf_yaml, 'DOWNLOAD', {'workers': 4, 'max_attempts': 5, 'backoff': 2., 'checksum': True})
+    return Downloader(self.api, manifest=self.manifest, store=self.store, **download_conf)
 
+  def download_scenes(self):
+    return self.get_downloader().download(self.get_download_jobs())
@@ -0,0 +1,49 @@
+"""
+Benchmark of the temporal bucketing of products into intervals.
+
+    python -m benchmarks.bench_chunks --years 5 --products 50000
+"""
+import argparse
+import datetime
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.utils import chunk_dates, get_products_chunks
+from src.TemporalIndex import TemporalIndex
+
+
+def make_products(n, min_date, max_date, seed=0):
+    rng = np.random.RandomState(seed)
+    span = (max_date - min_date).total_seconds()
+    offsets = pd.to_timedelta(rng.uniform(0, span, n), unit='s')
+    return pd.DataFrame({'uuid': np.arange(n), 'beginposition': pd.Timestamp(min_date) + offsets})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--products', type=int, default=50000)
+    parser.add_argument('--ts-interval', type=int, default=1)
+    args = parser.parse_args()
+
+    min_date = datetime.datetime(2017, 1, 1)
+    max_date = min_date + datetime.timedelta(365 * args.years)
+    products = make_products(args.products, min_date, max_date)
+
+    start = time.time()
+    intervals = chunk_dates(min_date, max_date, args.ts_interval)
+    print('{0} intervals in {1:.1f} ms'.format(len(intervals), (time.time() - start) * 1e3))
+
+    start = time.time()
+    counts = TemporalIndex(products).get_counts(intervals)
+    print('counts of {0} products in {1:.1f} ms'.format(counts.sum(), (time.time() - start) * 1e3))
+
+    start = time.time()
+    chunks = get_products_chunks(products, intervals)
+    print('{0} chunks in {1:.1f} ms'.format(len(chunks), (time.time() - start) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
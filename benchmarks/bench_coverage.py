@@ -0,0 +1,71 @@
+"""
+Benchmark of the scene selection on synthetic catalogs.
+
+Compares the CoverageSelector behind get_complete_coverage_of_AOI with the former recursive
+implementation (kept below as reference) and checks both pick the same scenes, and reports
+the download volume of the weighted (least cost) selection.
+
+    python -m benchmarks.bench_coverage --sizes 1000 10000 20000 --reference-max 2000
+"""
+import argparse
+import logging
+import time
+
+import shapely.wkt
+from shapely.geometry import box
+
+from benchmarks.synthetic import make_catalog
+from src.utils import estimate_download_bytes, get_complete_coverage_of_AOI, get_sorted_scenes_by_intersection_aoi, get_difference, get_intersection
+
+logger = logging.getLogger('BenchCoverageLogger')
+
+
+def reference_coverage(products, aoi_fp, aoi_area=None, min_coverage=0.90):
+    if aoi_area is None:
+        aoi_area = shapely.wkt.loads(aoi_fp).area
+
+    scenes = get_sorted_scenes_by_intersection_aoi(products, aoi_fp)
+    top_scene = scenes.iloc[0]
+    left_over_area = get_difference(aoi_fp, top_scene['footprint'])
+    intersection_area = get_intersection(aoi_fp, top_scene['footprint']).area
+
+    if intersection_area == 0:
+        return ['incomplete']
+    elif left_over_area.area < (1-min_coverage) * aoi_area:
+        return [top_scene]
+    return [top_scene] + reference_coverage(products, left_over_area.wkt, aoi_area, min_coverage)
+
+
+def uuids(scenes):
+    return [s if isinstance(s, str) else s['uuid'] for s in scenes]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 20000])
+    parser.add_argument('--reference-max', type=int, default=2000, help='largest catalog the reference implementation is run on')
+    parser.add_argument('--min-coverage', type=float, default=0.99)
+    args = parser.parse_args()
+
+    aoi_fp = box(10., 50., 14., 53.).wkt
+    for n in args.sizes:
+        products = make_catalog(n)
+
+        start = time.time()
+        selected = get_complete_coverage_of_AOI(products, aoi_fp, logger, min_coverage=args.min_coverage)
+        elapsed = time.time() - start
+        line = '{0:>7} footprints: {1:>3} scenes ({2:.1f} GB) in {3:.3f}s'.format(n, len(selected), estimate_download_bytes(selected) / 2.**30, elapsed)
+
+        start = time.time()
+        weighted = get_complete_coverage_of_AOI(products, aoi_fp, logger, min_coverage=args.min_coverage, weights={})
+        line += ', weighted {0:>3} scenes ({1:.1f} GB) in {2:.3f}s'.format(len(weighted), estimate_download_bytes(weighted) / 2.**30, time.time() - start)
+
+        if n <= args.reference_max:
+            start = time.time()
+            reference = reference_coverage(products.copy(), aoi_fp, min_coverage=args.min_coverage)
+            line += ', reference {0:.3f}s, same scenes: {1}'.format(time.time() - start, uuids(reference) == uuids(selected))
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
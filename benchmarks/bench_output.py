@@ -0,0 +1,100 @@
+"""
+Benchmark of the output profiles on synthetic uint16 (S2-like) and float32 (S1 dB-like) rasters.
+
+Reports, for each profile, the file size, the write throughput (overviews and COG layout included),
+the throughput of windowed reads over the whole raster and the time of a 1/8 resolution read.
+
+    python -m benchmarks.bench_output --size 4096
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+
+from src import OutputProfile
+from src.utils import raster_output, iter_block_windows
+
+PROFILES = {
+    'plain': None,
+    'deflate': {'compress': 'deflate', 'overviews': False, 'cog': False},
+    'zstd': {'compress': 'zstd', 'overviews': False, 'cog': False},
+    'lzw': {'compress': 'lzw', 'overviews': False, 'cog': False},
+    'deflate+overviews': {'compress': 'deflate', 'overviews': True, 'cog': False},
+    'deflate+cog': {'compress': 'deflate', 'overviews': True, 'cog': True},
+}
+
+
+def make_array(size, dtype, seed=0):
+    """
+    smooth field plus noise, so the predictors have something to work on, as in real scenes
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / float(size)
+    field = np.sin(6 * x) * np.cos(4 * y) + 0.05 * rng.standard_normal((size, size))
+    if np.dtype(dtype).kind == 'f':
+        return (10 * field - 15).astype(dtype)
+    return (2000 + 1000 * field).astype(dtype)
+
+
+def bench_profile(name, data, folder):
+    meta = {'driver': 'GTiff', 'count': 1, 'dtype': data.dtype.name, 'width': data.shape[1], 'height': data.shape[0],
+            'crs': CRS.from_epsg(4326), 'transform': Affine(0.0001, 0, 10., 0, -0.0001, 50.), 'nodata': 0}
+    path = os.path.join(folder, '{0}_{1}.tif'.format(name, data.dtype.name))
+    raw_mb = data.nbytes / 2.**20
+
+    if PROFILES[name] is None:
+        OutputProfile.disable()
+    else:
+        OutputProfile.configure(**PROFILES[name])
+    try:
+        start = time.perf_counter()
+        with raster_output(path, meta) as dst:
+            for window in iter_block_windows(meta['width'], meta['height'], 1, data.dtype, 64):
+                dst.write(data[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width], 1, window=window)
+        write_seconds = time.perf_counter() - start
+    finally:
+        OutputProfile.disable()
+
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        for _, window in src.block_windows(1):
+            src.read(1, window=window)
+    read_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        src.read(1, out_shape=(src.height // 8, src.width // 8))
+    overview_seconds = time.perf_counter() - start
+
+    return {'profile': name, 'dtype': data.dtype.name, 'MB': os.path.getsize(path) / 2.**20, 'ratio': raw_mb * 2.**20 / os.path.getsize(path),
+            'write_MBps': raw_mb / write_seconds, 'read_MBps': raw_mb / read_seconds, 'overview_read_s': overview_seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=4096, help='side of the synthetic rasters, in pixels')
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument('--workdir', default=None, help='folder of the rasters (default: a temporary folder, removed)')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        print('{0:>18} {1:>8} {2:>8} {3:>6} {4:>10} {5:>10} {6:>12}'.format(
+            'profile', 'dtype', 'MB', 'ratio', 'write MB/s', 'read MB/s', 'overview s'))
+        for dtype in ('uint16', 'float32'):
+            data = make_array(args.size, dtype)
+            for name in args.profiles:
+                result = bench_profile(name, data, folder)
+                print('{profile:>18} {dtype:>8} {MB:8.1f} {ratio:6.2f} {write_MBps:10.1f} {read_MBps:10.1f} {overview_read_s:12.3f}'.format(**result))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Offline end-to-end benchmark of the pipeline on synthetic products served by a fake hub.
+
+Times the scene selection and the temporal bucketing on synthetic catalogs, then download, extraction,
+clipping, mosaicking and post-processing of synthetic S2 products (the S1 stage is stubbed, SNAP is not needed)
+for each size of band, and writes the timings as JSON so commits can be compared.
+
+    python -m benchmarks.bench_pipeline --catalog-sizes 1000 10000 --raster-sizes 256 1024 --output bench.json
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from shapely.geometry import box
+
+from benchmarks.synthetic import make_catalog, make_s2_products, make_s1_mosaic, FakeSentinelAPI, S2_TILE_EXTENT
+from src.Downloader import Downloader
+from src.S2Processor import S2Processor, get_band_hrefs
+from src.utils import (get_complete_coverage_of_AOI, get_products_chunks, chunk_dates, extract_members, read_zipped_manifest,
+                       clip_to_aoi, merge_rasters, mosaic_virtual, post_proc, coregister_to_grid, get_raster_grid)
+
+logger = logging.getLogger('BenchPipelineLogger')
+
+
+def measure(func, repeat=1):
+    """
+    returns (best wall time of repeat runs in seconds, result of the last run)
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_catalog(n, repeat):
+    aoi_fp = box(10., 50., 14., 53.).wkt
+    products = make_catalog(n, min_date=datetime.datetime(2020, 1, 1), max_date=datetime.datetime(2021, 1, 1))
+    intervals = chunk_dates(datetime.datetime(2020, 1, 1), datetime.datetime(2021, 1, 1), 5)
+
+    coverage_seconds, selected = measure(lambda: get_complete_coverage_of_AOI(products, aoi_fp, logger, min_coverage=0.99), repeat)
+    chunks_seconds, chunks = measure(lambda: get_products_chunks(products, intervals), repeat)
+    return [
+        {'benchmark': 'get_complete_coverage_of_AOI', 'size': n, 'seconds': coverage_seconds, 'scenes': len(selected)},
+        {'benchmark': 'get_products_chunks', 'size': n, 'seconds': chunks_seconds, 'intervals': len(chunks)},
+    ]
+
+
+def bench_rasters(size, workdir, repeat):
+    """
+    one interval of 2 x 2 synthetic S2 products of size x size pixel bands
+    """
+    date = datetime.datetime(2020, 6, 1, 10, 30)
+    hub_folder = os.path.join(workdir, 'hub')
+    # footprints of real S2 tiles whatever the size of the bands: the selection rounds the intersections
+    # to 0.01 square degree, products of a few km would all tie at 0 and only one would be selected
+    zips, catalog, aoi_fp = make_s2_products(hub_folder, date, size=size, resolution=S2_TILE_EXTENT / size)
+    api = FakeSentinelAPI(catalog, hub_folder)
+
+    interval_folder = os.path.join(workdir, '20200601_20200615')
+    s2_folder = os.path.join(interval_folder, 'S2')
+    results = []
+
+    query = api.to_dataframe(api.query(area=aoi_fp, date=('20200601', '20200615'), platformname='Sentinel-2'))
+    selected = get_complete_coverage_of_AOI(query, aoi_fp, logger, min_coverage=0.99)
+    # the mosaics are only timed on several products covering the AOI
+    assert 'incomplete' not in [s2 for s2 in selected if isinstance(s2, str)], 'synthetic products do not cover the AOI'
+    assert len(selected) > 1, 'AOI covered by a single synthetic product'
+
+    def download():
+        shutil.rmtree(s2_folder, ignore_errors=True)
+        return Downloader(api, workers=4).download([(s2['uuid'], s2_folder) for s2 in selected if not isinstance(s2, str)])
+    seconds, summary = measure(download, repeat)
+    results.append({'benchmark': 'download', 'size': size, 'seconds': seconds, 'products': summary['products'],
+                    'MB': sum(os.path.getsize(path) for path in summary['paths'].values()) / 2.**20})
+
+    local_zips = sorted(glob.glob(os.path.join(s2_folder, 'S2*.zip')))
+
+    def extract():
+        return [extract_members(zip_file, lambda name: True, s2_folder) for zip_file in local_zips]
+    seconds, safe_folders = measure(extract, repeat)
+    results.append({'benchmark': 'extract_members', 'size': size, 'seconds': seconds, 'products': len(safe_folders)})
+
+    bands = [os.path.join(safe_folder, os.path.normpath(get_band_hrefs(read_zipped_manifest(zip_file))['red']))
+             for zip_file, safe_folder in zip(local_zips, safe_folders)]
+    seconds, clipped = measure(lambda: [clip_to_aoi(band, aoi_fp) for band in bands], repeat)
+    results.append({'benchmark': 'clip_to_aoi', 'size': size, 'seconds': seconds, 'bands': len(bands)})
+
+    seconds, s2_mosaic = measure(lambda: merge_rasters(clipped, interval_folder, 'red_20200601_20200615S2', 'uint16'), repeat)
+    results.append({'benchmark': 'merge_rasters', 'size': size, 'seconds': seconds, 'inputs': len(clipped)})
+
+    # clip_to_aoi + merge_rasters in one pass, without the clipped files
+    virtual_path = os.path.join(interval_folder, 'Mosaic_red_virtual_20200601_20200615S2.tif')
+    seconds, _ = measure(lambda: mosaic_virtual(bands, aoi_fp, virtual_path, 'uint16'), repeat)
+    results.append({'benchmark': 'mosaic_virtual', 'size': size, 'seconds': seconds, 'inputs': len(bands)})
+
+    s1_mosaic = os.path.join(interval_folder, '20200601_20200615S1.tif')
+
+    def stubbed_post_proc():
+        make_s1_mosaic(s1_mosaic, s2_mosaic)
+        return post_proc(s1_mosaic, s2_mosaic)
+    seconds, _ = measure(stubbed_post_proc, repeat)
+    results.append({'benchmark': 'post_proc', 'size': size, 'seconds': seconds})
+
+    grid = get_raster_grid(s2_mosaic)
+    seconds, _ = measure(lambda: coregister_to_grid([s1_mosaic], s1_mosaic[:-4] + '_coreg.tif', grid), repeat)
+    results.append({'benchmark': 'coregister_to_grid', 'size': size, 'seconds': seconds})
+
+    # the whole S2 chain as run by main.py, on a fresh copy of the downloaded zips
+    process_folder = os.path.join(workdir, '20200601_20200615_process', 'S2')
+    os.makedirs(process_folder)
+    for zip_file in local_zips:
+        shutil.copy(zip_file, process_folder)
+    seconds, _ = measure(lambda: S2Processor(process_folder, aoi_fp, extraction='vsizip').process(), 1)
+    results.append({'benchmark': 'S2Processor.process', 'size': size, 'seconds': seconds, 'extraction': 'vsizip'})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--catalog-sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--raster-sizes', type=int, nargs='+', default=[256, 1024], help='side of the synthetic bands, in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measure, the best is kept')
+    parser.add_argument('--workdir', default=None, help='folder of the synthetic products (default: a temporary folder, removed)')
+    parser.add_argument('--output', default='bench_pipeline.json')
+    args = parser.parse_args()
+
+    report = {'commit': get_commit(), 'python': platform.python_version(), 'machine': platform.machine(),
+              'date': datetime.datetime.now().isoformat(), 'results': []}
+
+    for n in args.catalog_sizes:
+        report['results'] += bench_catalog(n, args.repeat)
+
+    for size in args.raster_sizes:
+        workdir = tempfile.mkdtemp(dir=args.workdir)
+        try:
+            report['results'] += bench_rasters(size, workdir, args.repeat)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for result in report['results']:
+        print('{0:>30} {1:>7}: {2:.3f}s'.format(result['benchmark'], result['size'], result['seconds']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {0}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
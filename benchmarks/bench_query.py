@@ -0,0 +1,51 @@
+"""
+Benchmark of the catalog queries against the fake hub, with a simulated latency.
+
+Compares the former sequential S2 then S1 queries over the whole date range with the QueryEngine
+(concurrent queries split into date sub-ranges) and checks both return the same products.
+
+    python -m benchmarks.bench_query --products 20000 --latency 0.5 --per-product 0.0005
+"""
+import argparse
+import datetime
+import time
+
+import pandas as pd
+from shapely.geometry import box
+
+from benchmarks.synthetic import make_catalog, FakeSentinelAPI
+from src.QueryEngine import QueryEngine
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds per query')
+    parser.add_argument('--per-product', type=float, default=0.0005, help='seconds per product returned')
+    parser.add_argument('--days-per-query', type=int, default=60)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    min_date, max_date = datetime.datetime(2018, 1, 1), datetime.datetime(2021, 1, 1)
+    catalog = pd.concat([make_catalog(args.products, min_date=min_date, max_date=max_date, seed=1),
+                         make_catalog(args.products, min_date=min_date, max_date=max_date, seed=2, platformname='Sentinel-1')])
+    catalog.index = catalog['uuid'] = ['{0:032x}'.format(i) for i in range(len(catalog))]
+    api = FakeSentinelAPI(catalog, latency=args.latency, per_product=args.per_product)
+
+    aoi_fp = box(10., 50., 14., 53.).wkt
+    all_kwargs = [{'area': aoi_fp, 'date': ('20180101', '20210101'), 'platformname': platformname}
+                  for platformname in ('Sentinel-2', 'Sentinel-1')]
+
+    start = time.time()
+    sequential = [api.to_dataframe(api.query(**kwargs)) for kwargs in all_kwargs]
+    print('sequential: {0} products in {1:.2f}s'.format(sum(len(c) for c in sequential), time.time() - start))
+
+    start = time.time()
+    concurrent = QueryEngine(api, workers=args.workers, days_per_query=args.days_per_query).query(all_kwargs)
+    print('engine:     {0} products in {1:.2f}s, same products: {2}'.format(
+        sum(len(c) for c in concurrent), time.time() - start,
+        all(set(a['uuid']) == set(b['uuid']) for a, b in zip(sequential, concurrent))))
+
+
+if __name__ == '__main__':
+    main()
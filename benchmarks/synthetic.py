@@ -0,0 +1,232 @@
+"""
+Synthetic Sentinel products and a local stand-in of the Copernicus hub, so the pipeline runs offline.
+
+- make_catalog: DataFrames shaped like api.to_dataframe()
+- make_s2_product: S2 L1C SAFE zips (manifest.safe with fileLocation entries, bands in UTM)
+- make_s1_mosaic: stub of the S1 stage (the SNAP output), a float32 GeoTIFF in EPSG:4326
+- FakeSentinelAPI: serves a catalog and its zips through query, to_dataframe, get_product_odata and session
+"""
+import os
+import datetime
+import hashlib
+import time
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely.ops
+import shapely.wkt
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+from shapely.geometry import box
+
+from src.Downloader import md5_of_file
+
+S2_BANDS = ('B02', 'B03', 'B04', 'B08', 'TCI')
+# side of an S2 L1C tile, in metres
+S2_TILE_EXTENT = 109800.
+
+MANIFEST_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1" version="esa/safe/sentinel/1.1/sentinel-2/msi/archive_l1c_user_product">
+  <dataObjectSection>
+{0}
+  </dataObjectSection>
+</xfdu:XFDU>
+'''
+
+DATA_OBJECT_TEMPLATE = '''    <dataObject ID="IMG_DATA_Band_{0}">
+      <byteStream mimeType="application/octet-stream" size="{1}">
+        <fileLocation locatorType="URL" href="./{2}"/>
+      </byteStream>
+    </dataObject>'''
+
+
+def make_catalog(n, aoi_bounds=(10., 50., 14., 53.), tile=1., seed=0, platformname='Sentinel-2',
+                 min_date=datetime.datetime(2020, 1, 1), max_date=datetime.datetime(2021, 1, 1)):
+    """
+    returns a DataFrame shaped like api.to_dataframe() with n square footprints scattered around the AOI
+    """
+    rng = np.random.RandomState(seed)
+    minx, miny, maxx, maxy = aoi_bounds
+    xs = rng.uniform(minx - tile, maxx, n)
+    ys = rng.uniform(miny - tile, maxy, n)
+    span = (max_date - min_date).total_seconds()
+    beginposition = pd.Timestamp(min_date) + pd.to_timedelta(np.sort(rng.uniform(0, span, n)), unit='s')
+    uuids = ['{0:032x}'.format(i) for i in range(n)]
+    products = pd.DataFrame({
+        'uuid': uuids,
+        'title': ['{0}_{1:06d}'.format('S2A_MSIL1C' if platformname == 'Sentinel-2' else 'S1A_IW_GRDH_1SDV', i) for i in range(n)],
+        'platformname': platformname,
+        'footprint': [box(x, y, x + tile, y + tile).wkt for x, y in zip(xs, ys)],
+        'beginposition': beginposition,
+        'size': ['{0:.2f} MB'.format(s) for s in rng.uniform(500, 900, n)],
+    }, index=uuids)
+    if platformname == 'Sentinel-2':
+        products['cloudcoverpercentage'] = rng.uniform(0, 1, n).round(3)
+    return products
+
+
+def get_s2_title(date, tile_id, i):
+    stamp = date.strftime('%Y%m%dT%H%M%S')
+    return 'S2A_MSIL1C_{0}_N0208_R{1:03d}_T{2}_{0}'.format(stamp, i, tile_id)
+
+
+def write_band(path, width, height, transform, crs, count=1, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.randint(1, 10000, size=(count, height, width)).astype(np.uint16)
+    # GeoTIFF content under the .jp2 name, GDAL opens it by content
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=count, dtype='uint16',
+                       crs=crs, transform=transform, tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(data)
+
+
+def make_s2_product(folder, date, origin, size=512, resolution=10., epsg=32632, tile_id='32UNA', index=0, seed=0):
+    """
+    writes a synthetic S2 L1C SAFE zip of size x size pixel bands, upper left corner at origin (UTM coordinates)
+
+    returns: (path to the zip, catalog row as returned by the hub)
+    """
+    title = get_s2_title(date, tile_id, index)
+    safe_name = title + '.SAFE'
+    stamp = date.strftime('%Y%m%dT%H%M%S')
+    img_data = 'GRANULE/L1C_T{0}_A{1:06d}_{2}/IMG_DATA'.format(tile_id, index, stamp)
+    crs = CRS.from_epsg(epsg)
+    transform = from_origin(origin[0], origin[1], resolution, resolution)
+
+    zip_path = os.path.join(folder, title + '.zip')
+    tmp_folder = os.path.join(folder, '.' + title)
+    os.makedirs(tmp_folder, exist_ok=True)
+    data_objects = []
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+        for i, band in enumerate(S2_BANDS):
+            href = '{0}/T{1}_{2}_{3}.jp2'.format(img_data, tile_id, stamp, band)
+            band_path = os.path.join(tmp_folder, os.path.basename(href))
+            write_band(band_path, size, size, transform, crs, count=3 if band == 'TCI' else 1, seed=seed + i)
+            zf.write(band_path, safe_name + '/' + href)
+            data_objects.append(DATA_OBJECT_TEMPLATE.format(band, os.path.getsize(band_path), href))
+            os.remove(band_path)
+        zf.writestr(safe_name + '/manifest.safe', MANIFEST_TEMPLATE.format('\n'.join(data_objects)))
+    os.rmdir(tmp_folder)
+
+    bounds = transform_bounds(crs, 'EPSG:4326', origin[0], origin[1] - size * resolution, origin[0] + size * resolution, origin[1])
+    uuid = hashlib.md5('{0}:{1}'.format(title, seed).encode()).hexdigest()
+    row = {'uuid': uuid, 'title': title, 'platformname': 'Sentinel-2', 'footprint': box(*bounds).wkt,
+           'beginposition': pd.Timestamp(date), 'cloudcoverpercentage': float(index % 7),
+           'size': '{0:.2f} MB'.format(os.path.getsize(zip_path) / 2.**20)}
+    return zip_path, row
+
+
+def make_s2_products(folder, date, grid=(2, 2), size=512, resolution=10., overlap=0.1, origin=(500000., 5560000.), seed=0):
+    """
+    writes grid[0] x grid[1] overlapping S2 products
+
+    returns: (list of zip paths, catalog DataFrame, WKT of an AOI inside their union)
+    """
+    os.makedirs(folder, exist_ok=True)
+    step = size * resolution * (1 - overlap)
+    zips, rows = [], []
+    for i in range(grid[0]):
+        for j in range(grid[1]):
+            tile_origin = (origin[0] + j * step, origin[1] - i * step)
+            zip_path, row = make_s2_product(folder, date, tile_origin, size, resolution, index=len(rows), seed=seed + len(rows))
+            zips.append(zip_path)
+            rows.append(row)
+
+    union = shapely.ops.unary_union([shapely.wkt.loads(row['footprint']) for row in rows])
+    aoi = union.buffer(-0.1 * (union.bounds[2] - union.bounds[0])).envelope
+    return zips, pd.DataFrame(rows, index=[row['uuid'] for row in rows]), aoi.wkt
+
+
+def make_s1_mosaic(path, s2_path, seed=0):
+    """
+    stub of the S1 stage: a 2 band float32 (dB) GeoTIFF of the shape of the S2 mosaic,
+    shifted by half a pixel as the SNAP output usually is
+    """
+    with rasterio.open(s2_path) as s2:
+        width, height, transform = s2.width, s2.height, s2.transform
+    rng = np.random.RandomState(seed)
+    data = rng.normal(-15, 3, size=(2, height, width)).astype(np.float32)
+    shifted = transform * transform.translation(0.5, 0.5)
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=2, dtype='float32',
+                       crs='EPSG:4326', transform=shifted) as dst:
+        dst.write(data)
+    return path
+
+
+class FakeResponse(object):
+    def __init__(self, path, offset):
+        self.path = path
+        self.offset = offset
+        self.status_code = 206 if offset else 200
+        if offset >= os.path.getsize(path):
+            self.status_code = 416
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=2**20):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for block in iter(lambda: f.read(chunk_size), b''):
+                yield block
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    requests-like session serving file:// urls, with Range requests
+    """
+    def get(self, url, stream=True, headers=None):
+        offset = 0
+        if headers and 'Range' in headers:
+            offset = int(headers['Range'].split('=')[1].rstrip('-'))
+        return FakeResponse(url[len('file://'):], offset)
+
+
+class FakeSentinelAPI(object):
+    """
+    Local stand-in of sentinelsat.SentinelAPI over a catalog DataFrame and a folder of product zips
+
+    query filters on platformname, date (on beginposition), area (intersection with the footprint)
+    and any other catalog column, ranges given as tuples. Products without a zip cannot be downloaded.
+    latency: seconds each query takes, plus per_product seconds for each product returned, as the hub
+    """
+    def __init__(self, catalog, zips_folder=None, latency=0., per_product=0.):
+        self.catalog = catalog
+        self.zips_folder = zips_folder
+        self.latency = latency
+        self.per_product = per_product
+        self.session = FakeSession()
+
+    def query(self, area=None, date=None, **keywords):
+        products = self.catalog
+        if date is not None:
+            begin = pd.to_datetime(products['beginposition'])
+            products = products[(begin >= pd.Timestamp(date[0])) & (begin <= pd.Timestamp(date[1]) + pd.Timedelta(days=1))]
+        if area is not None:
+            products = products[shapely.intersects(shapely.from_wkt(products['footprint'].values), shapely.wkt.loads(area))]
+        for key, value in keywords.items():
+            if key not in products.columns:
+                continue
+            if isinstance(value, (tuple, list)):
+                products = products[(products[key] >= value[0]) & (products[key] <= value[1])]
+            else:
+                products = products[products[key] == value]
+        time.sleep(self.latency + self.per_product * len(products))
+        return OrderedDict((uuid, row.to_dict()) for uuid, row in products.iterrows())
+
+    def to_dataframe(self, products):
+        return pd.DataFrame.from_dict(products, orient='index')
+
+    def get_product_odata(self, uuid):
+        title = self.catalog.loc[uuid, 'title']
+        path = os.path.join(self.zips_folder or '', title + '.zip')
+        if not os.path.exists(path):
+            raise KeyError('{0} is not served by the fake hub'.format(title))
+        return {'id': uuid, 'title': title, 'size': os.path.getsize(path), 'md5': md5_of_file(path),
+                'url': 'file://' + os.path.abspath(path), 'Online': True}
@@ -19,21 +19,226 @@
 
 
 import logging
+import functools
+import contextlib
 from Sen12Mosaicker import Sen12Mosaicker
 import os
 import glob
 from src.S1Processor import S1Processor
 from src.S2Processor import S2Processor
-from src.utils import post_proc
+from src.Scheduler import IntervalScheduler
+from src.Datacube import Datacube
+from src.Despeckle import QueganFilter
+from src.AuxData import AuxDataManager, ORBIT_SOURCE, DEM_SOURCE
+from src.Tiling import get_aoi_tiles, get_tile_folder, get_tile_outputs, stitch_tiles
+from src.SnapGraph import get_grid_origin
+from src import Profiler, OutputProfile
+from src.utils import post_proc, read_config_section, coregister_to_grid, get_raster_grid, get_aoi_grid
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger('MainLogger')
 logging.basicConfig(level=logging.INFO)
 
+def process_s1(folder, footprint, extraction, mosaicker=None, **kwargs):
+  zip_files = mosaicker.get_selected_zips(folder, 'S1') if mosaicker is not None else None
+  s1_proc = S1Processor(folder + '/S1', footprint, extraction=extraction, zip_files=zip_files, **kwargs)
+  s1_proc.process() # the "process" method runs the complete workflow: raster processing, clipping, mosaicking, readings and writings... 
+                    # but of course each step can be executed individually e.g. s1_proc.unzip() or s2_proc.clip_all_to_aoi()  etc. 
+
+def process_s2(folder, footprint, extraction, mosaicker=None, **kwargs):
+  zip_files = mosaicker.get_selected_zips(folder, 'S2') if mosaicker is not None else None
+  s2_proc = S2Processor(folder + '/S2', footprint, extraction=extraction, zip_files=zip_files, **kwargs)
+  s2_proc.process()
+
+def process_tiled(folder, footprint, extraction, tiling, s1_kwargs, s2_kwargs, post_process_, manifest=None, mosaicker=None, snap=None, cpu=None):
+  """
+  processes the interval tile by tile: the products are extracted and the S1 scenes go through SNAP once, then each
+  tile of the AOI is clipped, mosaicked and post-processed on its own into <interval>/tiles/<tile_id>, and the tiles are
+  stitched block by block into the outputs of the interval (unless tiling['output'] is 'tiles'). The peak memory of the
+  mosaics follows the size of the tiles, not of the AOI.
+
+  snap, cpu: the pools of the scheduler, the SNAP processing of the S1 scenes goes to snap, the tiles (S1 and S2),
+             post-processing and stitching to cpu. Without them the interval gets its own: one SNAP run, tiling['workers'] tiles.
+  """
+  name = os.path.basename(folder)
+  tiles = get_aoi_tiles(footprint, tiling['rows'], tiling['cols'], tiling['tile_size_deg'])
+  zip_files = {sensor: mosaicker.get_selected_zips(folder, sensor) if mosaicker is not None else None for sensor in ('S1', 'S2')}
+  s1_proc = S1Processor(folder + '/S1', footprint, extraction=extraction, zip_files=zip_files['S1'], **s1_kwargs)
+  s2_proc = S2Processor(folder + '/S2', footprint, extraction=extraction, zip_files=zip_files['S2'], **s2_kwargs)
+  s1_proc.prepare()
+  s2_proc.prepare()
+  # the scenes are terrain corrected on the grid anchored at the corner of the AOI, the tiles are cut from it
+  s1_proc.grid_origin = get_grid_origin(footprint)
+
+  with contextlib.ExitStack() as stack:
+    if snap is None:
+      # SNAP already processes the scenes in parallel within its memory budget
+      snap = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+    if cpu is None:
+      cpu = stack.enter_context(ThreadPoolExecutor(max_workers=tiling['workers']))
+
+    s1_scenes = snap.submit(s1_proc.process_scenes)
+    s2_futures = [cpu.submit(lambda tile: s2_proc.for_tile(*tile).process_aoi(), tile) for tile in tiles]
+    s1_scenes.result()
+    s1_futures = [cpu.submit(lambda tile: s1_proc.for_tile(*tile).process_aoi(), tile) for tile in tiles]
+    post_futures = []
+    for (tile_id, tile_footprint), s2_future, s1_future in zip(tiles, s2_futures, s1_futures):
+      s2_future.result()
+      s1_future.result()
+      post_futures.append(cpu.submit(post_process_, get_tile_folder(folder, tile_id), footprint=tile_footprint,
+                                     interval='{0}/tiles/{1}'.format(name, tile_id)))
+    for future in post_futures:
+      future.result()
+    tile_folders = [get_tile_folder(folder, tile_id) for tile_id, _ in tiles]
+
+    if tiling['output'] == 'tiles':
+      return tile_folders
+    stitch = functools.partial(stitch_tiles, tile_folders, folder, memory_budget_mb=s2_proc.mosaic_memory_mb)
+    if manifest is None:
+      return cpu.submit(stitch).result()
+    return cpu.submit(manifest.run, name, 'mosaic', 'stitch', stitch, get_tile_outputs(tile_folders)).result()
+
+def coregister(folder, s1_, footprint, coregistration, name):
+  """
+  warps the S1 mosaic onto the grid of the S2 mosaics (or of the AOI), alone or stacked under the S2 mosaics
+  """
+  s2_mosaics = sorted(glob.glob(os.path.join(folder,'*S2.tif')))
+  if coregistration['grid'] == 'aoi':
+    grid = get_aoi_grid(footprint, coregistration['resolution_deg'])
+  else:
+    grid = get_raster_grid(s2_mosaics[0])
+
+  if coregistration['stack']:
+    output_path = os.path.join(folder, 'Stack_{0}_S1S2_coreg.tif'.format(name))
+    return coregister_to_grid(s2_mosaics + [s1_], output_path, grid, memory_budget_mb=coregistration['memory_budget_mb'])
+  return coregister_to_grid([s1_], s1_[:-4] + '_coreg.tif', grid, memory_budget_mb=coregistration['memory_budget_mb'])
+
+def post_process(folder, manifest=None, footprint=None, coregistration=None, interval=None, in_place=False):
+  """
+  interval: key of the interval in the run manifest and the profile, <interval>/tiles/<tile_id> for a tile
+  in_place: without co-registration, only rewrite the georeferencing of the S1 mosaic when it fits the S2 grid
+  """
+  interval = interval or os.path.basename(folder)
+  with Profiler.stage('post_process', interval):
+    s1_ = glob.glob(os.path.join(folder,'*S1.tif'))[0]
+    s2_ = glob.glob(os.path.join(folder,'*S2.tif'))[0]
+
+    if coregistration is not None and coregistration['enabled']:
+      # S1 resampled onto the S2 grid, the mosaics are left untouched
+      coregister_ = functools.partial(coregister, folder, s1_, footprint, coregistration, interval.split('/')[0])
+      if manifest is None:
+        return coregister_()
+      return manifest.run(interval, 'mosaic', 'post_process', coregister_, [s1_, s2_])
+
+    # Discrepancy between S1 and S2 extents require further post-processing
+    # following step has until now always cured it
+    if manifest is None:
+      return post_proc(s1_, s2_, in_place)
+    output = manifest.run(interval, 'mosaic', 'post_process', functools.partial(post_proc, s1_, s2_, in_place), [s1_, s2_])
+    # post_proc rewrites the S1 mosaic, which stays the valid output of the S1 merge
+    manifest.refresh(interval, 'S1', 'merge')
+    return output
+
+def get_datacube_rasters(folder, pair):
+  """
+  mosaics of the interval for the datacube: one S2 band per band mosaic, the co-registered S1 mosaic if there is one
+  """
+  name = os.path.basename(folder)
+  s2_paths = sorted(glob.glob(os.path.join(folder,'*S2.tif')))
+  s2_bands = [os.path.basename(path).replace('Mosaic_', '', 1).split('_' + name)[0] for path in s2_paths]
+  s1_paths = glob.glob(os.path.join(folder,'*S1_coreg.tif')) or glob.glob(os.path.join(folder,'*S1.tif'))
+  product_ids = lambda coverage: [product['uuid'] for product in coverage if not isinstance(product, str)]
+  return {'S2': (s2_paths, s2_bands, product_ids(pair[1])), 'S1': (s1_paths, [], product_ids(pair[2]))}
+
+def append_to_datacube(mosaicker, pairs, datacube_conf):
+  """
+  appends the intervals, in time order, to the datacube of the output folder
+  """
+  cube = Datacube(os.path.join(mosaicker.output_folder, datacube_conf['name']),
+                  chunks=(datacube_conf['chunk_time'], 1, datacube_conf['chunk_y'], datacube_conf['chunk_x']),
+                  compressor=datacube_conf['compressor'], clevel=datacube_conf['clevel'])
+  for pair in sorted(pairs, key=lambda pair: pair[0][0]):
+    folder = mosaicker.get_interval_folder(pair[0])
+    cube.append(pair[0], get_datacube_rasters(folder, pair), memory_budget_mb=datacube_conf['memory_budget_mb'])
+  return cube
+
+def despeckle(mosaicker, folders, despeckle_conf):
+  """
+  multi-temporal speckle filtering of the S1 mosaics of the intervals into *S1_despeckled.tif,
+  the intervals already in the state of the filter are not read again
+  """
+  paths = sorted(path for folder in folders for path in glob.glob(os.path.join(folder,'*S1.tif')))
+  if not paths:
+    return []
+  despeckle_filter = QueganFilter(mosaicker.output_folder, get_aoi_grid(mosaicker.footprint, despeckle_conf['resolution_deg']),
+                                  window_size=despeckle_conf['window_size'], workers=despeckle_conf['workers'],
+                                  memory_budget_mb=despeckle_conf['memory_budget_mb'])
+  return despeckle_filter.update(paths, [path[:-4] + '_despeckled.tif' for path in paths])
+
+def prefetch_auxdata(mosaicker, auxdata_conf):
+  """
+  fetches the orbits and DEM tiles of the selected S1 scenes into the auxdata cache, writes auxdata_report.json
+
+  returns the JVM options pointing SNAP at the cache
+  """
+  auxdata = AuxDataManager(auxdata_conf['folder'], orbit_source=auxdata_conf['orbit_source'], dem_source=auxdata_conf['dem_source'],
+                           offline=auxdata_conf['offline'], workers=auxdata_conf['workers'])
+  report = auxdata.prefetch(mosaicker.list_ts_pairs, mosaicker.footprint)
+  auxdata.write_report(report, os.path.join(mosaicker.output_folder, 'auxdata_report.json'))
+  if auxdata_conf['fail_on_missing']:
+    auxdata.check(report)
+  return auxdata.get_java_options()
+
 def main():
 
   conf_yaml = 'config.yaml'
 
+  profiling_conf = read_config_section(conf_yaml, 'PROFILING', {'enabled': False, 'trace': True})
+  if profiling_conf['enabled']:
+    Profiler.enable()
+
+  output_conf = read_config_section(conf_yaml, 'OUTPUT', {'enabled': False, 'compress': 'deflate', 'level': 6, 'blocksize': 512,
+                                                          'overviews': True, 'overview_resampling': 'average', 'cog': True,
+                                                          'threads': 'ALL_CPUS', 'nodata': 0})
+  if output_conf.pop('enabled'):
+    OutputProfile.configure(**output_conf)
+
   mosaicker = Sen12Mosaicker(conf_yaml)
+  try:
+    run(conf_yaml, mosaicker)
+  finally:
+    profiler = Profiler.disable()
+    if profiler is not None:
+      profiler.write(mosaicker.output_folder, trace=profiling_conf['trace'])
+
+def run(conf_yaml, mosaicker):
+  s2_conf = read_config_section(conf_yaml, 'S2', {'overview_level': None, 'bands': None, 'stack': False, 'virtual': False, 'materialize': False})
+  s2_kwargs = {key: s2_conf[key] for key in ('overview_level', 'bands', 'stack', 'virtual', 'materialize')}
+  extraction = read_config_section(conf_yaml, 'EXTRACTION', {'mode': 'full'})['mode']
+  scheduler_conf = read_config_section(conf_yaml, 'SCHEDULER', {'enabled': False})
+  snap_conf = read_config_section(conf_yaml, 'SNAP', {'backend': 'snappy'})
+  s1_conf = read_config_section(conf_yaml, 'S1', {'early_subset': False, 'subset_margin_deg': 0.1, 'slice_assembly': False})
+  s1_kwargs = {'backend': snap_conf.pop('backend'), 'snap_options': snap_conf, 'early_subset': s1_conf['early_subset'],
+               'subset_margin': s1_conf['subset_margin_deg'], 'slice_assembly': s1_conf['slice_assembly']}
+  if scheduler_conf['enabled'] and s1_kwargs['backend'] == 'gpt':
+    # each SNAP slot of the scheduler runs the gpt JVMs of one interval within s1_memory_gb,
+    # so that slots x JVMs x heap_gb stays within snap_memory_gb
+    snap_conf['memory_budget_gb'] = min(scheduler_conf.get('s1_memory_gb', 8), scheduler_conf.get('snap_memory_gb', 16))
+    if snap_conf.get('heap_gb', 8) > snap_conf['memory_budget_gb']:
+      logger.warning('\tSNAP heap_gb is larger than the memory of one interval, the gpt runs may exceed snap_memory_gb')
+  coregistration_conf = read_config_section(conf_yaml, 'COREGISTRATION', {'enabled': True, 'grid': 's2', 'resolution_deg': 0.0001,
+                                                                          'stack': False, 'memory_budget_mb': 512, 'workers': 2, 'in_place': False})
+  datacube_conf = read_config_section(conf_yaml, 'DATACUBE', {'enabled': False, 'name': 'datacube.zarr', 'chunk_time': 16, 'chunk_y': 256,
+                                                              'chunk_x': 256, 'compressor': 'zstd', 'clevel': 3, 'memory_budget_mb': 512})
+  auxdata_conf = read_config_section(conf_yaml, 'AUXDATA', {'enabled': False, 'folder': 'auxdata', 'orbit_source': ORBIT_SOURCE,
+                                                            'dem_source': DEM_SOURCE, 'offline': False, 'workers': 4,
+                                                            'fail_on_missing': True})
+  despeckle_conf = read_config_section(conf_yaml, 'DESPECKLE', {'enabled': False, 'window_size': 7, 'resolution_deg': 0.0001,
+                                                                'workers': 4, 'memory_budget_mb': 512})
+  tiling_conf = read_config_section(conf_yaml, 'TILING', {'enabled': False, 'rows': 2, 'cols': 2, 'tile_size_deg': None,
+                                                          'workers': 2, 'output': 'stitched'})
+  processor_kwargs = {'mosaic_memory_mb': read_config_section(conf_yaml, 'MOSAIC', {'memory_budget_mb': 512})['memory_budget_mb'],
+                      'manifest': mosaicker.manifest, 'store': mosaicker.store}
   mosaicker.get_products()
 
   if len(mosaicker.products_s1) >0 and len(mosaicker.products_s2)>0:
@@ -46,6 +251,36 @@ def main():
   logger.info('\tTrying to list data to form time series of {0} points in time'.format(len(mosaicker.ts_intervals))) 
 
   mosaicker.get_scenes_todownload()
+
+  if auxdata_conf['enabled']:
+    # SNAP reads the orbits and DEM tiles from the prefetched cache instead of downloading them scene by scene
+    snap_conf['java_options'] = ' '.join(option for option in (snap_conf.get('java_options', ''), prefetch_auxdata(mosaicker, auxdata_conf)) if option)
+
+  process_s1_ = functools.partial(process_s1, footprint=mosaicker.footprint, extraction=extraction, mosaicker=mosaicker, **dict(s1_kwargs, **processor_kwargs))
+  post_process_ = functools.partial(post_process, manifest=mosaicker.manifest, footprint=mosaicker.footprint, coregistration=coregistration_conf,
+                                    in_place=coregistration_conf['in_place'])
+  process_s2_ = functools.partial(process_s2, footprint=mosaicker.footprint, extraction=extraction, mosaicker=mosaicker, **dict(s2_kwargs, **processor_kwargs))
+  if tiling_conf['enabled']:
+    # the scenes are still selected once for the whole AOI, each interval is processed tile by tile
+    process_tiled_ = functools.partial(process_tiled, footprint=mosaicker.footprint, extraction=extraction, tiling=tiling_conf,
+                                       s1_kwargs=dict(s1_kwargs, **processor_kwargs), s2_kwargs=dict(s2_kwargs, **processor_kwargs),
+                                       post_process_=post_process_, manifest=mosaicker.manifest, mosaicker=mosaicker)
+
+  if scheduler_conf.pop('enabled'):
+    # downloads and processing of the intervals overlap
+    logger.info('\tDownloading and processing data to form time series of {0} points in time'.format(len(mosaicker.list_ts_pairs)))
+    if tiling_conf['enabled']:
+      # the tiles of the intervals go through the SNAP and CPU pools of the scheduler
+      status = IntervalScheduler(mosaicker, None, None, None, process_tiled=process_tiled_, backend=s1_kwargs['backend'], **scheduler_conf).run()
+    else:
+      status = IntervalScheduler(mosaicker, process_s1_, process_s2_, post_process_, backend=s1_kwargs['backend'], **scheduler_conf).run()
+    done = [pair for pair in mosaicker.list_ts_pairs if status[mosaicker.get_interval_folder(pair[0])] is None]
+    if despeckle_conf['enabled']:
+      despeckle(mosaicker, [mosaicker.get_interval_folder(pair[0]) for pair in done], despeckle_conf)
+    if datacube_conf['enabled']:
+      append_to_datacube(mosaicker, done, datacube_conf)
+    return
+
   logger.info('\tDownloading (or at least trying to) data to form time series of {0} points in time'.format(len(mosaicker.list_ts_pairs)))
 
   mosaicker.download_scenes()
@@ -53,23 +288,29 @@ def main():
 
 
   # Processing all files to form mosaicks for each time step
-  s1_folders = glob.glob(mosaicker.output_folder + '/*/S1')
-  s2_folders = glob.glob(mosaicker.output_folder + '/*/S2')
-  
-  for i in range(len(s2_folders)):
-    s1_proc = S1Processor(s1_folders[i], mosaicker.footprint)
-    s1_proc.process() # the "process" method runs the complete workflow: raster processing, clipping, mosaicking, readings and writings... 
-                      # but of course each step can be executed individually e.g. s1_proc.unzip() or s2_proc.clip_all_to_aoi()  etc. 
+  folders = [mosaicker.get_interval_folder(pair[0]) for pair in mosaicker.list_ts_pairs]
+  if tiling_conf['enabled']:
+    for folder in folders:
+      process_tiled_(folder)
+    if despeckle_conf['enabled']:
+      despeckle(mosaicker, folders, despeckle_conf)
+    if datacube_conf['enabled']:
+      append_to_datacube(mosaicker, mosaicker.list_ts_pairs, datacube_conf)
+    return
 
-    s2_proc = S2Processor(s2_folders[i], mosaicker.footprint)
-    s2_proc.process()
+  for folder in folders:
+    process_s1_(folder)
+    process_s2_(folder)
 
-    # Discrepancy between S1 and S2 extents require further post-processing
-    # following step has until now always cured it
-    s1_ = glob.glob(os.path.join(s2_folders[i],'../*S1.tif'))[0]
-    s2_ = glob.glob(os.path.join(s2_folders[i],'../*S2.tif'))[0]
+  # the intervals are post-processed in parallel
+  with ThreadPoolExecutor(max_workers=coregistration_conf['workers']) as executor:
+    list(executor.map(post_process_, folders))
+
+  if despeckle_conf['enabled']:
+    despeckle(mosaicker, folders, despeckle_conf)
 
-    post_proc(s1_, s2_)
+  if datacube_conf['enabled']:
+    append_to_datacube(mosaicker, mosaicker.list_ts_pairs, datacube_conf)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,249 @@
+import os
+import re
+import sqlite3
+import logging
+import zipfile
+import threading
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.wkt
+from src.utils import get_safe_name
+
+logger = logging.getLogger('ArchiveIndexLogger')
+logging.basicConfig(level=logging.INFO)
+
+ARCHIVE_COLUMNS = ['uuid', 'title', 'platformname', 'footprint', 'beginposition', 'cloudcoverpercentage', 'size', 'path']
+
+
+def parse_coordinates(text):
+    """
+    gml:coordinates of a SAFE manifest ('lat,lon lat,lon ...' for S1, 'lat lon lat lon ...' for S2) -> WKT polygon
+    """
+    values = [float(v) for v in text.replace(',', ' ').split()]
+    points = [(lon, lat) for lat, lon in zip(values[0::2], values[1::2])]
+    return shapely.Polygon(points).wkt
+
+
+def find_text(roots, suffixes):
+    """
+    text of the first element whose tag ends with one of suffixes, in the first of roots holding one
+    """
+    for root in roots:
+        for element in root.iter():
+            if element.text and element.tag.split('}')[-1] in suffixes:
+                return element.text
+    return None
+
+
+def parse_product(zip_file):
+    """
+    reads footprint, sensing start, cloud cover (S2) and size of a product from the manifest
+    (and the MTD_MSIL*.xml of S2) inside its zip
+
+    returns a dict with the columns of the index, without uuid
+    """
+    with zipfile.ZipFile(zip_file, 'r') as zf:
+        safe_name = get_safe_name(zf)
+        roots = []
+        for name in [safe_name + '/manifest.safe'] + [name for name in zf.namelist()
+                                                       if re.match(re.escape(safe_name) + r'/MTD_MSIL\w+\.xml$', name)]:
+            with zf.open(name) as f:
+                roots.append(ET.parse(f).getroot())
+
+    title = safe_name[:-len('.SAFE')]
+    coordinates = find_text(roots, ('coordinates', 'EXT_POS_LIST'))
+    if coordinates is None:
+        raise ValueError('no footprint in the manifest of {0}'.format(title))
+    start = find_text(roots, ('startTime', 'PRODUCT_START_TIME'))
+    if start is None:
+        # sensing start in the name: S1A_IW_GRDH_1SDV_<start>_... or S2A_MSIL1C_<start>_...
+        start = title.split('_')[4 if title.startswith('S1') else 2]
+    cloud = find_text(roots, ('Cloud_Coverage_Assessment',))
+
+    return {'title': title, 'platformname': 'Sentinel-1' if title.startswith('S1') else 'Sentinel-2',
+            'footprint': parse_coordinates(coordinates), 'beginposition': pd.Timestamp(start).tz_localize(None).isoformat(),
+            'cloudcoverpercentage': float(cloud) if cloud is not None else None,
+            'size': os.path.getsize(zip_file), 'path': os.path.abspath(zip_file)}
+
+
+def matches_query(title, query_kwargs):
+    """
+    applies the hub query kwargs the archive can check from the product name
+    """
+    fields = title.split('_')
+    if query_kwargs.get('producttype') and not fields[2].startswith(query_kwargs['producttype']):
+        return False
+    if query_kwargs.get('processinglevel') and not fields[1].endswith(query_kwargs['processinglevel'].replace('Level-', '')):
+        return False
+    return True
+
+
+class ArchiveIndex(object):
+    """
+    Persistent SQLite index of local archives of S1/S2 zips, read from the manifests inside the zips.
+
+    Footprints go into an R*Tree and sensing times into a B-tree, so queries by AOI and dates
+    don't touch the zips. update() only parses zips that are new or changed since the last scan
+    (same path, size and mtime are skipped) and forgets the ones that disappeared.
+    The hub uuid of a product is unknown locally; it is learned the first time the hub returns the product,
+    until then the title stands for it.
+    """
+    def __init__(self, path, folders=()):
+        self.path = path
+        self.folders = list(folders)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY, uuid TEXT, title TEXT UNIQUE, platformname TEXT, footprint TEXT,
+            beginposition TEXT, cloudcoverpercentage REAL, size INTEGER, path TEXT, mtime_ns INTEGER)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS products_time ON products (platformname, beginposition)')
+        self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS products_rtree USING rtree(id, minx, maxx, miny, maxy)')
+
+    def iter_zips(self):
+        for folder in self.folders:
+            for dirpath, _, filenames in os.walk(folder):
+                for filename in filenames:
+                    if filename.endswith('.zip') and filename[:2] in ('S1', 'S2'):
+                        yield os.path.abspath(os.path.join(dirpath, filename))
+
+    def update(self):
+        """
+        indexes the new and changed zips of the folders, drops the vanished ones
+
+        returns dict of counts: added, removed, unchanged, failed
+        """
+        with self.lock:
+            known = dict((path, (row_id, size, mtime)) for row_id, path, size, mtime in
+                         self.connection.execute('SELECT id, path, size, mtime_ns FROM products'))
+        counts = {'added': 0, 'removed': 0, 'unchanged': 0, 'failed': 0}
+        seen = set()
+
+        for zip_file in self.iter_zips():
+            seen.add(zip_file)
+            stat = os.stat(zip_file)
+            if zip_file in known and known[zip_file][1:] == (stat.st_size, stat.st_mtime_ns):
+                counts['unchanged'] += 1
+                continue
+            try:
+                product = parse_product(zip_file)
+            except (zipfile.BadZipFile, ValueError, ET.ParseError) as exc:
+                logger.info('\tcould not index {0}: {1}'.format(zip_file, exc))
+                counts['failed'] += 1
+                continue
+            if self.add(product, stat.st_mtime_ns):
+                counts['added'] += 1
+            else:
+                counts['unchanged'] += 1
+
+        for zip_file in set(known) - seen:
+            self.remove(known[zip_file][0])
+            counts['removed'] += 1
+
+        logger.info('\tarchive index: {added} added, {removed} removed, {unchanged} unchanged, {failed} failed'.format(**counts))
+        return counts
+
+    def add(self, product, mtime_ns):
+        """
+        returns False if the product is already indexed from another zip that still exists
+        """
+        minx, miny, maxx, maxy = shapely.wkt.loads(product['footprint']).bounds
+        with self.lock:
+            row = self.connection.execute('SELECT id, uuid, path FROM products WHERE title=?', (product['title'],)).fetchone()
+            if row is not None and row[2] != product['path'] and os.path.exists(row[2]):
+                return False
+            self.connection.execute('BEGIN')
+            if row is not None:
+                self.connection.execute('DELETE FROM products WHERE id=?', (row[0],))
+                self.connection.execute('DELETE FROM products_rtree WHERE id=?', (row[0],))
+            cursor = self.connection.execute(
+                'INSERT INTO products (uuid, title, platformname, footprint, beginposition, cloudcoverpercentage, size, path, mtime_ns) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (row[1] if row is not None else None, product['title'], product['platformname'], product['footprint'],
+                 product['beginposition'], product['cloudcoverpercentage'], product['size'], product['path'], mtime_ns))
+            self.connection.execute('INSERT INTO products_rtree VALUES (?, ?, ?, ?, ?)', (cursor.lastrowid, minx, maxx, miny, maxy))
+            self.connection.execute('COMMIT')
+        return True
+
+    def remove(self, row_id):
+        with self.lock:
+            self.connection.execute('DELETE FROM products WHERE id=?', (row_id,))
+            self.connection.execute('DELETE FROM products_rtree WHERE id=?', (row_id,))
+
+    def set_uuids(self, uuids):
+        """
+        uuids: dict title -> hub uuid
+        """
+        with self.lock:
+            self.connection.executemany('UPDATE products SET uuid=? WHERE title=?', [(uuid, title) for title, uuid in uuids.items()])
+
+    def query(self, footprint, date_interval, platformname, query_kwargs=None):
+        """
+        returns the indexed products intersecting footprint, sensed within date_interval, as a catalog DataFrame
+        (uuid, title, footprint, geometry, beginposition, cloudcoverpercentage, size in bytes, on_disk, local_path)
+        """
+        aoi = shapely.wkt.loads(footprint)
+        minx, miny, maxx, maxy = aoi.bounds
+        start, end = pd.Timestamp(date_interval[0]), pd.Timestamp(date_interval[1]) + pd.Timedelta(days=1)
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT p.uuid, p.title, p.platformname, p.footprint, p.beginposition, p.cloudcoverpercentage, p.size, p.path '
+                'FROM products p JOIN products_rtree r ON p.id = r.id '
+                'WHERE r.maxx >= ? AND r.minx <= ? AND r.maxy >= ? AND r.miny <= ? '
+                'AND p.platformname = ? AND p.beginposition >= ? AND p.beginposition < ?',
+                (minx, maxx, miny, maxy, platformname, start.isoformat(), end.isoformat())).fetchall()
+
+        products = pd.DataFrame(rows, columns=ARCHIVE_COLUMNS)
+        query_kwargs = query_kwargs or {}
+        keep = np.array([matches_query(title, query_kwargs) for title in products['title']], dtype=bool)
+        if 'cloudcoverpercentage' in query_kwargs and platformname == 'Sentinel-2':
+            low, high = query_kwargs['cloudcoverpercentage']
+            cloud = products['cloudcoverpercentage'].astype(float)
+            keep &= (cloud.isna() | ((cloud >= low) & (cloud <= high))).values
+        products = products[keep]
+
+        geometry = shapely.from_wkt(np.asarray(products['footprint'].values, dtype=object))
+        products = products[shapely.intersects(geometry, aoi)].copy()
+        products['geometry'] = shapely.from_wkt(np.asarray(products['footprint'].values, dtype=object))
+        products['uuid'] = products['uuid'].fillna(products['title'])
+        products['beginposition'] = pd.to_datetime(products['beginposition'])
+        products['on_disk'] = True
+        products = products.rename(columns={'path': 'local_path'})
+        if platformname != 'Sentinel-2':
+            products = products.drop(columns=['cloudcoverpercentage'])
+        return products.set_index('uuid', drop=False)
+
+    def annotate(self, products, footprint, date_interval, platformname, query_kwargs=None):
+        """
+        marks the products of a hub catalog held in the archive (on_disk, local_path), learns their uuids,
+        and appends the archived products matching the query the hub did not return (e.g. offline)
+        """
+        local = self.query(footprint, date_interval, platformname, query_kwargs)
+        products = products.copy()
+        if products.empty or 'title' not in products.columns:
+            if products.empty:
+                return local
+            products['on_disk'] = False
+            products['local_path'] = None
+            return products
+
+        paths = dict(zip(local['title'], local['local_path']))
+        products['local_path'] = products['title'].map(paths)
+        products['on_disk'] = products['local_path'].notna()
+        self.set_uuids(dict(zip(products.loc[products['on_disk'], 'title'], products.loc[products['on_disk'], 'uuid'])))
+
+        missing = local[~local['title'].isin(products['title'])].copy()
+        if missing.empty:
+            return products
+        if 'size' in products.columns and products['size'].dtype == object:
+            # the hub reports sizes as strings, unless the catalog was compacted
+            missing['size'] = ['{0:.2f} MB'.format(size / 2.**20) for size in missing['size']]
+        if 'geometry' not in products.columns:
+            missing = missing.drop(columns=['geometry'])
+        logger.info('\t{0} {1} products found in the archive only'.format(len(missing), platformname))
+        return pd.concat([products, missing[[c for c in missing.columns if c in products.columns]]])
+
+    def close(self):
+        self.connection.close()
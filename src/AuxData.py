@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import math
+import shutil
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import shapely
+import shapely.wkt
+
+logger = logging.getLogger('AuxDataLogger')
+logging.basicConfig(level=logging.INFO)
+
+# layout of the SNAP auxdata folder (see snap.auxdata.properties), the remote sources have the same layout
+ORBIT_FOLDER = os.path.join('Orbits', 'Sentinel-1', 'POEORB')
+DEM_FOLDER = os.path.join('dem', 'SRTM 3Sec')
+
+ORBIT_SOURCE = 'https://step.esa.int/auxdata/orbits/Sentinel-1/POEORB'
+DEM_SOURCE = 'https://download.esa.int/step/auxdata/dem/SRTM90/tiff'
+
+ORBIT_PATTERN = re.compile(r'(S1[AB]_OPER_AUX_POEORB_OPOD_\w+?_V(\d{8}T\d{6})_(\d{8}T\d{6})\.EOF\.zip)')
+
+
+class AuxDataMissingError(Exception):
+    pass
+
+
+def parse_time(text):
+    return datetime.datetime.strptime(text, '%Y%m%dT%H%M%S')
+
+
+def get_orbit_need(title):
+    """
+    S1A_IW_GRDH_1SDV_<start>_<stop>_... -> (mission, sensing start, sensing stop)
+    """
+    fields = title.split('_')
+    return fields[0], parse_time(fields[4]), parse_time(fields[5])
+
+
+def get_orbit_months(start):
+    """
+    (year, month) folders that may hold the precise orbit of a sensing start: its own and, as a file
+    is valid from the day before, the previous one on the first day of a month
+    """
+    months = [(start.year, start.month)]
+    before = start - datetime.timedelta(days=1)
+    if (before.year, before.month) not in months:
+        months.append((before.year, before.month))
+    return months
+
+
+def get_srtm_tiles(geometry):
+    """
+    names of the 5x5 degree CGIAR SRTM 3Sec tiles (srtm_XX_YY) intersecting geometry, which covers 60S to 60N
+    """
+    minx, miny, maxx, maxy = geometry.bounds
+    tiles = []
+    for x in range(int(math.floor((minx + 180) / 5.)) + 1, int(math.floor((maxx + 180) / 5.)) + 2):
+        for y in range(max(1, int(math.floor((60 - maxy) / 5.)) + 1), min(24, int(math.floor((60 - miny) / 5.)) + 1) + 1):
+            cell = shapely.box(-180 + (x - 1) * 5, 60 - y * 5, -180 + x * 5, 60 - (y - 1) * 5)
+            if 1 <= x <= 72 and cell.intersects(geometry):
+                tiles.append('srtm_{0:02d}_{1:02d}'.format(x, y))
+    return tiles
+
+
+class AuxDataManager(object):
+    """
+    Local cache of the auxiliary data SNAP needs for the S1 processing: Sentinel-1 precise orbits (POEORB)
+    for Apply-Orbit-File and SRTM 3Sec tiles for Terrain-Correction.
+
+    The orbits and tiles of a run are worked out from the S1 scenes of list_ts_pairs (orbits from the
+    sensing times in the names, tiles from the footprints) and fetched once, concurrently, before the processing,
+    into folder laid out as the SNAP auxdata folder. SNAP is pointed at it (get_java_options), so it no longer
+    downloads them scene by scene. The cache is shared: files already in it are never fetched again.
+
+    A source is an URL or a local folder with the same layout, e.g. a mirror for air-gapped workers
+    (or a test fixture). In offline mode nothing is fetched and the report lists what is missing.
+    """
+    def __init__(self, folder, orbit_source=ORBIT_SOURCE, dem_source=DEM_SOURCE, offline=False, workers=4, session=None):
+        self.folder = os.path.abspath(folder)
+        self.orbit_source = orbit_source
+        self.dem_source = dem_source
+        self.offline = offline
+        self.workers = workers
+        # requests-like session for the URL sources
+        self.session = session
+        self.listings = {}
+
+    def get_session(self):
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        return self.session
+
+    @staticmethod
+    def is_url(source):
+        return '://' in source
+
+    def list_source(self, source, relative_folder):
+        """
+        names of the files of a folder of a source (an empty list if it has no such folder)
+        """
+        key = (source, relative_folder)
+        if key not in self.listings:
+            if self.is_url(source):
+                url = '/'.join(part for part in (source.rstrip('/'), relative_folder.replace(os.sep, '/').strip('/')) if part)
+                response = self.get_session().get(url + '/')
+                if response.status_code == 404:
+                    names = []
+                else:
+                    response.raise_for_status()
+                    names = sorted(set(re.findall(r'href="([^"/?]+)"', response.text)))
+            else:
+                folder = os.path.join(source, relative_folder)
+                names = sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+            self.listings[key] = names
+        return self.listings[key]
+
+    def fetch(self, source, relative_path, output_path):
+        """
+        copies or downloads relative_path of source to output_path, returns False if the source has no such file
+        """
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        # other threads and runs may fetch the same file into the shared cache, each writes its own partial file
+        tmp_path = '{0}.{1}.{2}.part'.format(output_path, os.getpid(), threading.get_ident())
+        try:
+            if self.is_url(source):
+                response = self.get_session().get('{0}/{1}'.format(source.rstrip('/'), relative_path.replace(os.sep, '/')), stream=True)
+                if response.status_code == 404:
+                    return False
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=2**20):
+                        f.write(chunk)
+            else:
+                if not os.path.exists(os.path.join(source, relative_path)):
+                    return False
+                shutil.copy(os.path.join(source, relative_path), tmp_path)
+            os.replace(tmp_path, output_path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_needs(self, list_ts_pairs, footprint):
+        """
+        returns the S1 scenes of the pairs as (mission, start, stop, title) and the geometry the DEM must cover
+        (the footprints of the scenes, the AOI if they have none)
+        """
+        scenes, geometries = {}, []
+        for pair in list_ts_pairs:
+            for product in pair[2]:
+                if isinstance(product, str):
+                    continue
+                scenes[product['title']] = get_orbit_need(product['title']) + (product['title'],)
+                if isinstance(product.get('footprint'), str):
+                    geometries.append(shapely.wkt.loads(product['footprint']))
+        geometry = shapely.unary_union(geometries) if geometries else shapely.wkt.loads(footprint)
+        return sorted(scenes.values(), key=lambda scene: scene[1]), geometry
+
+    def find_orbit(self, names, start, stop):
+        """
+        the most recent of the orbit files names valid over [start, stop], or None
+        """
+        valid = []
+        for name in names:
+            match = ORBIT_PATTERN.match(name)
+            if match and parse_time(match.group(2)) <= start and parse_time(match.group(3)) >= stop:
+                valid.append(name)
+        return max(valid) if valid else None
+
+    def get_orbit_folders(self, mission, start):
+        """
+        folders of the cache that may hold the orbit of a scene of mission starting at start (see get_orbit_months)
+        """
+        return [os.path.join(ORBIT_FOLDER, mission, '{0:04d}'.format(year), '{0:02d}'.format(month))
+                for year, month in get_orbit_months(start)]
+
+    def get_orbit(self, mission, start, stop):
+        """
+        returns ('cached' | 'fetched' | 'missing', path of the orbit file in the cache or the folders looked into)
+        """
+        folders = self.get_orbit_folders(mission, start)
+        for folder in folders:
+            local = os.path.join(self.folder, folder)
+            name = self.find_orbit(sorted(os.listdir(local)) if os.path.isdir(local) else [], start, stop)
+            if name is not None:
+                return 'cached', os.path.join(local, name)
+        if self.offline:
+            return 'missing', [os.path.join(self.folder, folder) for folder in folders]
+
+        for folder in folders:
+            name = self.find_orbit(self.list_source(self.orbit_source, os.path.relpath(folder, ORBIT_FOLDER)), start, stop)
+            if name is not None and self.fetch(self.orbit_source, os.path.join(os.path.relpath(folder, ORBIT_FOLDER), name),
+                                               os.path.join(self.folder, folder, name)):
+                return 'fetched', os.path.join(self.folder, folder, name)
+        return 'missing', [os.path.join(self.folder, folder) for folder in folders]
+
+    def get_dem_path(self, tile):
+        return os.path.join(self.folder, DEM_FOLDER, tile + '.zip')
+
+    def get_dem_tile(self, tile):
+        """
+        returns ('cached' | 'fetched' | 'missing' | 'not_at_source', path of the tile in the cache),
+        'not_at_source' being a tile of sea only, which SRTM does not provide and SNAP does not need:
+        a tile the source does not have while its listing has other tiles. Such tiles are remembered in the cache
+        by an empty <tile>.zip.not_at_source, for the offline runs. A tile the source lists (or that could not be
+        checked against the listing) but failed to fetch is missing, and fetched again by the next run.
+        """
+        path = self.get_dem_path(tile)
+        if os.path.exists(path):
+            return 'cached', path
+        if os.path.exists(path + '.not_at_source'):
+            return 'not_at_source', path
+        if self.offline:
+            return 'missing', path
+        if self.fetch(self.dem_source, tile + '.zip', path):
+            return 'fetched', path
+        listing = self.list_source(self.dem_source, '')
+        if not listing or tile + '.zip' in listing:
+            return 'missing', path
+        open(path + '.not_at_source', 'w').close()
+        return 'not_at_source', path
+
+    @staticmethod
+    def get_entry(name, func, args, path_on_error):
+        """
+        runs func(*args) -> (status, path) into a report entry, an error (e.g. connection error, 5xx) making the file missing
+        """
+        try:
+            status, path = func(*args)
+            return {'status': status, 'path': path}
+        except Exception as exc:
+            logger.info('\tfetching {0} failed: {1}'.format(name, exc))
+            return {'status': 'missing', 'path': path_on_error, 'error': repr(exc)}
+
+    def prefetch(self, list_ts_pairs, footprint):
+        """
+        fetches the orbits and DEM tiles of the S1 scenes of list_ts_pairs missing from the cache,
+        a file that fails to be fetched is reported missing with the error (check decides whether the run goes on)
+
+        returns the report: for orbits (per scene) and dem (per tile), the status and path of each
+        """
+        scenes, geometry = self.get_needs(list_ts_pairs, footprint)
+        tiles = get_srtm_tiles(geometry)
+        logger.info('\tAuxiliary data of {0} S1 scenes: orbits and {1} SRTM tiles{2}'.format(
+            len(scenes), len(tiles), ' (offline)' if self.offline else ''))
+
+        orbit_entry = lambda scene: self.get_entry('the orbit of ' + scene[3], self.get_orbit, scene[:3],
+                                                   [os.path.join(self.folder, folder) for folder in self.get_orbit_folders(*scene[:2])])
+        dem_entry = lambda tile: self.get_entry('DEM tile ' + tile, self.get_dem_tile, (tile,), self.get_dem_path(tile))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            orbits = list(executor.map(orbit_entry, scenes))
+            dem = list(executor.map(dem_entry, tiles))
+
+        report = {'folder': self.folder, 'offline': self.offline,
+                  'orbits': {scene[3]: entry for scene, entry in zip(scenes, orbits)},
+                  'dem': {tile: entry for tile, entry in zip(tiles, dem)}}
+        for kind in ('orbits', 'dem'):
+            counts = {}
+            for entry in report[kind].values():
+                counts[entry['status']] = counts.get(entry['status'], 0) + 1
+            logger.info('\t{0}: {1}'.format(kind, ', '.join('{0} {1}'.format(count, status) for status, count in sorted(counts.items()))))
+        return report
+
+    @staticmethod
+    def get_missing(report):
+        """
+        list of what the report misses: the scenes without orbit, the DEM tiles not in the cache (with the error of their fetch, if any)
+        """
+        error = lambda entry: ': {0}'.format(entry['error']) if entry.get('error') else ''
+        return ['orbit of {0} (looked into {1}){2}'.format(title, ', '.join(entry['path']), error(entry))
+                for title, entry in report['orbits'].items() if entry['status'] == 'missing'] + \
+               ['DEM tile {0}{1}'.format(entry['path'], error(entry)) for entry in report['dem'].values() if entry['status'] == 'missing']
+
+    def write_report(self, report, path):
+        with open(path, 'w') as f:
+            json.dump(dict(report, missing=self.get_missing(report)), f, indent=2)
+        return path
+
+    def check(self, report):
+        """
+        raises AuxDataMissingError listing what is missing, if anything
+        """
+        missing = self.get_missing(report)
+        if missing:
+            raise AuxDataMissingError('{0} auxiliary files missing from {1}:\n{2}'.format(len(missing), self.folder, '\n'.join(missing)))
+
+    def get_java_options(self):
+        """
+        JVM options pointing SNAP at the cache, the paths of the orbits and DEM tiles derive from AuxDataPath
+        """
+        return '-DAuxDataPath={0}'.format(self.folder)
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import fcntl
+import contextlib
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+import shapely
+
+logger = logging.getLogger('CatalogCacheLogger')
+logging.basicConfig(level=logging.INFO)
+
+CATALOG_COLUMNS = ['uuid', 'title', 'footprint', 'beginposition', 'cloudcoverpercentage', 'size']
+
+# dtypes of the columns of a compact catalog
+CATALOG_DTYPES = {'uuid': object, 'title': object, 'footprint': object, 'beginposition': 'datetime64[ns]',
+                  'cloudcoverpercentage': np.float32, 'size': np.int64, 'geometry': object}
+
+SIZE_UNITS = {'B': 1, 'KB': 2**10, 'MB': 2**20, 'GB': 2**30, 'TB': 2**40}
+
+
+class CatalogCacheMiss(Exception):
+    pass
+
+
+def parse_size(size):
+    """
+    '1.08 GB' (as returned by the hub) -> number of bytes
+    """
+    if isinstance(size, str):
+        value, unit = size.split()
+        return int(float(value) * SIZE_UNITS[unit.upper()])
+    return size
+
+
+def compact_catalog(products):
+    """
+    returns a copy of an api.to_dataframe() catalog restricted to the columns the pipeline uses,
+    in compact dtypes and with the footprints parsed once into a 'geometry' column
+
+    A query without result gives a frame without columns, it becomes an empty catalog with all the columns
+    """
+    if products.empty:
+        return pd.DataFrame({c: pd.Series(dtype=dtype) for c, dtype in CATALOG_DTYPES.items()})
+    products = products[[c for c in CATALOG_COLUMNS if c in products.columns]].copy()
+
+    products['uuid'] = products['uuid'].astype(str)
+    products['beginposition'] = pd.to_datetime(products['beginposition'])
+    if 'cloudcoverpercentage' in products.columns:
+        products['cloudcoverpercentage'] = products['cloudcoverpercentage'].astype(np.float32)
+    if 'size' in products.columns:
+        products['size'] = products['size'].map(parse_size).astype(np.int64)
+    products['geometry'] = shapely.from_wkt(np.asarray(products['footprint'].values, dtype=object))
+    return products
+
+
+class CatalogCache(object):
+    """
+    On-disk cache of query results, one parquet file per query with the footprints stored as WKB.
+
+    Entries are keyed by footprint, date range and query kwargs, expire after ttl_hours and the least
+    recently used entries are evicted once the cache grows over max_size_mb.
+    In offline mode expired entries are still served and a miss raises CatalogCacheMiss.
+    The cache can be shared by concurrent runs: the index and the files it lists are only read and updated
+    under a flock()ed index.lock, as the entries of ProductStore.
+    """
+    def __init__(self, folder, ttl_hours=24*7, max_size_mb=1024, offline=False):
+        self.folder = folder
+        self.ttl = ttl_hours * 3600.
+        self.max_size = max_size_mb * 2**20
+        self.offline = offline
+        self.index_path = os.path.join(folder, 'index.json')
+        self.lock_path = os.path.join(folder, 'index.lock')
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    @staticmethod
+    def get_key(footprint, date_interval, query_kwargs):
+        blob = json.dumps({'footprint': footprint, 'date': [str(d) for d in date_interval], 'kwargs': query_kwargs},
+                          sort_keys=True, default=str)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        exclusive lock on the index across threads and processes
+        """
+        with open(self.lock_path, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def write_index(self, index):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get_path(self, key):
+        return os.path.join(self.folder, key + '.parquet')
+
+    def get(self, key):
+        """
+        returns the cached catalog or None
+        """
+        with self.lock():
+            index = self.read_index()
+            entry = index.get(key)
+            if entry is None or not os.path.exists(self.get_path(key)):
+                if self.offline:
+                    raise CatalogCacheMiss('no cached catalog for this query and running offline')
+                return None
+
+            if time.time() - entry['created'] > self.ttl:
+                if not self.offline:
+                    return None
+                logger.info('\tserving an expired catalog from the cache (offline)')
+
+            products = pd.read_parquet(self.get_path(key))
+            entry['last_access'] = time.time()
+            self.write_index(index)
+
+        products['geometry'] = shapely.from_wkb(products.pop('geometry_wkb').values)
+        products['footprint'] = shapely.to_wkt(products['geometry'].values, rounding_precision=-1)
+        return products
+
+    def put(self, key, products):
+        stored = products.drop(columns=['geometry', 'footprint'])
+        stored['geometry_wkb'] = shapely.to_wkb(products['geometry'].values)
+
+        # written aside by each process, only moved into place under the lock
+        tmp_path = '{0}.{1}.tmp'.format(self.get_path(key), os.getpid())
+        stored.to_parquet(tmp_path, index=False)
+        with self.lock():
+            os.replace(tmp_path, self.get_path(key))
+
+            index = self.read_index()
+            now = time.time()
+            index[key] = {'created': now, 'last_access': now, 'bytes': os.path.getsize(self.get_path(key))}
+            self.evict(index)
+            self.write_index(index)
+
+    def evict(self, index):
+        for key in [k for k, entry in index.items() if time.time() - entry['created'] > self.ttl]:
+            self.remove(index, key)
+
+        total = sum(entry['bytes'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_access']):
+            if total <= self.max_size:
+                break
+            total -= index[key]['bytes']
+            self.remove(index, key)
+
+    def remove(self, index, key):
+        if os.path.exists(self.get_path(key)):
+            os.remove(self.get_path(key))
+        del index[key]
@@ -0,0 +1,175 @@
+import numpy as np
+import shapely
+import shapely.wkt
+from shapely.strtree import STRtree
+from src.CatalogCache import parse_size
+
+
+class CoverageSelector(object):
+    """
+    Greedy set cover of the AOI by product footprints.
+
+    Picks the same scenes as the recursive get_complete_coverage_of_AOI did: at each step the scene
+    with the largest (rounded) intersection with the still uncovered area, ties broken by the least cloud cover
+    then the largest size. Products already on disk (on_disk column, if any) are preferred whenever their
+    intersection is within disk_tolerance (a fraction) of the largest one. Footprints are parsed once, candidates are pruned with an
+    STRtree and, after each pick, only the gains of the scenes touching the newly covered part are
+    recomputed, in one vectorized shapely call.
+
+    select_weighted solves the cover as a weighted set cover instead, minimizing the download cost.
+    """
+    def __init__(self, products):
+        self.products = products
+
+        if 'geometry' in products.columns:
+            self.geoms = np.asarray(products['geometry'].values, dtype=object)
+        else:
+            self.geoms = shapely.from_wkt(np.asarray(products['footprint'].values, dtype=object))
+        self.tree = STRtree(self.geoms)
+
+        n = len(products)
+        # sort keys equivalent to sort_values(['cloudcoverpercentage', 'size'], ascending=[True, False])
+        if 'cloudcoverpercentage' in products.columns:
+            self.cloud_key = products['cloudcoverpercentage'].astype(float).fillna(np.inf).values
+            self.size_key = -products['size'].rank(method='dense').fillna(-np.inf).values
+        else:
+            self.cloud_key = np.zeros(n)
+            self.size_key = np.zeros(n)
+        self.order_key = np.arange(n)
+        # products already in a local archive cost nothing, they win the ties
+        if 'on_disk' in products.columns:
+            self.disk_key = -products['on_disk'].fillna(False).astype(bool).values.astype(int)
+        else:
+            self.disk_key = np.zeros(n, dtype=int)
+
+    def get_costs(self, cloud_weight=1., on_disk_weight=0., free_uuids=()):
+        """
+        cost of each product: its size in bytes, raised by cloud_weight times its cloud cover fraction,
+        scaled by on_disk_weight for products already on disk (or in free_uuids, e.g. selected for another interval)
+        """
+        n = len(self.products)
+        sizes = self.products['size'].map(parse_size).astype(float).fillna(0).values if 'size' in self.products.columns else np.ones(n)
+        if 'cloudcoverpercentage' in self.products.columns:
+            clouds = self.products['cloudcoverpercentage'].astype(float).fillna(0).values / 100.
+        else:
+            clouds = np.zeros(n)
+        costs = sizes * (1 + cloud_weight * clouds)
+
+        free = self.disk_key < 0
+        if free_uuids:
+            free |= self.products['uuid'].isin(free_uuids).values
+        costs[free] *= on_disk_weight
+        # free products still rank among themselves by their gain
+        return np.maximum(costs, 1e-9 * max(costs.max(), 1.))
+
+    def get_gains(self, indices, remaining):
+        return shapely.area(shapely.intersection(self.geoms[indices], remaining))
+
+    def get_top(self, gains, disk_tolerance=0.):
+        """
+        returns the index and rounded gain of the next pick: the largest gain, or the largest gain of the products
+        on disk if it is within disk_tolerance of it, ties broken by the sort keys
+        """
+        rounded = np.round(gains, 2)
+        ties = np.flatnonzero(rounded == rounded.max())
+        on_disk = np.flatnonzero((self.disk_key < 0) & (gains > 0) & (gains >= (1 - disk_tolerance) * gains.max()))
+        if on_disk.size:
+            ties = on_disk[rounded[on_disk] == rounded[on_disk].max()]
+        best = np.lexsort((self.order_key[ties], self.size_key[ties], self.cloud_key[ties], self.disk_key[ties]))[0]
+        return ties[best], rounded[ties[best]]
+
+    def select(self, aoi_fp, logger, min_coverage=0.90, disk_tolerance=0.05):
+        """
+        disk_tolerance: a product on disk is picked over one to download covering up to this fraction more
+
+        returns: list of the selected product rows, ending with 'incomplete' if the AOI can't be covered
+        """
+        remaining = shapely.wkt.loads(aoi_fp) if isinstance(aoi_fp, str) else aoi_fp
+        aoi_area = remaining.area
+
+        gains = np.zeros(len(self.geoms))
+        candidates = self.tree.query(remaining)
+        gains[candidates] = self.get_gains(candidates, remaining)
+
+        selected = []
+        while True:
+            top, rounded_gain = self.get_top(gains, disk_tolerance)
+            intersection_area = gains[top]
+
+            if intersection_area == 0:
+                logger.info('the whole area could not be fully covered. Scenes are missing!')
+                return selected + ['incomplete']
+
+            top_scene = self.products.iloc[top].copy()
+            top_scene['intersection_AOI'] = rounded_gain
+            selected.append(top_scene)
+
+            covered = shapely.intersection(remaining, self.geoms[top])
+            remaining = shapely.difference(remaining, self.geoms[top])
+
+            if remaining.area < (1-min_coverage) * aoi_area:
+                return selected
+
+            logger.info('Looking for more scenes. Non covered area percentage until now = {0}%'.format(float((remaining.area/aoi_area))))
+            affected = self.tree.query(covered)
+            gains[affected] = self.get_gains(affected, remaining)
+            gains[top] = 0
+
+    def prune(self, selected, aoi, min_coverage, costs):
+        """
+        drops the most expensive selected scenes the others make redundant for min_coverage
+        """
+        aoi_area = aoi.area
+        kept = list(selected)
+        for index in sorted(selected, key=lambda i: -costs[i]):
+            others = [i for i in kept if i != index]
+            if not others:
+                break
+            left_over = shapely.difference(aoi, shapely.union_all(self.geoms[others]))
+            if left_over.area < (1-min_coverage) * aoi_area:
+                kept = others
+        return kept
+
+    def select_weighted(self, aoi_fp, logger, min_coverage=0.90, cloud_weight=1., on_disk_weight=0., free_uuids=()):
+        """
+        weighted set cover of the AOI: picks the scene with the largest newly covered area per cost
+        (see get_costs) until min_coverage is reached, then drops the scenes made redundant
+
+        returns: list of the selected product rows, ending with 'incomplete' if the AOI can't be covered
+        """
+        aoi = shapely.wkt.loads(aoi_fp) if isinstance(aoi_fp, str) else aoi_fp
+        remaining = aoi
+        aoi_area = aoi.area
+        costs = self.get_costs(cloud_weight, on_disk_weight, free_uuids)
+
+        gains = np.zeros(len(self.geoms))
+        candidates = self.tree.query(remaining)
+        gains[candidates] = self.get_gains(candidates, remaining)
+
+        selected, picked_gains = [], {}
+        complete = True
+        while remaining.area >= (1-min_coverage) * aoi_area:
+            top = int(np.argmax(gains / costs))
+            if gains[top] <= 0:
+                logger.info('the whole area could not be fully covered. Scenes are missing!')
+                complete = False
+                break
+
+            selected.append(top)
+            picked_gains[top] = gains[top]
+            covered = shapely.intersection(remaining, self.geoms[top])
+            remaining = shapely.difference(remaining, self.geoms[top])
+
+            affected = self.tree.query(covered)
+            gains[affected] = self.get_gains(affected, remaining)
+            gains[top] = 0
+
+        if complete:
+            selected = self.prune(selected, aoi, min_coverage, costs)
+
+        scenes = []
+        for index in selected:
+            scene = self.products.iloc[index].copy()
+            scene['intersection_AOI'] = round(picked_gains[index], 2)
+            scenes.append(scene)
+        return scenes if complete else scenes + ['incomplete']
@@ -0,0 +1,175 @@
+import logging
+import numpy as np
+import rasterio
+import zarr
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling
+from src.utils import iter_block_windows
+
+logger = logging.getLogger('DatacubeLogger')
+logging.basicConfig(level=logging.INFO)
+
+
+class Datacube(object):
+    """
+    Chunked, compressed Zarr datacube of the time series, one (time, band, y, x) array per sensor.
+
+    The interval dates ('time_start', 'time_end') and the ids of the products of each interval
+    ('products_S1', 'products_S2') are stored as coordinates along time, the grid as 'x' and 'y'.
+    The arrays carry xarray's _ARRAY_DIMENSIONS, so xarray.open_zarr reads the cube directly.
+    Intervals are kept in time order: a new interval is appended after the last one, an earlier one (a backfill)
+    moves the later ones one index up, an interval appended again is overwritten. Writing one interval rewrites
+    the time chunks it falls in (chunk_time intervals each), the other chunks are left untouched.
+
+    chunks: (time, band, y, x) chunk shape, e.g. (1, 1, 1024, 1024) for maps or (64, 1, 128, 128) for pixel time series
+    """
+    def __init__(self, path, chunks=(16, 1, 256, 256), compressor='zstd', clevel=3):
+        self.path = path
+        self.chunks = tuple(chunks)
+        self.compressor = zarr.Blosc(cname=compressor, clevel=clevel, shuffle=zarr.Blosc.BITSHUFFLE)
+        self.root = zarr.open_group(path, mode='a')
+
+    def get_grid(self):
+        """
+        returns (crs, transform, width, height) of the cube, None if empty
+        """
+        if 'grid' not in self.root.attrs:
+            return None
+        grid = self.root.attrs['grid']
+        return rasterio.crs.CRS.from_wkt(grid['crs']), rasterio.Affine(*grid['transform']), grid['width'], grid['height']
+
+    def init_grid(self, path):
+        with rasterio.open(path) as src:
+            crs, transform, width, height = src.crs, src.transform, src.width, src.height
+
+        self.root.attrs['grid'] = {'crs': crs.to_wkt(), 'transform': list(transform)[:6], 'width': width, 'height': height}
+        x = self.root.create_dataset('x', data=transform.c + transform.a * (np.arange(width) + 0.5), overwrite=True)
+        y = self.root.create_dataset('y', data=transform.f + transform.e * (np.arange(height) + 0.5), overwrite=True)
+        x.attrs['_ARRAY_DIMENSIONS'] = ['x']
+        y.attrs['_ARRAY_DIMENSIONS'] = ['y']
+
+        for name in ('time_start', 'time_end'):
+            coordinate = self.root.create_dataset(name, shape=(0,), chunks=(1024,), dtype='M8[s]', overwrite=True)
+            coordinate.attrs['_ARRAY_DIMENSIONS'] = ['time']
+
+    def get_time_arrays(self):
+        """
+        names of the arrays along time: dates, product ids and sensors
+        """
+        sensors = self.root.attrs.get('sensors', [])
+        return [name for name in self.root.array_keys()
+                if name in ('time_start', 'time_end') or name.startswith('products_') or name in sensors]
+
+    def get_time_index(self, interval, memory_budget_mb=512):
+        """
+        index of the interval along time, inserting it in time order if new: appended after the last interval,
+        or, for an earlier one (a backfill), the later intervals are moved one index up
+        """
+        start = np.datetime64(interval[0], 's')
+        starts = self.root['time_start'][:]
+        found = np.flatnonzero(starts == start)
+        if found.size:
+            return int(found[0])
+
+        t = int(np.searchsorted(starts, start))
+        for name in self.get_time_arrays():
+            array = self.root[name]
+            array.resize((len(starts) + 1,) + array.shape[1:])
+        if t < len(starts):
+            logger.info('\t{0} - {1} is earlier than the last interval, moving {2} intervals of {3}'.format(
+                interval[0], interval[1], len(starts) - t, self.path))
+            self.shift_time(t, memory_budget_mb)
+        self.root['time_start'][t] = start
+        self.root['time_end'][t] = np.datetime64(interval[1], 's')
+        return t
+
+    def shift_time(self, t, memory_budget_mb=512):
+        """
+        moves the time indices t and above one index up (the arrays already have the room for it) and empties t,
+        block by block within the memory budget
+        """
+        for name in self.get_time_arrays():
+            array = self.root[name]
+            if array.ndim == 1:
+                array[t + 1:] = array[t:-1]
+                if name.startswith('products_'):
+                    array[t] = ''
+                continue
+
+            moved, count, height, width = array.shape[0] - 1 - t, array.shape[1], array.shape[2], array.shape[3]
+            block_size = int(np.lcm(array.chunks[2], array.chunks[3]))
+            for window in iter_block_windows(width, height, moved * count, array.dtype, memory_budget_mb, block_size=block_size):
+                rows = slice(int(window.row_off), int(window.row_off + window.height))
+                cols = slice(int(window.col_off), int(window.col_off + window.width))
+                array[t + 1:, :, rows, cols] = array[t:-1, :, rows, cols]
+                array[t, :, rows, cols] = array.fill_value
+
+    def require_sensor(self, sensor, count, dtype, band_names):
+        if sensor not in self.root:
+            if len(band_names) != count:
+                band_names = ['{0}_{1}'.format(sensor, i + 1) for i in range(count)]
+            _, _, width, height = self.get_grid()
+            chunks = (self.chunks[0], min(self.chunks[1], count), min(self.chunks[2], height), min(self.chunks[3], width))
+            array = self.root.create_dataset(sensor, shape=(len(self.root['time_start']), count, height, width), chunks=chunks,
+                                             dtype=dtype, compressor=self.compressor, fill_value=0)
+            array.attrs['_ARRAY_DIMENSIONS'] = ['time', 'band_' + sensor, 'y', 'x']
+            bands = self.root.create_dataset('band_' + sensor, data=np.array(band_names, dtype=object), dtype=str, overwrite=True)
+            bands.attrs['_ARRAY_DIMENSIONS'] = ['band_' + sensor]
+            products = self.root.create_dataset('products_' + sensor, shape=(len(self.root['time_start']),), chunks=(1024,), dtype=str)
+            products.attrs['_ARRAY_DIMENSIONS'] = ['time']
+            self.root.attrs['sensors'] = self.root.attrs.get('sensors', []) + [sensor]
+        return self.root[sensor]
+
+    def write_sensor(self, sensor, t, paths, band_names, product_ids, memory_budget_mb=512):
+        """
+        writes the rasters of paths (bands in order) at time index t, warped onto the cube grid if needed
+        """
+        crs, transform, width, height = self.get_grid()
+        sources = [rasterio.open(path) for path in paths]
+        datasets = []
+        try:
+            for src in sources:
+                if (src.crs, src.transform, src.width, src.height) == (crs, transform, width, height):
+                    datasets.append(src)
+                else:
+                    datasets.append(WarpedVRT(src, crs=crs, transform=transform, width=width, height=height, resampling=Resampling.bilinear))
+
+            count = sum(dataset.count for dataset in datasets)
+            array = self.require_sensor(sensor, count, datasets[0].dtypes[0], band_names)
+
+            # blocks aligned on the spatial chunks, so each chunk is written once
+            block_size = int(np.lcm(array.chunks[2], array.chunks[3]))
+            for window in iter_block_windows(width, height, count, array.dtype, memory_budget_mb, block_size=block_size):
+                rows = slice(int(window.row_off), int(window.row_off + window.height))
+                cols = slice(int(window.col_off), int(window.col_off + window.width))
+                block = np.concatenate([dataset.read(window=window, out_dtype=array.dtype) for dataset in datasets])
+                array[t, :, rows, cols] = block
+
+            self.root['products_' + sensor][t] = ','.join(product_ids)
+        finally:
+            for dataset in datasets:
+                if dataset not in sources:
+                    dataset.close()
+            for src in sources:
+                src.close()
+
+    def append(self, interval, rasters, memory_budget_mb=512):
+        """
+        interval: (start, end) datetimes
+        rasters: dict sensor -> (list of raster paths, list of band names, list of product ids)
+        (band names default to <sensor>_<i> if they do not match the bands of the rasters,
+        sensors without raster are not written, they stay empty at this time index)
+        """
+        rasters = {sensor: raster for sensor, raster in rasters.items() if raster[0]}
+        if not rasters:
+            logger.info('\t{0} - {1} has no mosaic, not written to {2}'.format(interval[0], interval[1], self.path))
+            return None
+        if self.get_grid() is None:
+            first_paths = rasters['S2'][0] if 'S2' in rasters else list(rasters.values())[0][0]
+            self.init_grid(first_paths[0])
+
+        t = self.get_time_index(interval, memory_budget_mb)
+        for sensor, (paths, band_names, product_ids) in rasters.items():
+            self.write_sensor(sensor, t, paths, band_names, product_ids, memory_budget_mb)
+        logger.info('\t{0} - {1} written at time index {2} of {3}'.format(interval[0], interval[1], t, self.path))
+        return t
@@ -0,0 +1,273 @@
+import os
+import json
+import logging
+import contextlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from rasterio.warp import Resampling
+from src.utils import atomic_output, raster_output, iter_block_windows
+from src.RunManifest import fingerprint
+from src import Profiler
+
+logger = logging.getLogger('DespeckleLogger')
+logging.basicConfig(level=logging.INFO)
+
+# WarpedVRTs opened by a worker process, kept open for all the blocks it processes
+_datasets = {}
+
+
+def box_sum(array, radius):
+    """
+    sums over the (2 * radius + 1)^2 windows of the last two axes (zero outside), through an integral image
+    """
+    size = 2 * radius + 1
+    padded = np.pad(array, [(0, 0)] * (array.ndim - 2) + [(radius + 1, radius), (radius + 1, radius)])
+    integral = padded.cumsum(axis=-2).cumsum(axis=-1)
+    return integral[..., size:, size:] - integral[..., :-size, size:] - integral[..., size:, :-size] + integral[..., :-size, :-size]
+
+
+def local_mean(intensities, valid, radius):
+    """
+    mean of the valid pixels of the windows around every pixel, 0 where there is none
+    """
+    sums = box_sum(np.where(valid, intensities, 0.), radius)
+    counts = box_sum(valid.astype(np.float64), radius)
+    return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+
+def to_linear(db, nodata):
+    valid = np.isfinite(db) & (db != nodata)
+    return np.where(valid, 10. ** (db / 10.), 0.), valid
+
+
+def to_db(intensities, valid, nodata):
+    valid = valid & (intensities > 0)
+    return np.where(valid, 10. * np.log10(np.where(valid, intensities, 1.)), nodata).astype(np.float32)
+
+
+def get_grid_key(grid):
+    crs, transform, width, height = grid
+    return [crs.to_wkt(), list(transform)[:6], width, height]
+
+
+def get_vrt(path, grid_key, nodata):
+    key = (path, json.dumps(grid_key))
+    if key not in _datasets:
+        src = rasterio.open(path)
+        _datasets[key] = WarpedVRT(src, crs=CRS.from_wkt(grid_key[0]), transform=Affine(*grid_key[1]), width=grid_key[2],
+                                   height=grid_key[3], resampling=Resampling.nearest,
+                                   src_nodata=src.nodata if src.nodata is not None else nodata, nodata=nodata)
+    return _datasets[key]
+
+
+def read_block(paths, grid_key, window, radius, nodata):
+    """
+    reads window, grown by the radius of the filter, of the rasters of paths warped onto the grid
+
+    returns the linear intensities and their validity, (dates, bands, rows, cols), and the window without the halo within them
+    """
+    halo = Window(window.col_off - radius, window.row_off - radius, window.width + 2 * radius, window.height + 2 * radius)
+    halo = halo.intersection(Window(0, 0, grid_key[2], grid_key[3]))
+    db = np.stack([get_vrt(path, grid_key, nodata).read(window=halo, out_dtype='float64') for path in paths])
+    intensities, valid = to_linear(db, nodata)
+    inner = (slice(None), slice(None), slice(int(window.row_off - halo.row_off), int(window.row_off - halo.row_off + window.height)),
+             slice(int(window.col_off - halo.col_off), int(window.col_off - halo.col_off + window.width)))
+    return intensities, valid, inner
+
+
+def filter_block(task):
+    """
+    Quegan filter of all the dates of one block: J_k = <I_k> / N * sum_i I_i / <I_i>, over the N valid dates of each pixel
+
+    returns the window, the filtered dates in dB and the state of the block (sum of the ratios, number of dates)
+    """
+    paths, grid_key, window, radius, nodata = task
+    intensities, valid, inner = read_block(paths, grid_key, window, radius, nodata)
+    means = local_mean(intensities, valid, radius)[inner]
+    intensities, valid = intensities[inner], valid[inner]
+
+    used = valid & (means > 0)
+    ratio_sum = np.where(used, intensities / np.where(used, means, 1.), 0.).sum(axis=0)
+    count = used.sum(axis=0)
+    filtered = means * np.divide(ratio_sum, count, out=np.zeros_like(ratio_sum), where=count > 0)
+    return window, to_db(filtered, used, nodata), ratio_sum.astype(np.float32), count.astype(np.float32)
+
+
+def add_date_block(task):
+    """
+    adds one date to the state of a block, returns the window, the filtered date in dB and the updated state
+    """
+    path, state_path, grid_key, window, radius, nodata = task
+    intensities, valid, inner = read_block([path], grid_key, window, radius, nodata)
+    means = local_mean(intensities, valid, radius)[inner][0]
+    intensities, valid = intensities[inner][0], valid[inner][0]
+
+    bands = intensities.shape[0]
+    if state_path is not None:
+        with rasterio.open(state_path) as state:
+            block = state.read(window=window, out_dtype='float64')
+        ratio_sum, count = block[:bands], block[bands:]
+    else:
+        ratio_sum, count = np.zeros(intensities.shape), np.zeros(intensities.shape)
+
+    used = valid & (means > 0)
+    ratio_sum = ratio_sum + np.where(used, intensities / np.where(used, means, 1.), 0.)
+    count = count + used
+    filtered = means * np.divide(ratio_sum, count, out=np.zeros_like(ratio_sum), where=count > 0)
+    return window, to_db(filtered, used, nodata), ratio_sum.astype(np.float32), count.astype(np.float32)
+
+
+def imap_bounded(executor, func, tasks, max_in_flight):
+    """
+    executor.map(func, tasks) in order, with at most max_in_flight tasks submitted but not consumed,
+    so the results waiting to be written stay within the memory budget
+    """
+    futures = collections.deque()
+    for task in tasks:
+        futures.append(executor.submit(func, task))
+        if len(futures) >= max_in_flight:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+class QueganFilter(object):
+    """
+    Multi-temporal speckle filter (Quegan & Yu, 2001) of the S1 mosaics (in dB) of a time series.
+
+    Each date is filtered as J_k = <I_k> / N * sum_i I_i / <I_i> on a common grid, in linear intensity,
+    <.> being the mean over window_size x window_size pixels. The mosaics are read block by block
+    (grown by the window radius) through WarpedVRTs onto the grid, and the blocks are filtered in a pool of
+    worker processes, so the memory follows block size x number of dates, not the size of the AOI.
+
+    The sum of the ratios and the number of dates of every pixel are kept in a state raster (despeckle_state.tif),
+    so a new date is filtered from the state and its own mosaic only, without reading the former dates again.
+    The outputs of the former dates are not rewritten then, filter() refreshes them all.
+    """
+    def __init__(self, folder, grid, window_size=7, workers=4, memory_budget_mb=512, nodata=0):
+        self.state_path = os.path.join(folder, 'despeckle_state.tif')
+        self.state_json = os.path.join(folder, 'despeckle_state.json')
+        self.grid = grid
+        self.grid_key = get_grid_key(grid)
+        self.radius = window_size // 2
+        self.window_size = window_size
+        self.workers = workers
+        self.memory_budget_mb = memory_budget_mb
+        self.nodata = nodata
+
+    def get_state(self):
+        """
+        returns the description of the state (dates, window size, grid) if it is still valid for this filter, else None
+        """
+        if not (os.path.exists(self.state_json) and os.path.exists(self.state_path)):
+            return None
+        with open(self.state_json) as f:
+            state = json.load(f)
+        if state['window_size'] != self.window_size or state['grid'] != self.grid_key:
+            return None
+        if any(not os.path.exists(path) or fingerprint(path) != print_ for path, print_ in state['dates'].items()):
+            # a date was removed or processed again
+            return None
+        return state
+
+    def write_state(self, dates):
+        with atomic_output(self.state_json) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump({'window_size': self.window_size, 'grid': self.grid_key,
+                       'dates': {path: fingerprint(path) for path in dates}}, f, indent=2)
+
+    def get_meta(self, path):
+        """
+        returns the meta of the outputs on the grid (without count) and the band descriptions of the mosaic of path
+        """
+        with rasterio.open(path) as src:
+            descriptions = src.descriptions
+        crs, transform, width, height = self.grid
+        meta = {'driver': 'GTiff', 'dtype': 'float32', 'crs': crs, 'transform': transform, 'width': width,
+                'height': height, 'nodata': self.nodata, 'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'BIGTIFF': 'IF_SAFER'}
+        return meta, descriptions
+
+    def get_windows(self, bands, dates):
+        """
+        blocks of the grid holding the dates and the working arrays of one worker within the memory budget
+        """
+        return iter_block_windows(self.grid[2], self.grid[3], 4 * bands * dates, np.float64, self.memory_budget_mb / self.workers)
+
+    def run(self, func, tasks, writers):
+        """
+        writes the results of func over tasks: the filtered dates into writers[:-1], the state into writers[-1]
+        """
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for result in imap_bounded(executor, func, tasks, 2 * self.workers):
+                window, filtered, ratio_sum, count = result
+                if filtered.ndim == 3:
+                    filtered = filtered[np.newaxis]
+                for writer, date in zip(writers[:-1], filtered):
+                    writer.write(date, window=window)
+                writers[-1].write(np.concatenate([ratio_sum, count]), window=window)
+                Profiler.count_pixels(filtered.size)
+
+    def filter(self, paths, output_paths):
+        """
+        filters all the dates, writes output_paths and the state
+        """
+        with Profiler.stage('despeckle'):
+            meta, descriptions = self.get_meta(paths[0])
+            bands = len(descriptions)
+            logger.info('\tFiltering the speckle of {0} dates, {1}x{1} window'.format(len(paths), self.window_size))
+
+            with contextlib.ExitStack() as stack:
+                writers = [stack.enter_context(raster_output(path, dict(meta, count=bands))) for path in output_paths]
+                writers.append(stack.enter_context(raster_output(self.state_path, dict(meta, count=2 * bands), final=False)))
+                for writer in writers[:-1]:
+                    for index, description in enumerate(descriptions, 1):
+                        if description:
+                            writer.set_band_description(index, description)
+                tasks = ((paths, self.grid_key, window, self.radius, self.nodata) for window in self.get_windows(bands, len(paths)))
+                self.run(filter_block, tasks, writers)
+            self.write_state(paths)
+        return output_paths
+
+    def add_date(self, path, output_path):
+        """
+        filters one new date from the state (an empty state if none), writes output_path and updates the state
+        """
+        with Profiler.stage('despeckle'):
+            state = self.get_state()
+            dates = list(state['dates']) if state is not None else []
+            meta, descriptions = self.get_meta(path)
+            bands = len(descriptions)
+            logger.info('\tAdding {0} to the speckle filter of {1} dates'.format(os.path.basename(path), len(dates)))
+
+            state_path = self.state_path if state is not None else None
+            with contextlib.ExitStack() as stack:
+                writers = [stack.enter_context(raster_output(output_path, dict(meta, count=bands))),
+                           stack.enter_context(raster_output(self.state_path, dict(meta, count=2 * bands), final=False))]
+                for index, description in enumerate(descriptions, 1):
+                    if description:
+                        writers[0].set_band_description(index, description)
+                tasks = ((path, state_path, self.grid_key, window, self.radius, self.nodata) for window in self.get_windows(bands, 1))
+                self.run(add_date_block, tasks, writers)
+            self.write_state(dates + [path])
+        return output_path
+
+    def update(self, paths, output_paths):
+        """
+        adds the new dates of paths to the state when it holds the other ones, else filters them all
+
+        returns the paths of the outputs written
+        """
+        state = self.get_state()
+        if state is None or not state['dates'] or not set(state['dates']) <= set(paths):
+            return self.filter(paths, output_paths)
+
+        written = []
+        for path, output_path in zip(paths, output_paths):
+            if path not in state['dates']:
+                written.append(self.add_date(path, output_path))
+        return written
@@ -0,0 +1,237 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.Profiler import profiled
+
+logger = logging.getLogger('DownloaderLogger')
+logging.basicConfig(level=logging.INFO)
+
+
+class ChecksumError(Exception):
+    pass
+
+
+class ProductOfflineError(Exception):
+    pass
+
+
+def md5_of_file(path, chunk_size=2**20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    hardlinks src to dst, falls back to a copy across file systems
+    """
+    if os.path.exists(dst):
+        return dst
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+    return dst
+
+
+class Downloader(object):
+    """
+    Downloads products through a bounded pool of workers.
+
+    api only needs to provide what SentinelAPI provides for a download:
+    get_product_odata(uuid) -> dict with 'title', 'size', 'md5', 'url' (and optionally 'Online')
+    and a requests-like session whose get(url, stream=True, headers=...) returns a response
+    with status_code, raise_for_status() and iter_content(chunk_size).
+    A local stand-in can therefore replace the hub.
+
+    Partial files are kept as <title>.zip.incomplete and resumed with a Range request,
+    complete files are verified against the md5 of the hub and only renamed once valid.
+    """
+    def __init__(self, api, workers=4, max_attempts=5, backoff=2., checksum=True, chunk_size=2**20, manifest=None, store=None):
+        self.api = api
+        # ProductStore: products are downloaded once into the shared store and linked into the directories
+        self.store = store
+        # RunManifest: products recorded as downloaded (and unchanged since) are not checked against the hub again
+        self.manifest = manifest
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.checksum = checksum
+        self.chunk_size = chunk_size
+
+    def fetch(self, uuid, directory):
+        """
+        downloads one product into directory
+
+        returns: (path to the zip, number of bytes transferred)
+        """
+        odata = self.api.get_product_odata(uuid)
+        path = os.path.join(directory, odata['title'] + '.zip')
+
+        if os.path.exists(path):
+            if not self.checksum or md5_of_file(path, self.chunk_size) == odata['md5'].lower():
+                return path, 0
+            os.remove(path)
+
+        if not odata.get('Online', True):
+            trigger = getattr(self.api, 'trigger_offline_retrieval', None)
+            if trigger is not None:
+                trigger(uuid)
+            raise ProductOfflineError('{0} is in the long term archive'.format(odata['title']))
+
+        partial = path + '.incomplete'
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if offset > odata['size']:
+            os.remove(partial)
+            offset = 0
+
+        transferred = 0
+        if offset < odata['size']:
+            headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+            response = self.api.session.get(odata['url'], stream=True, headers=headers)
+            if response.status_code == 416:
+                # nothing left to send
+                response.close()
+            else:
+                response.raise_for_status()
+                # the server ignored the range request, start over
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                with open(partial, mode) as f:
+                    for block in response.iter_content(chunk_size=self.chunk_size):
+                        if block:
+                            f.write(block)
+                            transferred += len(block)
+                response.close()
+
+        if self.checksum and md5_of_file(partial, self.chunk_size) != odata['md5'].lower():
+            os.remove(partial)
+            raise ChecksumError('checksum mismatch for {0}'.format(odata['title']))
+
+        os.replace(partial, path)
+        return path, transferred
+
+    def fetch_with_retries(self, uuid, directory):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return self.fetch(uuid, directory)
+            except Exception as exc:
+                if attempt == self.max_attempts:
+                    raise
+                wait = self.backoff ** attempt
+                logger.info('\tattempt {0}/{1} for {2} failed ({3}), retrying in {4:.0f}s'.format(attempt, self.max_attempts, uuid, exc, wait))
+                time.sleep(wait)
+
+    def fetch_into_store(self, uuid):
+        """
+        returns (path in the store, number of bytes transferred), the product is downloaded only if
+        the store has no copy of it. A product does not change on the hub once published and the stored copy
+        was checked when it was downloaded, so the hub is only asked on a miss
+        """
+        with self.store.lock(uuid):
+            path = self.store.get_product(uuid)
+            if path is not None:
+                return path, 0
+            md5 = self.api.get_product_odata(uuid)['md5'] if self.api is not None else None
+            path, transferred = self.fetch_with_retries(uuid, self.store.get_product_folder(uuid))
+            self.store.put_product(uuid, path, md5)
+        return path, transferred
+
+    def _fetch_and_link(self, uuid, directories, local_path=None):
+        if local_path is not None and os.path.exists(local_path):
+            # already in a local archive
+            path, transferred = local_path, 0
+        elif self.manifest is not None and self.manifest.is_done('', uuid, 'download'):
+            path, transferred = self.manifest.get('', uuid, 'download')['outputs'], 0
+        else:
+            started = time.time()
+            if self.store is not None:
+                path, transferred = self.fetch_into_store(uuid)
+            else:
+                path, transferred = self.fetch_with_retries(uuid, directories[0])
+            if self.manifest is not None:
+                self.manifest.set('', uuid, 'download', 'done', outputs=path, started=started)
+
+        link = self.store.link if self.store is not None else link_or_copy
+        for directory in directories:
+            link(path, os.path.join(directory, os.path.basename(path)))
+        return path, transferred
+
+    def submit(self, jobs, executor):
+        """
+        submits the downloads of jobs (see download) to executor, a product listed for several directories
+        is downloaded once and linked into the other ones
+
+        returns: OrderedDict uuid -> future of (path, number of bytes transferred)
+        """
+        targets = OrderedDict()
+        local_paths = {}
+        for job in jobs:
+            uuid, directory = job[:2]
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            if directory not in targets.setdefault(uuid, []):
+                targets[uuid].append(directory)
+            if len(job) > 2 and job[2]:
+                local_paths[uuid] = job[2]
+
+        return OrderedDict((uuid, executor.submit(self._fetch_and_link, uuid, directories, local_paths.get(uuid)))
+                           for uuid, directories in targets.items())
+
+    def wait(self, futures):
+        """
+        futures: dict uuid -> future, as returned by submit
+
+        returns: dict summary of the transfers, once they are all done
+        """
+        summary = {'products': len(futures), 'downloaded': 0, 'skipped': 0, 'failed': [], 'paths': {}, 'bytes': 0}
+        start = time.time()
+        uuids = {future: uuid for uuid, future in futures.items()}
+        for future in as_completed(uuids):
+            uuid = uuids[future]
+            try:
+                path, transferred = future.result()
+            except Exception as exc:
+                logger.info('\tdownload of {0} failed: {1}'.format(uuid, exc))
+                summary['failed'].append(uuid)
+                continue
+
+            summary['paths'][uuid] = path
+            summary['bytes'] += transferred
+            if transferred:
+                summary['downloaded'] += 1
+            else:
+                summary['skipped'] += 1
+            logger.info('\t{0} ready ({1}/{2})'.format(os.path.basename(path), len(summary['paths']), len(futures)))
+
+        summary['seconds'] = time.time() - start
+        summary['throughput_MBps'] = summary['bytes'] / 2.**20 / max(summary['seconds'], 1e-6)
+        logger.info('\tdownloaded {0:.1f} MB in {1:.0f}s ({2:.2f} MB/s), {3} skipped, {4} failed'.format(
+            summary['bytes'] / 2.**20, summary['seconds'], summary['throughput_MBps'], summary['skipped'], len(summary['failed'])))
+        return summary
+
+    @profiled()
+    def download(self, jobs, executor=None):
+        """
+        jobs: iterable of (uuid, directory) or (uuid, directory, local zip or None),
+              products with a local zip are linked from it instead of being downloaded
+        executor: an executor shared with other downloads (e.g. of other intervals) instead of a pool of self.workers
+
+        A product listed for several directories (e.g. a scene on the inclusive bound of two
+        adjacent intervals) is downloaded once and linked into the other directories.
+
+        returns: dict summary of the transfers
+        """
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            return self.wait(self.submit(jobs, executor))
+        finally:
+            if own_executor:
+                executor.shutdown()
@@ -0,0 +1,166 @@
+import os
+import time
+import logging
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.env import GDALVersion
+from rasterio.enums import Resampling
+
+logger = logging.getLogger('OutputProfileLogger')
+logging.basicConfig(level=logging.INFO)
+
+# the profile of the run, None to write the GeoTIFFs as the writers describe them
+_profile = None
+
+LEVEL_OPTIONS = {'deflate': 'ZLEVEL', 'zstd': 'ZSTD_LEVEL'}
+
+
+class OutputProfile(object):
+    """
+    Layout and compression of the GeoTIFFs written by the pipeline.
+
+    Every output is tiled and compressed, with the horizontal predictor for integers and
+    the floating point predictor for floats. Compression runs on threads CPUs (NUM_THREADS).
+    Final outputs (mosaics, co-registered mosaics) also get internal overviews, or are laid out as
+    Cloud-Optimized GeoTIFFs when cog is set and GDAL has the COG driver (>= 3.1), so they can be read
+    by windows and at reduced resolution straight from an object store. Intermediates (clipped bands)
+    are only tiled and compressed.
+    """
+    def __init__(self, compress='deflate', level=6, blocksize=512, overviews=True, overview_resampling='average',
+                 cog=True, threads='ALL_CPUS', nodata=0):
+        self.compress = compress
+        self.level = level
+        self.blocksize = blocksize
+        self.overviews = overviews
+        self.overview_resampling = overview_resampling
+        self.cog = cog and GDALVersion.runtime().at_least('3.1')
+        self.threads = str(threads)
+        # nodata of the outputs that have none
+        self.nodata = nodata
+
+    def is_compressed(self):
+        return bool(self.compress) and self.compress != 'none'
+
+    @staticmethod
+    def get_predictor(dtype):
+        return 3 if np.dtype(dtype).kind == 'f' else 2
+
+    def get_compression_options(self, dtype):
+        if not self.is_compressed():
+            return {}
+        options = {'compress': self.compress, 'predictor': self.get_predictor(dtype), 'NUM_THREADS': self.threads}
+        if self.compress in LEVEL_OPTIONS and self.level is not None:
+            options[LEVEL_OPTIONS[self.compress]] = self.level
+        return options
+
+    def get_creation_options(self, dtype):
+        return dict(self.get_compression_options(dtype), tiled=True, blockxsize=self.blocksize, blockysize=self.blocksize,
+                    BIGTIFF='IF_SAFER')
+
+    def get_overview_factors(self, width, height):
+        factors = []
+        factor = 2
+        while max(width, height) / factor >= self.blocksize / 2.:
+            factors.append(factor)
+            factor *= 2
+        return factors
+
+    def get_cog_options(self, dtype):
+        options = {'BLOCKSIZE': self.blocksize, 'BIGTIFF': 'IF_SAFER', 'NUM_THREADS': self.threads,
+                   'OVERVIEWS': 'AUTO' if self.overviews else 'NONE', 'OVERVIEW_RESAMPLING': self.overview_resampling.upper()}
+        if self.is_compressed():
+            options.update({'COMPRESS': self.compress.upper(),
+                            'PREDICTOR': 'FLOATING_POINT' if self.get_predictor(dtype) == 3 else 'STANDARD'})
+            if self.compress in LEVEL_OPTIONS and self.level is not None:
+                options['LEVEL'] = self.level
+        return options
+
+    def finalize(self, path):
+        """
+        builds the overviews of a final output written to path, rewritten as a COG if cog
+        """
+        dtype = self.get_dtype(path)
+        env = {'GDAL_NUM_THREADS': self.threads}
+        if self.is_compressed():
+            env.update({'COMPRESS_OVERVIEW': self.compress.upper(), 'PREDICTOR_OVERVIEW': self.get_predictor(dtype)})
+        with rasterio.Env(**env):
+            if self.cog:
+                cog_path = path + '.cog.tif'
+                options = self.get_cog_options(dtype)
+                try:
+                    rasterio.shutil.copy(path, cog_path, driver='COG', **options)
+                    os.replace(cog_path, path)
+                finally:
+                    if os.path.exists(cog_path):
+                        os.remove(cog_path)
+            elif self.overviews:
+                with rasterio.open(path, 'r+') as dst:
+                    factors = self.get_overview_factors(dst.width, dst.height)
+                    if factors:
+                        dst.build_overviews(factors, Resampling[self.overview_resampling])
+                        dst.update_tags(ns='rio_overview', resampling=self.overview_resampling)
+
+    @staticmethod
+    def get_dtype(path):
+        with rasterio.open(path) as src:
+            return src.dtypes[0]
+
+
+def configure(**kwargs):
+    """
+    writes the outputs of the pipeline with OutputProfile(**kwargs), returns the profile
+    """
+    global _profile
+    _profile = OutputProfile(**kwargs)
+    logger.info('\toutputs written as {0} {1}GeoTIFFs'.format(_profile.compress, 'Cloud-Optimized ' if _profile.cog else ''))
+    return _profile
+
+
+def disable():
+    global _profile
+    profile, _profile = _profile, None
+    return profile
+
+
+def get_profile():
+    return _profile
+
+
+def get_creation_options(dtype):
+    """
+    creation options overriding the ones of the writers, none while no profile is configured
+    """
+    if _profile is None:
+        return {}
+    return _profile.get_creation_options(dtype)
+
+
+def get_nodata(nodata):
+    if nodata is None and _profile is not None:
+        return _profile.nodata
+    return nodata
+
+
+def finalize(path, final=True, seconds=None, name=None):
+    """
+    overviews and COG layout of a final output, then logs its size, compression ratio and write throughput
+    (seconds: time spent writing it before, name: name to log, default the file name)
+
+    returns the report (path, bytes, raw_bytes, ratio, seconds, mb_per_second) or None while no profile is configured
+    """
+    if _profile is None:
+        return None
+    start = time.perf_counter()
+    if final:
+        _profile.finalize(path)
+    seconds = (seconds or 0.) + time.perf_counter() - start
+
+    with rasterio.open(path) as src:
+        raw_bytes = src.width * src.height * src.count * np.dtype(src.dtypes[0]).itemsize
+    size = os.path.getsize(path)
+    report = {'path': path, 'bytes': size, 'raw_bytes': raw_bytes, 'ratio': raw_bytes / float(size) if size else None,
+              'seconds': seconds, 'mb_per_second': raw_bytes / 2.**20 / seconds if seconds else None}
+    logger.info('\t{0}: {1:.1f} MB, {2:.1f}x compressed, written at {3:.1f} MB/s'.format(
+        name or os.path.basename(path), size / 2.**20, report['ratio'] or 0., report['mb_per_second'] or 0.))
+    return report
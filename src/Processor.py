@@ -1,24 +1,79 @@
 import os
+import copy
 import shutil
-from src.utils import merge_rasters
+from src.utils import merge_rasters, mosaic_to_file, atomic_output
+from src.Tiling import get_tile_folder
+from src import Profiler, OutputProfile
 import numpy as np
+import rasterio
 
 class Processor(object):
-    def __init__(self, zips_path, footprint):
+    def __init__(self, zips_path, footprint, mosaic_memory_mb=512, manifest=None, store=None, zip_files=None):
         self.zips_path = zips_path
+        # zips of the products selected for the interval, None: all the zips of zips_path
+        self.zip_files = zip_files
         self.footprint = footprint
+        # memory budget of the block-wise mosaicking
+        self.mosaic_memory_mb = mosaic_memory_mb
+        # RunManifest recording the stages, done stages are skipped
+        self.manifest = manifest
+        # ProductStore caching the clipped bands across runs
+        self.store = store
+        self.interval = os.path.basename(os.path.dirname(self.zips_path))
+        # folder of the mosaics, the interval folder
+        self.output_folder = os.path.join(self.zips_path, '..')
+        # folder of the intermediate files (clips, S1 scenes), None: next to the products
+        self.work_folder = None
         self.paths_to_merge = []
         self.dtype = None
         self.suffix = ''
 
+    def run_stage(self, product, stage, func, inputs=()):
+        """
+        runs func() (returning the outputs of the stage) through the run manifest, if any
+        """
+        with Profiler.stage(stage, self.interval):
+            if self.manifest is None:
+                return func()
+            return self.manifest.run(self.interval, product, stage, func, inputs)
+
+    def copy(self, path, output_path):
+        """
+        mosaic of a single product, rewritten block by block with the output profile if there is one
+        """
+        if OutputProfile.get_profile() is not None:
+            with rasterio.open(path) as src:
+                return mosaic_to_file([src], output_path, src.dtypes[0], self.mosaic_memory_mb)
+        with atomic_output(output_path) as tmp_path:
+            shutil.copy(path, tmp_path)
+        return output_path
+
+    def for_tile(self, tile_id, footprint):
+        """
+        returns a copy of the prepared processor (products extracted once for all tiles) processing the part
+        footprint of the AOI, with its intermediates and mosaics in <interval>/tiles/<tile_id>
+        """
+        tile = copy.copy(self)
+        tile.footprint = footprint
+        tile.output_folder = tile.work_folder = get_tile_folder(self.output_folder, tile_id)
+        tile.interval = '{0}/tiles/{1}'.format(self.interval, tile_id)
+        tile.paths_to_merge = []
+        os.makedirs(tile.output_folder, exist_ok=True)
+        return tile
+
     def merge(self):
-        output_folder = os.path.join(self.zips_path, '..')
+        inputs = [path for paths in self.paths_to_merge for path in ([paths] if self.suffix == 'S1' else paths.values())]
+        return self.run_stage(self.suffix, 'merge', self.merge_all, inputs)
+
+    def merge_all(self):
+        output_folder = self.output_folder
         file_string = os.path.basename(os.path.dirname(self.zips_path)) + self.suffix
+        outputs = []
         if self.suffix == 'S1':        
             if len(self.paths_to_merge)>1:
-                merge_rasters(self.paths_to_merge, output_folder, file_string, self.dtype)
+                outputs.append(merge_rasters(self.paths_to_merge, output_folder, file_string, self.dtype, self.mosaic_memory_mb))
             elif len(self.paths_to_merge) == 1:
-                shutil.copy(self.paths_to_merge[0], output_folder + '/{0}.tif'.format(file_string))
+                outputs.append(self.copy(self.paths_to_merge[0], output_folder + '/{0}.tif'.format(file_string)))
         
         elif self.suffix == 'S2':
             group_lambda = lambda x, key: [dic[key] for dic in x]
@@ -26,9 +81,10 @@ class Processor(object):
                 for key in self.paths_to_merge[0].keys():
                     list_bands_to_merge = group_lambda(self.paths_to_merge, key)
                     file_string2 = '{0}_'.format(key) + file_string
-                    merge_rasters(list_bands_to_merge, output_folder, file_string2, self.dtype)
+                    outputs.append(merge_rasters(list_bands_to_merge, output_folder, file_string2, self.dtype, self.mosaic_memory_mb))
 
             elif len(self.paths_to_merge) == 1:
                 for key in self.paths_to_merge[0].keys():
                     file_string2 = '{0}_'.format(key) + file_string
-                    shutil.copy(self.paths_to_merge[0][key], output_folder + '/{0}.tif'.format(file_string2))
+                    outputs.append(self.copy(self.paths_to_merge[0][key], output_folder + '/{0}.tif'.format(file_string2)))
+        return outputs
@@ -0,0 +1,173 @@
+import os
+import time
+import fcntl
+import shutil
+import sqlite3
+import threading
+import hashlib
+import logging
+import contextlib
+
+logger = logging.getLogger('ProductStoreLogger')
+logging.basicConfig(level=logging.INFO)
+
+
+class ProductStore(object):
+    """
+    Store of products and clipped bands shared by all runs, interval folders only get links to it.
+
+    Products are kept under products/<uuid>/<title>.zip with their md5, so a product republished
+    under the same uuid with another checksum is fetched again. Clipped bands are kept under
+    clips/<key>.tif, keyed by product, band, AOI and resolution (see get_clip_key).
+
+    Entries are hardlinked into the interval folders (symlinked across file systems, or always with link='symlink').
+    Concurrent runs coordinate through flock()ed lock files, one per entry, and an SQLite index in WAL mode.
+    The least recently used entries are evicted once the store grows over max_size_gb; an evicted product
+    still linked from an interval folder only frees its space once the links are gone.
+    """
+    def __init__(self, folder, max_size_gb=500, link='hard'):
+        self.folder = folder
+        self.max_size = max_size_gb * 2**30
+        self.link_mode = link
+        for sub_folder in ('products', 'clips', 'locks'):
+            os.makedirs(os.path.join(folder, sub_folder), exist_ok=True)
+
+        self.db_lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(folder, 'store.sqlite'), timeout=60, check_same_thread=False, isolation_level=None)
+        self.execute('PRAGMA journal_mode=WAL')
+        self.execute('''CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, kind TEXT, path TEXT, md5 TEXT, bytes INTEGER, last_access REAL)''')
+
+    def execute(self, sql, parameters=()):
+        with self.db_lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        """
+        exclusive lock on an entry across threads and processes, yields False if not blocking and already locked
+        """
+        with open(os.path.join(self.folder, 'locks', key + '.lock'), 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def link(self, src, dst):
+        """
+        links the stored src to dst, returns dst
+        """
+        if os.path.lexists(dst):
+            if os.path.exists(dst):
+                return dst
+            # dangling symlink to an evicted entry
+            os.remove(dst)
+        if self.link_mode == 'hard':
+            try:
+                os.link(src, dst)
+                return dst
+            except OSError:
+                pass
+        os.symlink(os.path.abspath(src), dst)
+        return dst
+
+    def get(self, key, md5=None):
+        """
+        returns the path of a stored entry (with the given md5, if any) or None
+        """
+        rows = self.execute('SELECT path, md5 FROM entries WHERE key=?', (key,))
+        row = rows[0] if rows else None
+        if row is None or not os.path.exists(row[0]) or (md5 is not None and row[1] != md5.lower()):
+            return None
+        self.execute('UPDATE entries SET last_access=? WHERE key=?', (time.time(), key))
+        return row[0]
+
+    def put(self, key, kind, path, md5=None):
+        """
+        records a file already moved or linked into the store, then evicts over the budget
+        """
+        self.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                     (key, kind, path, md5.lower() if md5 else None, os.path.getsize(path), time.time()))
+        self.evict()
+        return path
+
+    def get_product_folder(self, uuid):
+        folder = os.path.join(self.folder, 'products', uuid)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def get_product(self, uuid, md5=None):
+        return self.get(uuid, md5)
+
+    def put_product(self, uuid, path, md5=None):
+        """
+        path: zip downloaded into get_product_folder(uuid)
+        """
+        return self.put(uuid, 'product', path, md5)
+
+    @staticmethod
+    def get_clip_key(*parts):
+        """
+        key of a clipped band from what determines it, e.g. product title, band file, footprint, overview level
+        """
+        return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def get_clip(self, key, output_path):
+        """
+        links the stored clip to output_path, returns output_path or None if not stored
+        """
+        with self.lock(key):
+            path = self.get(key)
+            if path is None:
+                return None
+            if os.path.lexists(output_path):
+                os.remove(output_path)
+            return self.link(path, output_path)
+
+    def put_clip(self, key, output_path):
+        """
+        stores a copy of a clip written to output_path, linked when on the same file system
+        """
+        path = os.path.join(self.folder, 'clips', key + '.tif')
+        with self.lock(key):
+            tmp_path = path + '.tmp'
+            try:
+                os.link(output_path, tmp_path)
+            except OSError:
+                shutil.copy(output_path, tmp_path)
+            os.replace(tmp_path, path)
+            self.put(key, 'clip', path)
+        return output_path
+
+    def get_size(self):
+        return self.execute('SELECT COALESCE(SUM(bytes), 0) FROM entries')[0][0]
+
+    def evict(self):
+        """
+        removes the least recently used entries not in use (locked) until the store fits in max_size_gb
+        """
+        total = self.get_size()
+        if total <= self.max_size:
+            return
+        rows = self.execute('SELECT key, kind, path, bytes FROM entries ORDER BY last_access')
+        for key, kind, path, size in rows:
+            if total <= self.max_size:
+                break
+            with self.lock(key, blocking=False) as locked:
+                if not locked:
+                    continue
+                if os.path.exists(path):
+                    os.remove(path)
+                if kind == 'product':
+                    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                self.execute('DELETE FROM entries WHERE key=?', (key,))
+                total -= size
+                logger.info('\tevicted {0} from the product store'.format(os.path.basename(path)))
+
+    def close(self):
+        self.connection.close()
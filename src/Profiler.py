@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import logging
+import resource
+import functools
+import threading
+import contextlib
+
+logger = logging.getLogger('ProfilerLogger')
+logging.basicConfig(level=logging.INFO)
+
+# the profiler of the run, None while profiling is disabled
+_profiler = None
+_disabled_stage = contextlib.nullcontext()
+
+
+def read_io():
+    """
+    returns (bytes read, bytes written) by the process so far, files and sockets, or (None, None) if unavailable
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class Profiler(object):
+    """
+    Records the stages of a run: wall time, CPU time, peak RSS, bytes read and written, pixels.
+
+    Stages nest and inherit the interval of the enclosing stage of their thread.
+    CPU time is the one of the thread running the stage plus the one of the child processes
+    (gpt) that ended during it. Peak RSS is the high-water mark of the process (and of its children)
+    at the end of the stage, bytes read and written are counted for the whole process, so they
+    include the work of concurrent stages.
+    """
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def get_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name, interval=None):
+        stack = self.get_stack()
+        if interval is None:
+            interval = stack[-1]['interval'] if stack else ''
+        event = {'name': name, 'interval': interval, 'pixels': 0, 'thread': threading.get_ident()}
+        stack.append(event)
+
+        read_start, written_start = read_io()
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_start = time.thread_time()
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException as exc:
+            event['error'] = repr(exc)
+            raise
+        finally:
+            end = time.perf_counter()
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            read_end, written_end = read_io()
+            stack.pop()
+
+            event['start'] = start - self.origin
+            event['wall_seconds'] = end - start
+            event['cpu_seconds'] = time.thread_time() - cpu_start + \
+                (children.ru_utime + children.ru_stime) - (children_start.ru_utime + children_start.ru_stime)
+            # ru_maxrss is in kilobytes on Linux
+            event['peak_rss_mb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children.ru_maxrss) / 1024.
+            event['bytes_read'] = read_end - read_start if read_start is not None else None
+            event['bytes_written'] = written_end - written_start if written_start is not None else None
+            with self.lock:
+                self.events.append(event)
+
+    def count_pixels(self, pixels):
+        """
+        adds pixels to the innermost stage of the calling thread
+        """
+        stack = self.get_stack()
+        if stack:
+            stack[-1]['pixels'] += int(pixels)
+
+    def get_intervals(self):
+        with self.lock:
+            return sorted(set(event['interval'] for event in self.events))
+
+    def get_summary(self, interval=''):
+        """
+        returns dict stage -> totals of the stages of interval ('' for the stages outside any interval)
+        """
+        summary = {}
+        with self.lock:
+            events = [event for event in self.events if event['interval'] == interval]
+        for event in events:
+            totals = summary.setdefault(event['name'], {'count': 0, 'errors': 0, 'wall_seconds': 0., 'cpu_seconds': 0.,
+                                                        'peak_rss_mb': 0., 'bytes_read': 0, 'bytes_written': 0, 'pixels': 0})
+            totals['count'] += 1
+            totals['errors'] += 'error' in event
+            for key in ('wall_seconds', 'cpu_seconds', 'pixels'):
+                totals[key] += event[key]
+            for key in ('bytes_read', 'bytes_written'):
+                totals[key] += event[key] or 0
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], event['peak_rss_mb'])
+
+        for totals in summary.values():
+            totals['mpixels_per_second'] = totals['pixels'] / 1e6 / totals['wall_seconds'] if totals['wall_seconds'] else None
+        return summary
+
+    def get_trace(self):
+        """
+        returns the stages as a Chrome trace (chrome://tracing, Perfetto), one row per thread
+        """
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        return {'traceEvents': [{
+            'name': event['name'], 'cat': event['interval'] or 'run', 'ph': 'X', 'pid': pid, 'tid': event['thread'],
+            'ts': event['start'] * 1e6, 'dur': event['wall_seconds'] * 1e6,
+            'args': {key: value for key, value in event.items() if key not in ('name', 'thread', 'start', 'wall_seconds')},
+        } for event in events], 'displayTimeUnit': 'ms'}
+
+    def write(self, output_folder, trace=True):
+        """
+        writes profile.json for each interval into the folder of the interval (if it exists),
+        the stages outside any interval into output_folder/profile.json and the trace into output_folder/trace.json
+
+        returns the list of written paths
+        """
+        paths = []
+        for interval in self.get_intervals():
+            folder = os.path.join(output_folder, interval)
+            path = os.path.join(folder, 'profile.json') if interval and os.path.isdir(folder) else \
+                os.path.join(output_folder, 'profile{0}.json'.format('_' + interval if interval else ''))
+            with open(path, 'w') as f:
+                json.dump({'interval': interval, 'stages': self.get_summary(interval)}, f, indent=2)
+            paths.append(path)
+
+        if trace:
+            path = os.path.join(output_folder, 'trace.json')
+            with open(path, 'w') as f:
+                json.dump(self.get_trace(), f)
+            paths.append(path)
+        logger.info('\tprofile written to {0}'.format(', '.join(paths)))
+        return paths
+
+
+def enable():
+    """
+    starts profiling the stages of the pipeline, returns the Profiler
+    """
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    """
+    stops profiling, returns the Profiler with the stages recorded so far (or None)
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+def stage(name, interval=None):
+    """
+    context manager timing a stage, does nothing while profiling is disabled
+
+        with Profiler.stage('query'):
+            ...
+    """
+    if _profiler is None:
+        return _disabled_stage
+    return _profiler.stage(name, interval)
+
+
+def profiled(name=None):
+    """
+    decorator timing each call of the function as a stage (named after the function by default)
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.stage(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_pixels(pixels):
+    """
+    adds pixels to the current stage of the calling thread, does nothing while profiling is disabled
+    """
+    if _profiler is not None:
+        _profiler.count_pixels(pixels)
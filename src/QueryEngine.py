@@ -0,0 +1,87 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+import shapely
+import shapely.wkt
+from src.TemporalIndex import make_intervals
+
+logger = logging.getLogger('QueryEngineLogger')
+logging.basicConfig(level=logging.INFO)
+
+
+def simplify_query_footprint(footprint, max_vertices=200):
+    """
+    footprint sent to the hub: the AOI itself if small enough, else its convex hull (or bounding box).
+    The hub returns a superset of the products, the coverage is still computed on the exact AOI.
+    """
+    aoi = shapely.wkt.loads(footprint)
+    if shapely.get_num_coordinates(aoi) <= max_vertices:
+        return footprint
+    hull = aoi.convex_hull
+    if shapely.get_num_coordinates(hull) <= max_vertices:
+        return hull.wkt
+    return aoi.envelope.wkt
+
+
+def split_date_range(date_interval, days):
+    """
+    (start, end) as datetimes or 'YYYYMMDD' strings -> list of consecutive (start, end) datetimes of at most days
+    """
+    start, end = (pd.Timestamp(date).to_pydatetime() for date in date_interval)
+    if not days:
+        return [(start, end)]
+    return make_intervals(start, end, days)
+
+
+class QueryEngine(object):
+    """
+    Queries the hub concurrently: the queries (e.g. S2 and S1) and, for each, the sub-ranges of days_per_query days
+    of its date range run in a pool of workers, on the simplified AOI (see simplify_query_footprint).
+
+    The products of the sub-queries are merged by uuid as they complete, so the products on the bound
+    of two sub-ranges are only kept once, and sorted by sensing time so the result doesn't depend on
+    the order the sub-queries complete in.
+
+    api only needs query(**kwargs) -> dict uuid -> properties and to_dataframe(products), as SentinelAPI,
+    so a local stand-in can replace the hub.
+    """
+    def __init__(self, api, workers=4, days_per_query=90, max_vertices=200):
+        self.api = api
+        self.workers = workers
+        self.days_per_query = days_per_query
+        self.max_vertices = max_vertices
+
+    def get_sub_queries(self, kwargs):
+        sub_kwargs = dict(kwargs)
+        if sub_kwargs.get('area'):
+            sub_kwargs['area'] = simplify_query_footprint(sub_kwargs['area'], self.max_vertices)
+        if not sub_kwargs.get('date'):
+            return [sub_kwargs]
+        return [dict(sub_kwargs, date=date_range) for date_range in split_date_range(sub_kwargs['date'], self.days_per_query)]
+
+    def query(self, kwargs_list):
+        """
+        kwargs_list: list of the kwargs of api.query, one per query
+
+        returns the list of the catalog DataFrames of the queries, in order
+        """
+        results = [OrderedDict() for _ in kwargs_list]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for i, kwargs in enumerate(kwargs_list):
+                for sub_kwargs in self.get_sub_queries(kwargs):
+                    futures[executor.submit(self.api.query, **sub_kwargs)] = i
+
+            for future in as_completed(futures):
+                products = future.result()
+                for uuid, properties in products.items():
+                    results[futures[future]].setdefault(uuid, properties)
+
+        catalogs = []
+        for kwargs, products in zip(kwargs_list, results):
+            ordered = OrderedDict(sorted(products.items(), key=lambda item: (str(item[1].get('beginposition', '')), item[0])))
+            logger.info('\t{0} {1} products found by {2} sub-queries'.format(
+                len(ordered), kwargs.get('platformname', ''), len(self.get_sub_queries(kwargs))))
+            catalogs.append(self.api.to_dataframe(ordered))
+        return catalogs
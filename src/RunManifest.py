@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger('RunManifestLogger')
+logging.basicConfig(level=logging.INFO)
+
+STAGES = ('query', 'select', 'download', 'extract', 's1_graph', 's2_clip', 'merge', 'post_process')
+
+
+def fingerprint(path):
+    """
+    cheap checksum of an output: size and modification time (of the manifest.safe for a SAFE folder,
+    of the zip for a /vsizip/ path)
+    """
+    if path.startswith('/vsizip/') and '.zip' in path:
+        path = path[len('/vsizip/'):].split('.zip')[0] + '.zip'
+    if os.path.isdir(path):
+        path = os.path.join(path, 'manifest.safe')
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return '{0}:{1}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def as_list(outputs):
+    """
+    flattens the outputs of a stage (a path, a list of paths or a list of dicts of paths) into a list of paths
+    """
+    if outputs is None:
+        return []
+    if isinstance(outputs, str):
+        return [outputs]
+    if isinstance(outputs, dict):
+        return [path for value in outputs.values() for path in as_list(value)]
+    return [path for value in outputs for path in as_list(value)]
+
+
+class RunManifest(object):
+    """
+    SQLite record of every stage of a run, per interval and product: status, inputs, outputs,
+    fingerprints of the inputs and outputs and timings.
+
+    run() skips a stage whose outputs are all still there and unchanged since it succeeded, and whose inputs are
+    the same files, unchanged, so a restarted run only redoes what was interrupted or what depends on a changed
+    input (e.g. the mosaics of an interval after a new selection of its scenes). Safe to share between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS stages (
+            interval TEXT, product TEXT, stage TEXT, status TEXT,
+            inputs TEXT, outputs TEXT, checksums TEXT, result TEXT,
+            started REAL, finished REAL, error TEXT, input_checksums TEXT,
+            PRIMARY KEY (interval, product, stage))''')
+        if 'input_checksums' not in [row[1] for row in self.connection.execute('PRAGMA table_info(stages)')]:
+            # manifest of an earlier version, its stages are checked on their outputs only
+            self.connection.execute('ALTER TABLE stages ADD COLUMN input_checksums TEXT')
+
+    def get(self, interval, product, stage):
+        with self.lock:
+            row = self.connection.execute('SELECT status, outputs, checksums, result, inputs, input_checksums FROM stages '
+                                          'WHERE interval=? AND product=? AND stage=?', (interval, product, stage)).fetchone()
+        if row is None:
+            return None
+        return {'status': row[0], 'outputs': json.loads(row[1]) if row[1] else [], 'checksums': json.loads(row[2] or '[]'),
+                'result': json.loads(row[3]) if row[3] else None, 'inputs': json.loads(row[4] or '[]'),
+                'input_checksums': json.loads(row[5]) if row[5] else None}
+
+    def is_done(self, interval, product, stage, inputs=None):
+        """
+        inputs: the inputs of the stage now, if given the stage is only done if it ran on the same inputs, unchanged since
+        """
+        record = self.get(interval, product, stage)
+        if record is None or record['status'] != 'done':
+            return False
+        if inputs is not None and record['input_checksums'] is not None:
+            if record['inputs'] != list(inputs) or record['input_checksums'] != [fingerprint(path) for path in as_list(list(inputs))]:
+                return False
+        return all(checksum is not None and fingerprint(path) == checksum
+                   for path, checksum in zip(as_list(record['outputs']), record['checksums']))
+
+    def set(self, interval, product, stage, status, inputs=(), outputs=None, result=None, started=None, error=None):
+        """
+        inputs: list of paths, stored as given and fingerprinted
+        outputs: path or list of paths, stored as given and fingerprinted
+        result: any json serializable result of the stage (e.g. the selected scenes)
+        """
+        inputs = list(inputs)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO stages (interval, product, stage, status, inputs, outputs, checksums, result, '
+                                    'started, finished, error, input_checksums) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                interval, product, stage, status, json.dumps(inputs), json.dumps(outputs),
+                json.dumps([fingerprint(path) for path in as_list(outputs)]), json.dumps(result) if result is not None else None,
+                started, time.time(), error, json.dumps([fingerprint(path) for path in as_list(inputs)])))
+
+    def run(self, interval, product, stage, func, inputs=()):
+        """
+        runs func() unless the stage is already done on the same, unchanged inputs with valid outputs
+
+        func returns the outputs of the stage: a path, a list or a dict of paths
+        returns the outputs, stored or new
+        """
+        if self.is_done(interval, product, stage, inputs):
+            logger.info('\t{0} {1} {2}: already done, skipping'.format(interval, product, stage))
+            return self.get(interval, product, stage)['outputs']
+
+        started = time.time()
+        self.set(interval, product, stage, 'running', inputs, started=started)
+        try:
+            outputs = func()
+        except Exception as exc:
+            self.set(interval, product, stage, 'failed', inputs, started=started, error=repr(exc))
+            raise
+
+        self.set(interval, product, stage, 'done', inputs, outputs, started=started)
+        return outputs
+
+    def refresh(self, interval, product, stage):
+        """
+        records the current fingerprints of the outputs of a done stage, after a later stage updated them in place
+        """
+        record = self.get(interval, product, stage)
+        if record is not None and record['status'] == 'done':
+            with self.lock:
+                self.connection.execute('UPDATE stages SET checksums=? WHERE interval=? AND product=? AND stage=?', (
+                    json.dumps([fingerprint(path) for path in as_list(record['outputs'])]), interval, product, stage))
+
+    def get_summary(self):
+        """
+        returns dict stage -> dict status -> count
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status').fetchall()
+        summary = {}
+        for stage, status, count in rows:
+            summary.setdefault(stage, {})[status] = count
+        return summary
+
+    def close(self):
+        self.connection.close()
@@ -1,22 +1,42 @@
 # extended from https://github.com/wajuqi/Sentinel-1-preprocessing-using-Snappy
 
-import snappy
-from snappy import ProductIO
-from snappy import HashMap
-from snappy import GPF
+try:
+    import snappy
+    from snappy import ProductIO
+    from snappy import HashMap
+    from snappy import GPF
+except ImportError:
+    # only the gpt backend is available
+    snappy = None
 import os
+import functools
 import zipfile
 import logging
 import glob
 from src.Processor import Processor
+from src import Profiler
+from src.utils import extract_members, atomic_output, mosaic_to_file, get_footprint_grid
+from src.SnapGraph import THERMAL_NOISE_PARAMS, SCALE_DB_PARAMS, OUTPUT_FORMAT, get_calibration_params, get_terrain_correction_params, \
+    get_s1_nodes, make_graph, run_gpt, get_subset_region, group_slices
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import rasterio
 
 logger = logging.getLogger('S1ProcessorLogger')
 logging.basicConfig(level=logging.INFO)
 
+SNAP_OPTIONS = {'gpt': 'gpt', 'heap_gb': 8, 'tile_cache_mb': 4096, 'threads': 4, 'memory_budget_gb': 16, 'java_options': ''}
+
+def to_hashmap(parameters):
+    hashmap = HashMap()
+    for key, value in parameters.items():
+        hashmap.put(key, value)
+    return hashmap
+
 class S1Processor(Processor):
-    def __init__(self, zips_path, footprint):
-        super(S1Processor, self).__init__(zips_path, footprint)
+    def __init__(self, zips_path, footprint, extraction='full', backend='snappy', snap_options=None,
+                 early_subset=False, subset_margin=0.1, slice_assembly=False, **kwargs):
+        super(S1Processor, self).__init__(zips_path, footprint, **kwargs)
         logger.info('Instanciating S1 processor for S1 files in {0}'.format(self.zips_path))
 
         self.suffix = 'S1'
@@ -25,17 +45,44 @@ class S1Processor(Processor):
         self.basenames = []
         self.pols = []
         self.polarizations = []
+        # 'full': extract the whole SAFE, 'selective': extract only what SNAP reads (manifest, annotation, measurement)
+        # 'vsizip': SNAP reads the zips directly
+        self.extraction = extraction
+        self.product_paths = []
+        # 'snappy': operators chained through the Java bridge, 'gpt': one graph per scene run by gpt
+        self.backend = backend
+        # gpt, heap_gb, tile_cache_mb, threads, memory_budget_gb
+        self.snap_options = dict(SNAP_OPTIONS, **(snap_options or {}))
+        # subset to the AOI grown by subset_margin (degrees) in radar geometry, before the terrain correction
+        self.early_subset = early_subset and bool(footprint)
+        self.subset_margin = subset_margin
+        # assemble the consecutive slices of the same pass into one product before processing
+        self.slice_assembly = slice_assembly
+        # (lon, lat) the terrain corrected grid is aligned on, None: anchored at the extent of each scene
+        self.grid_origin = None
+        # tile of the AOI (see for_tile): mosaics the scenes processed for the whole AOI, without running SNAP
+        self.is_tile = False
 
     def unzip(self):
 
-        for zip_file in glob.glob(self.zips_path + '/S1*.zip'):
+        zip_files = self.zip_files if self.zip_files is not None else glob.glob(self.zips_path + '/S1*.zip')
+        for zip_file in zip_files:
                     
             basename = os.path.basename(zip_file)[:-4]
             self.basenames.append(basename)
             self.safe_folders.append(os.path.join(self.zips_path, basename) + '.SAFE')
 
-            with zipfile.ZipFile(zip_file, 'r') as f:
-                f.extractall(self.zips_path)   
+            if self.extraction == 'vsizip':
+                self.product_paths.append(zip_file)
+                continue
+
+            if self.extraction == 'selective':
+                keep = lambda name: name == 'manifest.safe' or name.startswith('annotation/') or name.startswith('measurement/')
+            else:
+                keep = lambda name: True
+            extract = functools.partial(extract_members, zip_file, keep, self.zips_path)
+            safe_folder = self.run_stage(basename, 'extract', extract, [zip_file])
+            self.product_paths.append(safe_folder + '/manifest.safe')
 
 
     def apply_orbit_file(self, source):
@@ -69,64 +116,61 @@ class S1Processor(Processor):
 
     def remove_thermal_noise(self, source):
         logger.info('\tThermal noise removal')
-        parameters = HashMap()
-        parameters.put('removeThermalNoise', True)
+        parameters = to_hashmap(THERMAL_NOISE_PARAMS)
         output = GPF.createProduct('ThermalNoiseRemoval', parameters, source)
         return output
 
     def calibrate(self, source, pol, polarization):
         logger.info('\tCalibration')
-        parameters = HashMap()
-        parameters.put('outputSigmaBand', True)
-
-        if polarization == 'DH':
-            parameters.put('sourceBands', 'Intensity_HH,Intensity_HV')
-        elif polarization == 'DV':
-            parameters.put('sourceBands', 'Intensity_VH,Intensity_VV')
-        elif polarization == 'SH' or polarization == 'HH':
-            parameters.put('sourceBands', 'Intensity_HH')
-        elif polarization == 'SV':
-            parameters.put('sourceBands', 'Intensity_VV')
-        else:
-            logger.info("Unknown polarization")
-
-        parameters.put('selectedPolarisations', pol)
-        parameters.put('outputImageScaleInDb', False)
-        parameters.put('auxFile', 'Product Auxiliary File')
-        parameters.put('outputImageInComplex', False)
-        parameters.put('outputGammaBand', False)
-        parameters.put('outputBetaBand', False)
+        parameters = to_hashmap(get_calibration_params(pol, polarization))
         output = GPF.createProduct("Calibration", parameters, source)
         return output
 
 
-    def multi_temporal_despeckling(self):
-        pass
-        return
-
-
     def terrain_correction(self, source):
         logger.info('\tTerrain correction...')
-        parameters = HashMap()
-        parameters.put('demName', 'SRTM 3Sec')
-        parameters.put('imgResamplingMethod', 'BILINEAR_INTERPOLATION')
-        #parameters.put('mapProjection', 'AUTO:42001')       # comment this line if no need to convert to UTM/WGS84, default is WGS84
-        parameters.put('saveProjectedLocalIncidenceAngle', True)
-        parameters.put('saveSelectedSourceBand', True)
-        #parameters.put('pixelSpacingInMeter', 10.0)
-        #parameters.put('pixelSpacingInDegree', 8.983152841195215E-5)
-        #parameters.put('alignToStandardGrid', False)
-        #parameters.put('standardGridOriginX', 0.0)
-        #parameters.put('standardGridOriginXY', 0.0)
-        parameters.put('nodataValueAtSea', True)
-        parameters.put('saveDEM', False)
-        parameters.put('saveSelectedSourceBand', True)
-        parameters.put('incidenceAngleForSigma0', 'Use projected local incidence angle from DEM')
-        parameters.put('auxFile', 'Latest Auxiliary File')
-        
+        #parameters.put('mapProjection', 'AUTO:42001')       # add this one if there is a need to convert to UTM/WGS84, default is WGS84
+        parameters = to_hashmap(get_terrain_correction_params(self.grid_origin))
         output = GPF.createProduct('Terrain-Correction', parameters, source)
         return output
 
+    def for_tile(self, tile_id, footprint):
+        """
+        as Processor.for_tile, once the scenes of the whole AOI are processed (see process_scenes): the tile only
+        mosaics them on the part of their grid covering it, so SNAP runs once per interval whatever the number of tiles
+        and the tiles, cut from the same grid, stitch without shifting at the seams
+        """
+        tile = super(S1Processor, self).for_tile(tile_id, footprint)
+        tile.paths_to_merge = list(self.paths_to_merge)
+        tile.is_tile = True
+        return tile
+
+    def get_groups(self):
+        """
+        returns lists of indices of the scenes processed together (slices of one pass if slice_assembly)
+        """
+        if self.slice_assembly:
+            return group_slices(self.basenames)
+        return [[i] for i in range(len(self.basenames))]
+
+    def assemble_slices(self, sources, pol):
+        logger.info('\tAssembling {0} slices'.format(len(sources)))
+        parameters = HashMap()
+        parameters.put('selectedPolarisations', pol)
+        products = snappy.jpy.array('org.esa.snap.core.datamodel.Product', len(sources))
+        for i, source in enumerate(sources):
+            products[i] = source
+        output = GPF.createProduct('SliceAssembly', parameters, products)
+        return output
+
+    def subset_radar(self, source):
+        logger.info('\tSubsetting to the AOI in radar geometry')
+        parameters = HashMap()
+        parameters.put('geoRegion', get_subset_region(self.footprint, self.subset_margin))
+        parameters.put('copyMetadata', True)
+        output = GPF.createProduct('Subset', parameters, source)
+        return output
+
     def subset(self, source):
         logger.info('\tClipping to AOI')
         parameters = HashMap()
@@ -137,35 +181,129 @@ class S1Processor(Processor):
 
     def scale_db(self, source):
         logger.info('\tScaling to dB')
-        parameters = HashMap()
-        parameters.put('sourceBands', 'Sigma0_VV,Sigma0_VH')
+        parameters = to_hashmap(SCALE_DB_PARAMS)
         output = GPF.createProduct("LinearToFromdB", parameters, source)
         return output
 
 
-    def process(self):
+    def get_output_path(self, i):
+        return os.path.join(self.work_folder or self.zips_path, self.basenames[i]) + '_VV_VH_dB.tif'
 
-        self.unzip()
-        self.get_meta()
+    def process_group(self, group):
+        """
+        processes one scene (or the assembled slices of one pass), through the run manifest if any
+        """
+        process = self.process_scene_gpt if self.backend == 'gpt' else self.process_scene_snappy
+        return self.run_stage(self.basenames[group[0]], 's1_graph', functools.partial(process, group),
+                              [self.product_paths[j] for j in group])
 
-        for i, safe_folder in enumerate(self.safe_folders):
+    def process_scene_gpt(self, group):
+        i = group[0]
+        output_path = self.get_output_path(i)
+        subset_region = get_subset_region(self.footprint, self.subset_margin) if self.early_subset else None
+        with atomic_output(output_path) as tmp_path:
+            graph_xml = make_graph(get_s1_nodes([self.product_paths[j] for j in group], tmp_path, self.pols[i], self.polarizations[i],
+                                                self.footprint, subset_region, self.grid_origin))
+            run_gpt(graph_xml, output_path[:-4] + '_graph.xml', gpt=self.snap_options['gpt'], heap_gb=self.snap_options['heap_gb'],
+                    tile_cache_mb=self.snap_options['tile_cache_mb'], threads=self.snap_options['threads'],
+                    java_options=self.snap_options['java_options'])
+        return output_path
+
+    def process_scene_snappy(self, group):
+        i = group[0]
        
-            scene = ProductIO.readProduct(safe_folder + '/manifest.safe')   
-            applyorbit = self.apply_orbit_file(scene)
-            thermaremoved = self.remove_thermal_noise(applyorbit)
-            calibrated = self.calibrate(thermaremoved, self.pols[i], self.polarizations[i])
-            tercorrected = self.terrain_correction(calibrated)
+        with Profiler.stage('snap_read'):
+            scenes = [ProductIO.readProduct(self.product_paths[j]) for j in group]
+        # orbit and thermal noise are corrected slice by slice, the slices are assembled before the calibration
+        thermaremoved = [self.remove_thermal_noise(self.apply_orbit_file(scene)) for scene in scenes]
+        assembled = thermaremoved[0] if len(thermaremoved) == 1 else self.assemble_slices(thermaremoved, self.pols[i])
+        calibrated = self.calibrate(assembled, self.pols[i], self.polarizations[i])
+        if self.early_subset:
+            calibrated = self.subset_radar(calibrated)
+        tercorrected = self.terrain_correction(calibrated)
 
-            # subset here
-            if self.footprint:
-                tercorrected = self.subset(tercorrected)
+        # subset here
+        if self.footprint:
+            tercorrected = self.subset(tercorrected)
 
-            scaled_db = self.scale_db(tercorrected)
+        scaled_db = self.scale_db(tercorrected)
 
-            output_path = os.path.join(self.zips_path, self.basenames[i]) + '_VV_VH_dB.tif'
-            ProductIO.writeProduct(scaled_db, output_path, 'GeoTIFF-BigTIFF')
+        output_path = self.get_output_path(i)
+        # the operators are computed while the product is written
+        with atomic_output(output_path) as tmp_path, Profiler.stage('snap_write'):
+            ProductIO.writeProduct(scaled_db, tmp_path, OUTPUT_FORMAT)
+        for scene in scenes:
             scene.dispose()
             scene.closeIO()
-            self.paths_to_merge.append(output_path)
+        return output_path
+
+    def process_gpt(self):
+        """
+        runs one graph per scene, as many scenes at once as JVMs of heap_gb fit in memory_budget_gb
+        """
+        workers = max(1, int(self.snap_options['memory_budget_gb'] // self.snap_options['heap_gb']))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            self.paths_to_merge = list(executor.map(self.process_group, self.get_groups()))
+
+    def set_jai_options(self):
+        """
+        tile cache, parallelism and system properties of the JVM started by snappy (its heap is set in snappy.ini)
+        """
+        JAI = snappy.jpy.get_type('javax.media.jai.JAI')
+        JAI.getDefaultInstance().getTileCache().setMemoryCapacity(self.snap_options['tile_cache_mb'] * 2**20)
+        JAI.getDefaultInstance().getTileScheduler().setParallelism(self.snap_options['threads'])
+
+        # the JVM is already running, the -Dkey=value options (e.g. AuxDataPath) are set as system properties
+        System = snappy.jpy.get_type('java.lang.System')
+        for option in self.snap_options['java_options'].split():
+            if option.startswith('-D') and '=' in option:
+                System.setProperty(*option[2:].split('=', 1))
+
+    def prepare(self):
+        """
+        steps shared by the tiles of the AOI (see Processor.for_tile)
+        """
+        self.unzip()
+        self.get_meta()
+
+    def process_scenes(self):
+        """
+        runs SNAP on every scene (or pass), the processed scenes are the paths to merge
+        """
+        if self.backend == 'gpt':
+            self.process_gpt()
+            return
+
+        if snappy is None:
+            raise ImportError('snappy is required by the snappy backend, use the gpt backend instead')
+        self.set_jai_options()
+
+        for group in self.get_groups():
+            self.paths_to_merge.append(self.process_group(group))
 
+    def process_aoi(self):
+        if not self.is_tile:
+            self.process_scenes()
         self.merge()
+
+    def merge_all(self):
+        """
+        as Processor.merge_all, a tile mosaics the scenes on the part of their grid covering the tile
+        """
+        if not self.is_tile:
+            return super(S1Processor, self).merge_all()
+
+        file_string = os.path.basename(os.path.dirname(self.zips_path)) + self.suffix
+        output_path = os.path.join(self.output_folder, 'Mosaic_{0}.tif'.format(file_string))
+        datasets = [rasterio.open(path) for path in self.paths_to_merge]
+        try:
+            transform, width, height = get_footprint_grid(datasets, self.footprint)
+            return [mosaic_to_file(datasets, output_path, self.dtype, self.mosaic_memory_mb, transform, width, height)]
+        finally:
+            for dataset in datasets:
+                dataset.close()
+
+    def process(self):
+
+        self.prepare()
+        self.process_aoi()
@@ -7,65 +7,166 @@ import xml.etree.ElementTree as ET
 import numpy as np
 import shapely.wkt
 import rasterio
-from src.utils import clip_to_aoi
+from src.utils import clip_to_aoi, clip_bands_to_aoi, mosaic_virtual, read_zipped_manifest, extract_members, get_safe_name
 from src.Processor import Processor
 
 logger = logging.getLogger('S2ProcessorLogger')
 logging.basicConfig(level=logging.INFO)
 
+def get_band_hrefs(root):
+    """
+    returns the manifest hrefs of the bands used for the mosaics
+    """
+    red = blue = green = nir = tci = None
+
+    for r in root.iter('fileLocation'):
+        href = r.attrib['href']
+        if 'B02.jp2' in href or 'B02_10m.jp2' in href:
+            blue = href
+        elif 'B03.jp2' in href or 'B03_10m.jp2' in href:
+            green = href
+        elif 'B04.jp2' in href or 'B04_10m.jp2' in href:
+            red = href
+        elif 'B08.jp2' in href or 'B08_10m.jp2' in href:
+            nir = href
+        elif 'TCI.jp2' in href or 'TCI_10m.jp2' in href:
+            tci = href
+
+    return {'red':red, 'green':green, 'blue':blue, 'nir':nir, 'tci':tci}
+
+BANDS = ('red', 'green', 'blue', 'nir', 'tci')
+
 class S2Processor(Processor):
-    def __init__(self, path_S2, footprint):
-        super(S2Processor, self).__init__(path_S2, footprint)
+    def __init__(self, path_S2, footprint, overview_level=None, extraction='full', bands=None, stack=False, virtual=False,
+                 materialize=False, **kwargs):
+        super(S2Processor, self).__init__(path_S2, footprint, **kwargs)
         logger.info('Instanciating S2 processor for S2 files in {0}'.format(self.zips_path))
         
         self.suffix = 'S2'
         self.dtype = np.uint16
         # The zip files in one S2 folder (of one time series point)
-        self.zip_files = glob.glob(self.zips_path + '/S2*.zip')
+        if self.zip_files is None:
+            self.zip_files = glob.glob(self.zips_path + '/S2*.zip')
         self.unzip_folders = []
         self.jp2_paths = []
         self.footprint = footprint
+        # reduced resolution level to read the JP2 bands at, None for full resolution
+        self.overview_level = overview_level
+        # 'full': extract the whole SAFE, 'selective': extract only the manifest and the used bands,
+        # 'vsizip': read the bands straight from the zips through GDAL's /vsizip/
+        self.extraction = extraction
+        self.manifests = []
+        # bands to process among red, green, blue, nir, tci (default: all)
+        self.bands = bands if bands else list(BANDS)
+        # write the bands of each product (and of the mosaic) into one multi-band file instead of one file per band
+        self.stack = stack
+        # mosaic the bands straight from the products through WarpedVRTs, without writing the clipped bands
+        # (not for stacks, whose products are clipped into one file each)
+        self.virtual = virtual and not stack
+        # still write the clipped bands in virtual mode, for debugging
+        self.materialize = materialize
     
     def unzip_files(self):
         for zip_file in self.zip_files:
-            with zipfile.ZipFile(zip_file, 'r') as ff:
-                ff.extractall(os.path.dirname(zip_file))
-        
-            self.unzip_folders.append(zip_file[:-4] + '.SAFE')
+            if self.extraction == 'full':
+                extract = functools.partial(extract_members, zip_file, lambda name: True, os.path.dirname(zip_file))
+                self.unzip_folders.append(self.run_stage(os.path.basename(zip_file)[:-4], 'extract', extract, [zip_file]))
+                continue
+
+            root = read_zipped_manifest(zip_file)
+            self.manifests.append(root)
+            if self.extraction == 'selective':
+                hrefs = [os.path.normpath(href) for band, href in get_band_hrefs(root).items() if href and band in self.bands]
+                keep = lambda name, hrefs=hrefs: name == 'manifest.safe' or name in hrefs
+                extract = functools.partial(extract_members, zip_file, keep, os.path.dirname(zip_file))
+                self.unzip_folders.append(self.run_stage(os.path.basename(zip_file)[:-4], 'extract', extract, [zip_file]))
+            else:
+                with zipfile.ZipFile(zip_file, 'r') as zf:
+                    self.unzip_folders.append('/vsizip/{0}/{1}'.format(zip_file, get_safe_name(zf)))
 
     def get_jp2_paths(self):
-        for unzip_folder in self.unzip_folders:
-            manifest = unzip_folder + '/manifest.safe'
-            tree = ET.parse(manifest)
-            root = tree.getroot()
-            
-            red = blue = green = nir = tci = None
-            
-            for r in root.iter('fileLocation'):
-                href = r.attrib['href']
-                if 'B02.jp2' in href or 'B02_10m.jp2' in href:
-                    blue = os.path.join(unzip_folder,href)
-                elif 'B03.jp2' in href or 'B03_10m.jp2' in href:
-                    green = os.path.join(unzip_folder,href)
-                elif 'B04.jp2' in href or 'B04_10m.jp2' in href:
-                    red = os.path.join(unzip_folder,href)
-                elif 'B08.jp2' in href or 'B08_10m.jp2' in href:
-                    nir = os.path.join(unzip_folder,href)
-                elif 'TCI.jp2' in href or 'TCI_10m.jp2' in href:
-                    tci = os.path.join(unzip_folder,href)
-                    
-            self.jp2_paths.append({'red':red, 'green':green, 'blue':blue, 'nir':nir, 'tci':tci})
+        for i, unzip_folder in enumerate(self.unzip_folders):
+            if self.manifests:
+                root = self.manifests[i]
+            else:
+                root = ET.parse(unzip_folder + '/manifest.safe').getroot()
 
+            hrefs = get_band_hrefs(root)
+            self.jp2_paths.append({key: os.path.join(unzip_folder, os.path.normpath(hrefs[key])) if hrefs[key] else None
+                                   for key in self.bands})
 
-    def clip_all_to_aoi(self):
-        clip_partial = functools.partial(clip_to_aoi, footprint=self.footprint)
-        clip_lambda = lambda x: dict(zip(x.keys(), map(clip_partial, x.values())))
+    def get_clip_path(self, jp2_path):
+        """
+        bands are clipped next to the bands, the bands read from the zips next to the zips (or into the work folder of a tile)
+        """
+        if self.work_folder is not None:
+            return os.path.join(self.work_folder, os.path.basename(jp2_path)[:-4] + '_clipped.tif')
+        if jp2_path.startswith('/vsizip/'):
+            return os.path.join(self.zips_path, os.path.basename(jp2_path)[:-4] + '_clipped.tif')
+        return jp2_path[:-4] + '_clipped.tif'
+
+    def get_stack_path(self, i):
+        if self.work_folder is not None:
+            return os.path.join(self.work_folder, os.path.basename(self.zip_files[i])[:-4] + '_stack_clipped.tif')
+        return self.zip_files[i][:-4] + '_stack_clipped.tif'
+
+    def clip_cached(self, i, clip, output_path, *key_parts):
+        """
+        clip(output_path), unless the product store holds the same clip (same product, AOI, resolution and bands)
+        """
+        if self.store is None:
+            return clip(output_path)
+        key = self.store.get_clip_key(os.path.basename(self.zip_files[i]), self.footprint, self.overview_level, *key_parts)
+        return self.store.get_clip(key, output_path) or self.store.put_clip(key, clip(output_path))
 
-        self.paths_to_merge = [clip_lambda(jp2_paths) for jp2_paths in self.jp2_paths]
+    def clip_product(self, i):
+        jp2_paths = self.jp2_paths[i]
+        if self.stack:
+            clip = functools.partial(clip_bands_to_aoi, jp2_paths, self.footprint, overview_level=self.overview_level)
+            return {'stack': self.clip_cached(i, clip, self.get_stack_path(i), 'stack', *jp2_paths.keys())}
+
+        clip_partial = lambda path: functools.partial(clip_to_aoi, path, self.footprint, overview_level=self.overview_level)
+        return dict(zip(jp2_paths.keys(), [self.clip_cached(i, clip_partial(path), self.get_clip_path(path), os.path.basename(path))
+                                           for path in jp2_paths.values()]))
+
+    def clip_all_to_aoi(self):
+        self.paths_to_merge = [self.run_stage(os.path.basename(self.zip_files[i])[:-4], 's2_clip', functools.partial(self.clip_product, i),
+                                              list(self.jp2_paths[i].values()))
+                               for i in range(len(self.jp2_paths))]
     
-    def process(self):
+    def prepare(self):
+        """
+        steps shared by the tiles of the AOI (see Processor.for_tile)
+        """
         self.unzip_files()
         self.get_jp2_paths()
-        self.clip_all_to_aoi()
-        self.merge()
+
+    def merge_virtual(self):
+        """
+        mosaics each band from the bands of all products in one pass (see mosaic_virtual)
+        """
+        file_string = os.path.basename(os.path.dirname(self.zips_path)) + self.suffix
+        outputs = []
+        for key in self.bands:
+            paths = [jp2_paths[key] for jp2_paths in self.jp2_paths if jp2_paths.get(key)]
+            if not paths:
+                continue
+            output_path = os.path.join(self.output_folder, 'Mosaic_{0}_{1}.tif'.format(key, file_string))
+            outputs.append(mosaic_virtual(paths, self.footprint, output_path, self.dtype, self.mosaic_memory_mb, self.overview_level))
+        return outputs
+
+    def process_aoi(self):
+        if not self.virtual:
+            self.clip_all_to_aoi()
+            self.merge()
+            return
+
+        if self.materialize:
+            self.clip_all_to_aoi()
+        inputs = [path for jp2_paths in self.jp2_paths for path in jp2_paths.values() if path]
+        self.run_stage(self.suffix, 'merge', self.merge_virtual, inputs)
+
+    def process(self):
+        self.prepare()
+        self.process_aoi()
   
\ No newline at end of file
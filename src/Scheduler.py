@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src import Profiler
+
+logger = logging.getLogger('SchedulerLogger')
+logging.basicConfig(level=logging.INFO)
+
+
+class IntervalScheduler(object):
+    """
+    Runs the intervals of a time series concurrently, each as a small DAG:
+
+        download S1/S2 -> process S1 || process S2 -> post-process
+
+    Every kind of work has its own bounded pool so interval i is processed while interval i+1 downloads:
+    - network: product downloads of all intervals share network_workers threads
+    - SNAP: with the gpt backend, S1 processing runs in snap_memory_gb // s1_memory_gb slots, so the gpt JVMs
+      of the intervals fit in memory: process_s1 must keep the gpt runs of one interval within s1_memory_gb
+      (main passes it as the SNAP memory_budget_gb). With snappy all the S1 processing goes through the one JVM of the process,
+      whose heap and tile cache are shared, so it runs one interval at a time in a single slot.
+    - CPU: S2 processing and post-processing share cpu_workers threads
+    max_intervals_in_flight bounds how many intervals are downloaded ahead (and their disk usage).
+
+    The download jobs of all the intervals are listed once: a product selected for several intervals
+    (e.g. on the shared bound of two of them) is downloaded once, by the first interval needing it,
+    and linked into the folders of the others, which wait for the same download.
+
+    process_s1, process_s2 and post_process are callables taking the folder of the interval.
+    process_tiled, if given, replaces them: a callable taking the folder of the interval and the SNAP and CPU pools
+    as snap and cpu keywords, which submits the SNAP processing and the work of the tiles of the interval to them (see main.process_tiled).
+    """
+    def __init__(self, mosaicker, process_s1, process_s2, post_process, network_workers=4, cpu_workers=2,
+                 snap_memory_gb=16, s1_memory_gb=8, max_intervals_in_flight=3, backend='snappy',
+                 process_tiled=None):
+        self.mosaicker = mosaicker
+        self.downloader = mosaicker.get_downloader()
+        # uuid -> jobs of the product for all the intervals
+        self.jobs = {}
+        for job in mosaicker.get_download_jobs():
+            self.jobs.setdefault(job[0], []).append(job)
+        # uuid -> future of its download, once submitted
+        self.downloads = {}
+        self.downloads_lock = threading.Lock()
+        self.process_s1 = process_s1
+        self.process_s2 = process_s2
+        self.post_process = post_process
+        self.process_tiled = process_tiled
+
+        self.network_workers = network_workers
+        self.cpu_workers = cpu_workers
+        self.snap_workers = max(1, int(snap_memory_gb // s1_memory_gb)) if backend == 'gpt' else 1
+        self.max_intervals_in_flight = max_intervals_in_flight
+
+    def submit_downloads(self, pair, network):
+        """
+        returns: dict uuid -> future of the download of the products of the interval, the products
+        not submitted yet for another interval are submitted with the jobs of all the intervals
+        """
+        jobs = self.mosaicker.get_download_jobs([pair])
+        uuids = [job[0] for job in jobs]
+        with self.downloads_lock:
+            pending = [job for uuid in uuids if uuid not in self.downloads for job in self.jobs.get(uuid, [])]
+            pending += [job for job in jobs if job[0] not in self.jobs and job[0] not in self.downloads]
+            self.downloads.update(self.downloader.submit(pending, network))
+            return {uuid: self.downloads[uuid] for uuid in uuids}
+
+    def run_interval(self, pair, network, snap, cpu):
+        interval = pair[0]
+        folder = self.mosaicker.get_interval_folder(interval)
+        name = os.path.basename(folder)
+        start = time.time()
+
+        with Profiler.stage('download', name):
+            summary = self.downloader.wait(self.submit_downloads(pair, network))
+        if summary['failed']:
+            raise RuntimeError('{0} products could not be downloaded'.format(len(summary['failed'])))
+        logger.info('\t{0}: downloaded after {1:.0f}s'.format(name, time.time() - start))
+
+        if self.process_tiled is not None:
+            self.process_tiled(folder, snap=snap, cpu=cpu)
+            logger.info('\t{0}: done after {1:.0f}s'.format(name, time.time() - start))
+            return folder
+
+        s1_future = snap.submit(self.process_s1, folder)
+        s2_future = cpu.submit(self.process_s2, folder)
+        s1_future.result()
+        s2_future.result()
+        logger.info('\t{0}: processed after {1:.0f}s'.format(name, time.time() - start))
+
+        cpu.submit(self.post_process, folder).result()
+        logger.info('\t{0}: done after {1:.0f}s'.format(name, time.time() - start))
+        return folder
+
+    def run(self, pairs=None):
+        """
+        returns: dict folder of the interval -> None if done or the exception that stopped it
+        """
+        pairs = self.mosaicker.list_ts_pairs if pairs is None else pairs
+        status = {}
+
+        with ThreadPoolExecutor(max_workers=self.network_workers) as network, \
+             ThreadPoolExecutor(max_workers=self.snap_workers) as snap, \
+             ThreadPoolExecutor(max_workers=self.cpu_workers) as cpu, \
+             ThreadPoolExecutor(max_workers=self.max_intervals_in_flight) as intervals:
+
+            futures = [(self.mosaicker.get_interval_folder(pair[0]), intervals.submit(self.run_interval, pair, network, snap, cpu))
+                       for pair in pairs]
+            for folder, future in futures:
+                try:
+                    future.result()
+                    status[folder] = None
+                except Exception as exc:
+                    logger.info('\t{0} failed: {1}'.format(os.path.basename(folder), exc))
+                    status[folder] = exc
+
+        logger.info('\t{0}/{1} intervals done'.format(sum(exc is None for exc in status.values()), len(status)))
+        return status
@@ -0,0 +1,201 @@
+import os
+import subprocess
+import logging
+from collections import OrderedDict
+import xml.etree.ElementTree as ET
+import shapely.wkt
+from src.Profiler import profiled
+
+logger = logging.getLogger('SnapGraphLogger')
+logging.basicConfig(level=logging.INFO)
+
+# parameters shared by the snappy and the gpt backends of S1Processor
+THERMAL_NOISE_PARAMS = OrderedDict([
+    ('removeThermalNoise', True),
+])
+
+CALIBRATION_PARAMS = OrderedDict([
+    ('outputSigmaBand', True),
+    ('outputImageScaleInDb', False),
+    ('auxFile', 'Product Auxiliary File'),
+    ('outputImageInComplex', False),
+    ('outputGammaBand', False),
+    ('outputBetaBand', False),
+])
+
+TERRAIN_CORRECTION_PARAMS = OrderedDict([
+    ('demName', 'SRTM 3Sec'),
+    ('imgResamplingMethod', 'BILINEAR_INTERPOLATION'),
+    ('saveProjectedLocalIncidenceAngle', True),
+    ('saveSelectedSourceBand', True),
+    ('nodataValueAtSea', True),
+    ('saveDEM', False),
+    ('incidenceAngleForSigma0', 'Use projected local incidence angle from DEM'),
+    ('auxFile', 'Latest Auxiliary File'),
+])
+
+SCALE_DB_PARAMS = OrderedDict([
+    ('sourceBands', 'Sigma0_VV,Sigma0_VH'),
+])
+
+OUTPUT_FORMAT = 'GeoTIFF-BigTIFF'
+
+
+def get_calibration_source_bands(polarization):
+    if polarization == 'DH':
+        return 'Intensity_HH,Intensity_HV'
+    elif polarization == 'DV':
+        return 'Intensity_VH,Intensity_VV'
+    elif polarization == 'SH' or polarization == 'HH':
+        return 'Intensity_HH'
+    elif polarization == 'SV':
+        return 'Intensity_VV'
+    logger.info("Unknown polarization")
+    return None
+
+
+def get_calibration_params(pol, polarization):
+    parameters = OrderedDict(CALIBRATION_PARAMS)
+    source_bands = get_calibration_source_bands(polarization)
+    if source_bands:
+        parameters['sourceBands'] = source_bands
+    parameters['selectedPolarisations'] = pol
+    return parameters
+
+
+def get_terrain_correction_params(grid_origin=None):
+    """
+    grid_origin: (lon, lat) the output grid is aligned on, so outputs of different subsets share the same pixel grid
+    """
+    parameters = OrderedDict(TERRAIN_CORRECTION_PARAMS)
+    if grid_origin is not None:
+        parameters['alignToStandardGrid'] = True
+        parameters['standardGridOriginX'], parameters['standardGridOriginY'] = grid_origin
+    return parameters
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def make_graph(nodes):
+    """
+    nodes: list of (node id, operator, list of source node ids, dict of parameters)
+
+    returns the gpt graph XML as a string
+    """
+    graph = ET.Element('graph', id='Sen12MosaickerGraph')
+    ET.SubElement(graph, 'version').text = '1.0'
+
+    for node_id, operator, sources, parameters in nodes:
+        node = ET.SubElement(graph, 'node', id=node_id)
+        ET.SubElement(node, 'operator').text = operator
+
+        sources_element = ET.SubElement(node, 'sources')
+        for i, source in enumerate(sources):
+            tag = 'sourceProduct' if i == 0 else 'sourceProduct.{0}'.format(i)
+            ET.SubElement(sources_element, tag, refid=source)
+
+        parameters_element = ET.SubElement(node, 'parameters', {'class': 'com.bc.ceres.binding.dom.XppDomElement'})
+        for key, value in parameters.items():
+            ET.SubElement(parameters_element, key).text = format_value(value)
+
+    return ET.tostring(graph, encoding='unicode')
+
+
+def get_grid_origin(footprint):
+    """
+    upper left corner of the AOI, origin of the terrain corrected grid shared by its tiles
+    """
+    minx, _, _, maxy = shapely.wkt.loads(footprint).bounds
+    return minx, maxy
+
+
+def get_subset_region(footprint, margin):
+    """
+    AOI grown by margin (in degrees), to subset in radar geometry without losing pixels to terrain correction
+    """
+    return shapely.wkt.loads(footprint).buffer(margin).envelope.wkt
+
+
+def get_slice_key(basename):
+    """
+    slices of the same pass share mission, absolute orbit and datatake id:
+    S1A_IW_GRDH_1SDV_20200101T053120_20200101T053145_030620_038216_3F3C -> ('S1A', '030620', '038216')
+    """
+    fields = basename.split('_')
+    return fields[0], fields[-3], fields[-2]
+
+
+def group_slices(basenames):
+    """
+    returns lists of indices of basenames, one per pass, ordered by sensing start
+    """
+    groups = OrderedDict()
+    for i in sorted(range(len(basenames)), key=lambda i: basenames[i].split('_')[-5]):
+        groups.setdefault(get_slice_key(basenames[i]), []).append(i)
+    return list(groups.values())
+
+
+def get_s1_nodes(input_paths, output_path, pol, polarization, footprint=None, subset_region=None, grid_origin=None):
+    """
+    Read -> Apply-Orbit-File -> ThermalNoiseRemoval -> (SliceAssembly) -> Calibration -> Terrain-Correction -> (Subset) -> LinearToFromdB -> Write
+    with the parameters of the snappy backend
+
+    input_paths: one product, or the consecutive slices of one pass, each orbit-corrected and cleared of its
+                 thermal noise on its own (the noise vectors are per slice), then assembled (SliceAssembly) before the calibration
+    subset_region: subset in radar geometry right after the calibration, before the terrain correction
+    grid_origin: (lon, lat) the terrain corrected grid is aligned on (see get_terrain_correction_params)
+    """
+    if isinstance(input_paths, str):
+        input_paths = [input_paths]
+
+    node_id = lambda operator, i: operator if i == 0 else '{0}({1})'.format(operator, i + 1)
+    nodes, last_nodes = [], []
+    for i, path in enumerate(input_paths):
+        nodes += [
+            (node_id('Read', i), 'Read', [], {'file': path}),
+            (node_id('Apply-Orbit-File', i), 'Apply-Orbit-File', [node_id('Read', i)], {}),
+            (node_id('ThermalNoiseRemoval', i), 'ThermalNoiseRemoval', [node_id('Apply-Orbit-File', i)], THERMAL_NOISE_PARAMS),
+        ]
+        last_nodes.append(node_id('ThermalNoiseRemoval', i))
+    last = last_nodes[0]
+    if len(last_nodes) > 1:
+        nodes.append(('SliceAssembly', 'SliceAssembly', last_nodes, {'selectedPolarisations': pol}))
+        last = 'SliceAssembly'
+
+    nodes.append(('Calibration', 'Calibration', [last], get_calibration_params(pol, polarization)))
+    last = 'Calibration'
+    if subset_region:
+        nodes.append(('Subset-Radar', 'Subset', [last], OrderedDict([('geoRegion', subset_region), ('copyMetadata', True)])))
+        last = 'Subset-Radar'
+
+    nodes.append(('Terrain-Correction', 'Terrain-Correction', [last], get_terrain_correction_params(grid_origin)))
+    last = 'Terrain-Correction'
+    if footprint:
+        nodes.append(('Subset', 'Subset', [last], {'geoRegion': footprint}))
+        last = 'Subset'
+    nodes += [
+        ('LinearToFromdB', 'LinearToFromdB', [last], SCALE_DB_PARAMS),
+        ('Write', 'Write', ['LinearToFromdB'], OrderedDict([('file', output_path), ('formatName', OUTPUT_FORMAT)])),
+    ]
+    return nodes
+
+
+@profiled()
+def run_gpt(graph_xml, graph_path, gpt='gpt', heap_gb=8, tile_cache_mb=4096, threads=4, java_options=''):
+    """
+    writes the graph next to its outputs and runs it with gpt in a JVM of heap_gb
+    java_options: further JVM options, e.g. -DAuxDataPath=<folder> (see AuxData)
+    """
+    with open(graph_path, 'w') as f:
+        f.write(graph_xml)
+
+    env = dict(os.environ)
+    env['_JAVA_OPTIONS'] = ' '.join(option for option in (env.get('_JAVA_OPTIONS', ''), '-Xmx{0}G'.format(heap_gb), java_options) if option)
+    command = [gpt, graph_path, '-c', '{0}M'.format(tile_cache_mb), '-q', str(threads)]
+
+    logger.info('\tRunning {0}'.format(' '.join(command)))
+    subprocess.run(command, env=env, check=True)
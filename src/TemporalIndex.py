@@ -0,0 +1,57 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+
+def make_intervals(min_date, max_date, days, step=None):
+    """
+    returns the list of (start, end) intervals of width days covering [min_date, max_date]
+
+    step (in days, defaults to days) is the shift between two consecutive starts:
+    step < days gives overlapping sliding windows
+    """
+    delta_days = datetime.timedelta(days)
+    delta_step = datetime.timedelta(step if step else days)
+
+    intervals = []
+    start = min_date
+    while max_date - start > delta_days:
+        intervals.append((start, start + delta_days))
+        start += delta_step
+    intervals.append((start, max_date))
+    return intervals
+
+
+class TemporalIndex(object):
+    """
+    Sorts the products once by sensing time and finds the products of each interval with a binary search.
+
+    closed: which interval bounds are inclusive, 'both' (as get_products_chunks always did), 'left', 'right' or 'neither'.
+    Chunks are positional slices of the sorted frame, computed only when asked for.
+    """
+    def __init__(self, products_df, column='beginposition'):
+        self.products = products_df.sort_values(column, kind='mergesort')
+        self.times = pd.to_datetime(self.products[column]).values
+
+    def get_bounds(self, ts_intervals, closed='both'):
+        """
+        returns: two arrays of the positional (start, stop) of each interval in the sorted products
+        """
+        starts = pd.to_datetime([interval[0] for interval in ts_intervals]).values
+        ends = pd.to_datetime([interval[1] for interval in ts_intervals]).values
+
+        lo = np.searchsorted(self.times, starts, side='left' if closed in ('both', 'left') else 'right')
+        hi = np.searchsorted(self.times, ends, side='right' if closed in ('both', 'right') else 'left')
+        return lo, np.maximum(hi, lo)
+
+    def get_counts(self, ts_intervals, closed='both'):
+        lo, hi = self.get_bounds(ts_intervals, closed)
+        return hi - lo
+
+    def iter_chunks(self, ts_intervals, closed='both'):
+        lo, hi = self.get_bounds(ts_intervals, closed)
+        for start, stop in zip(lo, hi):
+            yield self.products.iloc[start:stop]
+
+    def get_chunks(self, ts_intervals, closed='both'):
+        return list(self.iter_chunks(ts_intervals, closed))
@@ -0,0 +1,71 @@
+import os
+import glob
+import math
+import logging
+import rasterio
+import shapely
+import shapely.wkt
+from src.utils import mosaic_to_file
+
+logger = logging.getLogger('TilingLogger')
+logging.basicConfig(level=logging.INFO)
+
+# outputs of a tile that are stitched: S2 band mosaics, S1 mosaic, co-registered S1 or stack
+TILE_OUTPUTS = ('*S2.tif', '*S1.tif', '*_coreg.tif')
+
+
+def get_aoi_tiles(footprint, rows=2, cols=2, tile_size_deg=None):
+    """
+    splits the AOI into a grid over its bounding box, rows x cols tiles or tiles of tile_size_deg degrees
+
+    returns the list of (tile_id, footprint WKT of the part of the AOI in the tile), tiles outside the AOI are dropped
+    """
+    aoi = shapely.wkt.loads(footprint)
+    minx, miny, maxx, maxy = aoi.bounds
+    if tile_size_deg:
+        cols = max(1, int(math.ceil((maxx - minx) / tile_size_deg)))
+        rows = max(1, int(math.ceil((maxy - miny) / tile_size_deg)))
+    step_x, step_y = (maxx - minx) / cols, (maxy - miny) / rows
+
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            cell = shapely.box(minx + col * step_x, maxy - (row + 1) * step_y, minx + (col + 1) * step_x, maxy - row * step_y)
+            part = aoi.intersection(cell)
+            if part.is_empty or part.area == 0:
+                continue
+            tiles.append(('r{0}_c{1}'.format(row, col), part.wkt))
+    logger.info('\tAOI split into {0} tiles of a {1}x{2} grid'.format(len(tiles), rows, cols))
+    return tiles
+
+
+def get_tile_folder(folder, tile_id):
+    return os.path.join(folder, 'tiles', tile_id)
+
+
+def get_tile_outputs(tile_folders):
+    """
+    returns the outputs of the tiles that are stitched (see TILE_OUTPUTS)
+    """
+    return sorted(path for tile_folder in tile_folders for pattern in TILE_OUTPUTS for path in glob.glob(os.path.join(tile_folder, pattern)))
+
+
+def stitch_tiles(tile_folders, output_folder, memory_budget_mb=512):
+    """
+    mosaics the outputs of the same name of the tiles (see TILE_OUTPUTS) into output_folder, block by block,
+    so the peak memory is the one of mosaic_to_file whatever the size of the AOI
+
+    returns the list of stitched outputs
+    """
+    names = sorted(set(os.path.basename(path) for path in get_tile_outputs(tile_folders)))
+    outputs = []
+    for name in names:
+        datasets = [rasterio.open(os.path.join(tile_folder, name)) for tile_folder in tile_folders
+                    if os.path.exists(os.path.join(tile_folder, name))]
+        try:
+            outputs.append(mosaic_to_file(datasets, os.path.join(output_folder, name), datasets[0].dtypes[0], memory_budget_mb))
+        finally:
+            for dataset in datasets:
+                dataset.close()
+    logger.info('\t{0} outputs stitched from {1} tiles into {2}'.format(len(outputs), len(tile_folders), output_folder))
+    return outputs
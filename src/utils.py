@@ -7,7 +7,14 @@ from datetime import date
 import datetime
 import pandas as pd
 
+import os
+import time
 import json
+import shutil
+import contextlib
+import math
+import zipfile
+import xml.etree.ElementTree as ET
 import yaml
 
 import shapely
@@ -19,9 +26,48 @@ from rasterio.mask import mask
 from rasterio.merge import merge
 import geopandas as gpd
 from shapely.geometry import box
-
-import rasterio
-from rasterio.warp import reproject, calculate_default_transform as cdt, Resampling
+from src.CoverageSelector import CoverageSelector
+from src.CatalogCache import CatalogCache, compact_catalog, parse_size
+from src.TemporalIndex import TemporalIndex, make_intervals
+from src.QueryEngine import QueryEngine
+from src.Profiler import profiled, count_pixels
+from src import OutputProfile
+
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds
+from rasterio.transform import array_bounds
+from rasterio.warp import reproject, transform_bounds, calculate_default_transform as cdt, Resampling
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    yields a temporary path next to path, renamed to path only once the block succeeded,
+    so an interrupted write never leaves a truncated output behind
+    """
+    root, ext = os.path.splitext(path)
+    tmp_path = '{0}.tmp{1}'.format(root, ext)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@contextlib.contextmanager
+def raster_output(path, meta, final=True):
+    """
+    opens a GeoTIFF for writing through atomic_output, laid out and compressed as the output profile of the run
+    (see OutputProfile), final outputs get their overviews (COG layout) once written
+    """
+    meta = dict(meta, **OutputProfile.get_creation_options(meta['dtype']))
+    meta['nodata'] = OutputProfile.get_nodata(meta.get('nodata'))
+    start = time.perf_counter()
+    with atomic_output(path) as tmp_path:
+        with rasterio.open(tmp_path, 'w', **meta) as dst:
+            yield dst
+        OutputProfile.finalize(tmp_path, final, time.perf_counter() - start, os.path.basename(path))
 
 def authenticate_oah(creds_json):
     """
@@ -46,6 +92,17 @@ def read_main_config(conf_yaml):
             
         return parse_['OUTPUT_FOLDER'], parse_['min_coverage'], parse_['DATE']['min_date'], parse_['DATE']['max_date'], parse_['DATE']['ts_interval'], parse_['OAH_CREDS'], parse_['FOOTPRINT']
 
+def read_config_section(conf_yaml, section, defaults):
+    """
+    returns the (optional) section of the config file merged over the given defaults
+    """
+    with open(conf_yaml, 'r') as stream:
+        parse_ = yaml.safe_load(stream)
+
+    values = dict(defaults)
+    values.update((parse_ or {}).get(section) or {})
+    return values
+
 def read_query_kwargs(conf_yaml):
     with open(conf_yaml, 'r') as stream:
         try:
@@ -63,9 +120,12 @@ def read_query_kwargs(conf_yaml):
         
         return s2_kwargs, s1_kwargs
 
-def query_products(api, date_interval, conf_yaml, footprint):
+@profiled()
+def query_products(api, date_interval, conf_yaml, footprint, archive=None):
     """
     date_interval: tuple of strings (min_date, max_date) 
+    archive: ArchiveIndex of the local zips, the archived products are flagged on_disk (with their local_path)
+             and those the hub did not return are added. Without api only the cache and the archive are queried.
 
     returns: two dicts of s2 and s1 products
     """
@@ -76,7 +136,41 @@ def query_products(api, date_interval, conf_yaml, footprint):
     s2_kwargs.update({'area':footprint, 'platformname': 'Sentinel-2', 'date' : date_interval})
     s1_kwargs.update({'area':footprint, 'platformname': 'Sentinel-1', 'date' : date_interval})
 
-    return api.to_dataframe(api.query(**s2_kwargs)), api.to_dataframe(api.query(**s1_kwargs))
+    cache = get_catalog_cache(conf_yaml)
+    query_conf = read_config_section(conf_yaml, 'QUERY', {'workers': 4, 'days_per_query': 90, 'max_vertices': 200})
+    all_kwargs = [s2_kwargs, s1_kwargs]
+
+    catalogs, keys = [None, None], [None, None]
+    if cache is not None:
+        keys = [cache.get_key(footprint, date_interval, kwargs) for kwargs in all_kwargs]
+        catalogs = [cache.get(key) for key in keys]
+
+    # the queries the cache could not answer run concurrently
+    missing = [i for i, catalog in enumerate(catalogs) if catalog is None]
+    if missing and api is not None:
+        queried = QueryEngine(api, **query_conf).query([all_kwargs[i] for i in missing])
+        for i, catalog in zip(missing, queried):
+            if cache is not None:
+                catalog = compact_catalog(catalog)
+                cache.put(keys[i], catalog)
+            catalogs[i] = catalog
+
+    products = []
+    for kwargs, catalog in zip(all_kwargs, catalogs):
+        catalog = catalog if catalog is not None else pd.DataFrame()
+        if archive is not None:
+            catalog = archive.annotate(catalog, footprint, date_interval, kwargs['platformname'], kwargs)
+        products.append(catalog)
+    return products[0], products[1]
+
+def get_catalog_cache(conf_yaml):
+    """
+    returns the CatalogCache configured in conf_yaml or None if disabled
+    """
+    cache_conf = read_config_section(conf_yaml, 'CATALOG_CACHE', {'enabled': False, 'folder': '.catalog_cache', 'ttl_hours': 24*7, 'max_size_mb': 1024, 'offline': False})
+    if not cache_conf.pop('enabled'):
+        return None
+    return CatalogCache(**cache_conf)
 
 def get_intersection(footprint1, footprint2):
     fp1 = shapely.wkt.loads(footprint1)
@@ -98,53 +192,99 @@ def get_sorted_scenes_by_intersection_aoi(products, aoi_fp):
         return products.sort_values(['intersection_AOI'], ascending=False)
 
 
-def get_complete_coverage_of_AOI(products, aoi_fp, logger, aoi_area=None, min_coverage=0.90):
-    
-    if aoi_area is None:
-        aoi = shapely.wkt.loads(aoi_fp)
-        aoi_area = aoi.area
-
-    scenes = get_sorted_scenes_by_intersection_aoi(products, aoi_fp)
+def get_complete_coverage_of_AOI(products, aoi_fp, logger, aoi_area=None, min_coverage=0.90, weights=None, disk_tolerance=0.05):
+    """
+    returns the list of scenes (rows of products) covering at least min_coverage of the AOI,
+    ending with the flag 'incomplete' if the AOI can't be covered
 
-    top_scene = scenes.iloc[0]
-    
-    # has to return the flag incomplete aoi coverage 
+    aoi_area is kept for backwards compatibility, the coverage is always relative to aoi_fp
+    weights: None for the largest intersections first, or a dict of CoverageSelector.select_weighted options
+             (cloud_weight, on_disk_weight, free_uuids) for the cover of least download cost
+    disk_tolerance: without weights, a scene on disk is picked over one to download covering up to this fraction more
+    """
+    if weights is not None:
+        return CoverageSelector(products).select_weighted(aoi_fp, logger, min_coverage=min_coverage, **weights)
+    return CoverageSelector(products).select(aoi_fp, logger, min_coverage=min_coverage, disk_tolerance=disk_tolerance)
 
-    left_over_area = get_difference(aoi_fp, top_scene['footprint'])
-    intersection_area = get_intersection(aoi_fp, top_scene['footprint']).area
+def estimate_download_bytes(coverage, known_uuids=()):
+    """
+    bytes to download for a coverage: the scenes neither on disk nor in known_uuids (e.g. planned for another interval)
+    """
+    return sum(parse_size(scene['size']) for scene in coverage
+               if not isinstance(scene, str) and not scene.get('on_disk', False) and scene['uuid'] not in known_uuids)
 
-    if intersection_area == 0:
-        logger.info('the whole area could not be fully covered. Scenes are missing!')
-        return ['incomplete']
+def coverage_to_uuids(coverage):
+    return [scene if isinstance(scene, str) else scene['uuid'] for scene in coverage]
 
-    elif left_over_area.area < (1-min_coverage) * aoi_area:
-        return [top_scene]
-    else:
-        logger.info('Looking for more scenes. Non covered area percentage until now = {0}%'.format(float((left_over_area.area/aoi_area))))
-        new_aoi_fp = left_over_area.to_wkt()
-        return [top_scene] + get_complete_coverage_of_AOI(products=products, aoi_fp=new_aoi_fp, logger=logger, aoi_area=aoi_area, min_coverage=min_coverage)
+def coverage_from_uuids(products, uuids):
+    """
+    returns the coverage (list of product rows, 'incomplete' flag kept) of the given uuids or None if one is missing
+    """
+    coverage = []
+    for uuid in uuids:
+        if uuid == 'incomplete':
+            coverage.append(uuid)
+            continue
+        match = products[products['uuid'] == uuid]
+        if match.empty:
+            return None
+        coverage.append(match.iloc[0])
+    return coverage
+
+def chunk_dates(min_date, max_date, days, step=None):
+    return make_intervals(min_date, max_date, days, step)
+
+
+def get_products_chunks(products_df, ts_intervals, closed='both'):
+    """
+    returns a list of length ts_intervals
 
+    """
+    return TemporalIndex(products_df).get_chunks(ts_intervals, closed)
 
-def chunk_dates(min_date, max_date, days):
-    
-    delta_days = datetime.timedelta(days)
-    interval_width = max_date-min_date
-    
-    if interval_width <= delta_days:
-        return [(min_date, max_date)]
-    else:
-        return [(min_date, min_date + delta_days)] + chunk_dates(min_date + delta_days, max_date, days)
+def get_safe_name(zf):
+    """
+    returns the name of the .SAFE folder at the root of an opened product zip
+    """
+    for name in zf.namelist():
+        parts = name.split('/')
+        if len(parts) == 2 and parts[1] == 'manifest.safe':
+            return parts[0]
+    raise ValueError('no manifest.safe in {0}'.format(zf.filename))
 
+def read_zipped_manifest(zip_file):
+    """
+    returns the parsed manifest.safe of a product zip, without extracting it
+    """
+    with zipfile.ZipFile(zip_file, 'r') as zf:
+        safe_name = get_safe_name(zf)
+        with zf.open(safe_name + '/manifest.safe') as f:
+            return ET.parse(f).getroot()
 
-def get_products_chunks(products_df, ts_intervals):
+@profiled()
+def extract_members(zip_file, keep, folder):
     """
-    returns a list of length ts_intervals
+    extracts only the members of zip_file for which keep(name relative to the .SAFE folder) is True
 
+    returns the path of the extracted .SAFE folder
     """
-    ts_products_lists = []
-    for (min_date, max_date) in ts_intervals:
-        ts_products_lists.append(products_df[(products_df['beginposition']<=max_date) & (products_df['beginposition']>=min_date)])
-    return ts_products_lists
+    with zipfile.ZipFile(zip_file, 'r') as zf:
+        safe_name = get_safe_name(zf)
+        members = [name for name in zf.namelist()
+                   if not name.endswith('/') and keep(name[len(safe_name) + 1:])]
+
+        # extracted aside and moved in place once complete
+        tmp_folder = os.path.join(folder, '.{0}.tmp'.format(safe_name))
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+        zf.extractall(tmp_folder, members=members)
+
+    safe_folder = os.path.join(folder, safe_name)
+    if os.path.exists(safe_folder):
+        shutil.rmtree(safe_folder)
+    os.replace(os.path.join(tmp_folder, safe_name), safe_folder)
+    os.rmdir(tmp_folder)
+    return safe_folder
 
 def get_min_bbox(bbox1, bbox2):
     max_left = max(bbox1[0], bbox2[0])
@@ -158,50 +298,280 @@ def getFeatures(gdf):
     import json
     return [json.loads(gdf.to_json())['features'][0]['geometry']]
 
-def clip_to_aoi(path_jp2, footprint):
-    ConvertRaster2LatLong(path_jp2, path_jp2)
-    dataset = rasterio.open(path_jp2)
+def snap_window(window, pad=0):
+    """
+    rounds a window outwards to whole pixels (all touched), optionally padded by pad pixels
+    """
+    col_off = math.floor(window.col_off) - pad
+    row_off = math.floor(window.row_off) - pad
+    return Window(col_off, row_off,
+                  math.ceil(window.col_off + window.width) + pad - col_off,
+                  math.ceil(window.row_off + window.height) + pad - row_off)
+
+def get_clip_grid(src, fp, dst_crs):
+    """
+    returns the lat/long grid (transform, height, width) of the AOI bounding box within the tile of src
+    and the window of src (padded for the bilinear kernel) needed to fill it
+    """
+    # grid of the whole tile warped to lat/long, only computed not warped, to keep the same resolution for all products
+    full_transform, full_width, full_height = cdt(src.crs, dst_crs, src.width, src.height, *src.bounds)
+    tile_bounds = array_bounds(full_height, full_width, full_transform)
+    clip_bounds = (max(fp.bounds[0], tile_bounds[0]), max(fp.bounds[1], tile_bounds[1]),
+                   min(fp.bounds[2], tile_bounds[2]), min(fp.bounds[3], tile_bounds[3]))
+
+    dst_window = snap_window(from_bounds(*clip_bounds, transform=full_transform))
+    dst_window = dst_window.intersection(Window(0, 0, full_width, full_height))
+    dst_transform = rasterio.windows.transform(dst_window, full_transform)
+
+    src_bounds = transform_bounds(dst_crs, src.crs, *rasterio.windows.bounds(dst_window, full_transform), densify_pts=21)
+    src_window = snap_window(from_bounds(*src_bounds, transform=src.transform), pad=2)
+    src_window = src_window.intersection(Window(0, 0, src.width, src.height))
+    return dst_transform, int(dst_window.height), int(dst_window.width), src_window
+
+def reproject_window(src, src_window, dst_transform, height, width, dst_crs, nodata, dtype=np.uint16):
+    """
+    decodes src_window of all the bands of src and reprojects it onto the given grid
+    """
+    rect = src.read(window=src_window)
+    clipped = np.full((src.count, height, width), nodata, dtype=dtype)
+    reproject(
+        source=rect,
+        destination=clipped,
+        src_transform=src.window_transform(src_window),
+        src_crs=src.crs,
+        src_nodata=nodata,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        dst_nodata=nodata,
+        resampling=Resampling.bilinear)
+    return clipped
+
+@profiled()
+def clip_to_aoi(path_jp2, footprint, output_path=None, overview_level=None):
+    """
+    clips a (JP2) band to the AOI and reprojects it to EPSG:4326
+
+    The AOI is transformed into the native CRS of the tile so only the intersecting window is decoded
+    and warped, the source file is never written to.
+    overview_level: read the band at a reduced resolution level (0 is the first overview, i.e. 1/2)
+
+    returns the path of the clipped GeoTIFF (default: <band>_clipped.tif next to the band)
+    """
     fp = shapely.wkt.loads(footprint)
-    
-    # create new footprint from the intersection of raster and footprint
-    dataset_bbox = dataset.bounds
-    geo_dataset = gpd.GeoDataFrame({'geometry': box(dataset_bbox[0], dataset_bbox[1], dataset_bbox[2], dataset_bbox[3])}, index=[0], crs=dataset.crs)
+    dst_crs = CRS.from_epsg(4326)
+    open_kwargs = {} if overview_level is None else {'OVERVIEW_LEVEL': overview_level}
+
+    with rasterio.open(path_jp2, **open_kwargs) as src:
+        nodata = src.nodata if src.nodata is not None else 0
+        dst_transform, height, width, src_window = get_clip_grid(src, fp, dst_crs)
+        clipped = reproject_window(src, src_window, dst_transform, height, width, dst_crs, nodata)
+        count_pixels(clipped.size)
+
+        out_meta = src.meta.copy()
+        out_meta.update({"driver": "GTiff",
+                "height": height,
+                "width": width,
+                "transform": dst_transform,
+                "crs": dst_crs,
+                "nodata": nodata,
+                "dtype":"uint16"}
+            )
+
+    if output_path is None:
+        output_path = path_jp2[:-4] + '_clipped.tif'
+    with raster_output(output_path, out_meta, final=False) as dst:
+        dst.write(clipped)
+    return output_path
 
-    geo_fp = gpd.GeoDataFrame({'geometry': box(fp.bounds[0],fp.bounds[1],fp.bounds[2],fp.bounds[3])}, index=[0], crs={'init':'epsg:4326'})
+@profiled()
+def clip_bands_to_aoi(band_paths, footprint, output_path, overview_level=None):
+    """
+    clips the bands of one product to the AOI into a single band-interleaved GeoTIFF
 
-    coords = getFeatures(geo_dataset.intersection(geo_fp))
+    band_paths: dict band name -> path, all bands on the same tile grid (e.g. the 10m bands of a S2 product)
+    The target grid and the source window are computed once from the first band and shared by all bands,
+    which are reprojected one at a time. Multi-band inputs (TCI) add one output band per input band.
 
-    _,g_rect = mask(dataset, coords, all_touched=True, crop=True)
-    windo = rasterio.features.geometry_window(dataset, coords)
-    rect = dataset.read(window=windo)
-    
-    out_meta = dataset.meta.copy()
-    out_meta.update({"driver": "GTiff",
-            "height": rect.shape[1],
-            "width": rect.shape[2],
-            "transform": g_rect,
-            "dtype":"uint16"}
-        )
-    output_path = path_jp2[:-4] + '_clipped.tif'
-    with rasterio.open(output_path, 'w', **out_meta) as dst:
-        dst.write(rect.astype(np.uint16))      
+    returns output_path
+    """
+    fp = shapely.wkt.loads(footprint)
+    dst_crs = CRS.from_epsg(4326)
+    open_kwargs = {} if overview_level is None else {'OVERVIEW_LEVEL': overview_level}
+
+    sources = [(name, rasterio.open(path, **open_kwargs)) for name, path in band_paths.items()]
+    try:
+        first = sources[0][1]
+        nodata = first.nodata if first.nodata is not None else 0
+        dst_transform, height, width, src_window = get_clip_grid(first, fp, dst_crs)
+
+        out_meta = first.meta.copy()
+        out_meta.update({"driver": "GTiff",
+                "count": sum(src.count for _, src in sources),
+                "height": height,
+                "width": width,
+                "transform": dst_transform,
+                "crs": dst_crs,
+                "nodata": nodata,
+                "dtype": "uint16",
+                "interleave": "band"})
+
+        with raster_output(output_path, out_meta, final=False) as dst:
+            index = 1
+            for name, src in sources:
+                clipped = reproject_window(src, src_window, dst_transform, height, width, dst_crs, nodata)
+                count_pixels(clipped.size)
+                for i in range(src.count):
+                    dst.write(clipped[i], index)
+                    dst.set_band_description(index, name if src.count == 1 else '{0}_{1}'.format(name, i + 1))
+                    index += 1
+    finally:
+        for _, src in sources:
+            src.close()
     return output_path
 
+def get_clip_vrt(src, fp, dst_crs, resampling=Resampling.bilinear):
+    """
+    returns a WarpedVRT of src onto its clip grid (see get_clip_grid): the clipped, reprojected band
+    of clip_to_aoi, evaluated lazily on the windows read from it
+    """
+    nodata = src.nodata if src.nodata is not None else 0
+    dst_transform, height, width, _ = get_clip_grid(src, fp, dst_crs)
+    return WarpedVRT(src, crs=dst_crs, transform=dst_transform, width=width, height=height, resampling=resampling,
+                     src_nodata=nodata, nodata=nodata)
+
+@profiled()
+def mosaic_virtual(paths, footprint, output_path, dtype=np.uint16, memory_budget_mb=512, overview_level=None):
+    """
+    clips, reprojects to EPSG:4326 and mosaics rasters (e.g. the same band of several products) in one pass
+
+    Each input is a WarpedVRT onto its clip grid, read block by block by mosaic_to_file: the windows of
+    the inputs are decoded and warped once, straight into the mosaic, no clipped file is written.
+
+    returns output_path
+    """
+    fp = shapely.wkt.loads(footprint)
+    dst_crs = CRS.from_epsg(4326)
+    open_kwargs = {} if overview_level is None else {'OVERVIEW_LEVEL': overview_level}
+
+    sources = [rasterio.open(path, **open_kwargs) for path in paths]
+    vrts = []
+    try:
+        for src in sources:
+            vrts.append(get_clip_vrt(src, fp, dst_crs))
+        return mosaic_to_file(vrts, output_path, dtype, memory_budget_mb)
+    finally:
+        for dataset in vrts + sources:
+            dataset.close()
+
+
+def get_mosaic_grid(datasets):
+    """
+    returns (transform, width, height) of the grid covering all the datasets at the resolution of the first one
+    """
+    res_x, res_y = datasets[0].res
+    west = min(d.bounds.left for d in datasets)
+    south = min(d.bounds.bottom for d in datasets)
+    east = max(d.bounds.right for d in datasets)
+    north = max(d.bounds.top for d in datasets)
+
+    transform = Affine(res_x, 0, west, 0, -res_y, north)
+    return transform, int(round((east - west) / res_x)), int(round((north - south) / res_y))
+
+def get_footprint_grid(datasets, footprint):
+    """
+    returns (transform, width, height) of the part of the mosaic grid of datasets (see get_mosaic_grid)
+    covering the bounding box of footprint, rounded outwards to whole pixels
+    """
+    transform, width, height = get_mosaic_grid(datasets)
+    window = snap_window(from_bounds(*loads(footprint).bounds, transform=transform))
+    window = window.intersection(Window(0, 0, width, height))
+    return rasterio.windows.transform(window, transform), int(window.width), int(window.height)
 
-def merge_rasters(list_clipped_rasters_paths, output_folder, suffix, dtype):
+def iter_block_windows(width, height, count, dtype, memory_budget_mb, block_size=512):
+    """
+    yields windows of the output grid, aligned on the output tiles, small enough for the memory budget
+    (the block in the output dtype plus one input read per block)
+    """
+    pixel_bytes = count * (np.dtype(dtype).itemsize + 8)
+    side = int(math.sqrt(memory_budget_mb * 2**20 / pixel_bytes)) // block_size * block_size
+    side = max(side, block_size)
 
-    rec, rec_g = merge(list_clipped_rasters_paths)
-    out_meta = rasterio.open(list_clipped_rasters_paths[0]).meta.copy()
+    for row_off in range(0, height, side):
+        for col_off in range(0, width, side):
+            yield Window(col_off, row_off, min(side, width - col_off), min(side, height - row_off))
+
+@profiled()
+def mosaic_to_file(datasets, output_path, dtype, memory_budget_mb=512, transform=None, width=None, height=None):
+    """
+    mosaics opened datasets into a tiled GeoTIFF, block by block, the first valid pixel wins (as rasterio.merge)
+
+    Only the window of each input overlapping the current block is read, converted to dtype in place,
+    so the peak memory is bounded by memory_budget_mb whatever the size of the mosaic.
+    transform, width, height: output grid, by default the one covering all the inputs at the resolution of the first
+    """
+    first = datasets[0]
+    if transform is None:
+        transform, width, height = get_mosaic_grid(datasets)
+    nodata = first.nodata if first.nodata is not None else 0
+
+    out_meta = first.meta.copy()
     out_meta.update({"driver": "GTiff",
-            "height": rec.shape[1],
-            "width": rec.shape[2],
-            "transform": rec_g,
-            "dtype": dtype})
-    
+            "height": height,
+            "width": width,
+            "transform": transform,
+            "dtype": dtype,
+            "nodata": nodata,
+            "tiled": True,
+            "blockxsize": 512,
+            "blockysize": 512,
+            "BIGTIFF": "IF_SAFER"})
+
+    with raster_output(output_path, out_meta) as dst:
+        for index, description in enumerate(first.descriptions, 1):
+            if description:
+                dst.set_band_description(index, description)
+
+        for window in iter_block_windows(width, height, first.count, dtype, memory_budget_mb):
+            block_bounds = rasterio.windows.bounds(window, transform)
+            block = np.full((first.count, int(window.height), int(window.width)), nodata, dtype=dtype)
+            filled = np.zeros(block.shape, dtype=bool)
+
+            for src in datasets:
+                left, bottom = max(block_bounds[0], src.bounds.left), max(block_bounds[1], src.bounds.bottom)
+                right, top = min(block_bounds[2], src.bounds.right), min(block_bounds[3], src.bounds.top)
+                if left >= right or bottom >= top:
+                    continue
+
+                dst_window = from_bounds(left, bottom, right, top, transform=transform)
+                row = int(round(dst_window.row_off)) - int(window.row_off)
+                col = int(round(dst_window.col_off)) - int(window.col_off)
+                rows = min(int(round(dst_window.height)), block.shape[1] - row)
+                cols = min(int(round(dst_window.width)), block.shape[2] - col)
+                if rows <= 0 or cols <= 0:
+                    continue
+
+                data = src.read(window=from_bounds(left, bottom, right, top, transform=src.transform),
+                                out_shape=(src.count, rows, cols), masked=True, resampling=Resampling.nearest)
+
+                region = block[:, row:row + rows, col:col + cols]
+                region_filled = filled[:, row:row + rows, col:col + cols]
+                copy_mask = ~region_filled & ~np.ma.getmaskarray(data)
+                np.copyto(region, data.data, where=copy_mask, casting='unsafe')
+                region_filled |= copy_mask
+
+            dst.write(block, window=window)
+            count_pixels(block.size)
+    return output_path
+
+def merge_rasters(list_clipped_rasters_paths, output_folder, suffix, dtype, memory_budget_mb=512):
+
     output_path = output_folder + '/Mosaic_{0}.tif'.format(suffix)
-    print(output_path)
-    with rasterio.open(output_path, 'w', **out_meta) as dst:
-        dst.write(rec.astype(dtype))   
+    datasets = [rasterio.open(path) for path in list_clipped_rasters_paths]
+    try:
+        return mosaic_to_file(datasets, output_path, dtype, memory_budget_mb)
+    finally:
+        for dataset in datasets:
+            dataset.close()
 
 def ConvertRaster2LatLong(InputRasterFile,OutputRasterFile):
 
@@ -242,7 +612,79 @@ def ConvertRaster2LatLong(InputRasterFile,OutputRasterFile):
                     dst_crs=Output_CRS,
                     resampling=Resampling.bilinear) 
 
-def post_proc(s1_path, s2_path):
+def get_raster_grid(path):
+    """
+    returns (crs, transform, width, height) of a raster
+    """
+    with rasterio.open(path) as src:
+        return src.crs, src.transform, src.width, src.height
+
+def get_aoi_grid(footprint, resolution):
+    """
+    returns the lat/long grid (crs, transform, width, height) of the AOI bounding box at resolution (degrees)
+    """
+    minx, miny, maxx, maxy = shapely.wkt.loads(footprint).bounds
+    width = int(math.ceil((maxx - minx) / resolution))
+    height = int(math.ceil((maxy - miny) / resolution))
+    return CRS.from_epsg(4326), Affine(resolution, 0, minx, 0, -resolution, maxy), width, height
+
+@profiled()
+def coregister_to_grid(paths, output_path, grid, dtype='float32', resampling=Resampling.bilinear, memory_budget_mb=512):
+    """
+    warps the rasters of paths onto grid (crs, transform, width, height) through WarpedVRTs, block by block,
+    into one pixel-aligned output holding all their bands in order. The inputs are never modified.
+
+    returns output_path
+    """
+    crs, transform, width, height = grid
+    sources = [rasterio.open(path) for path in paths]
+    vrts = []
+    try:
+        nodata = sources[0].nodata if sources[0].nodata is not None else 0
+        for src in sources:
+            vrts.append(WarpedVRT(src, crs=crs, transform=transform, width=width, height=height, resampling=resampling,
+                                  src_nodata=src.nodata if src.nodata is not None else nodata, nodata=nodata))
+
+        count = sum(vrt.count for vrt in vrts)
+        out_meta = {"driver": "GTiff",
+                "count": count,
+                "dtype": dtype,
+                "crs": crs,
+                "transform": transform,
+                "width": width,
+                "height": height,
+                "nodata": nodata,
+                "tiled": True,
+                "blockxsize": 512,
+                "blockysize": 512,
+                "BIGTIFF": "IF_SAFER"}
+
+        with raster_output(output_path, out_meta) as dst:
+            index = 1
+            for src in sources:
+                for description in src.descriptions:
+                    if description:
+                        dst.set_band_description(index, description)
+                    index += 1
+
+            for window in iter_block_windows(width, height, count, dtype, memory_budget_mb):
+                index = 1
+                for vrt in vrts:
+                    dst.write(vrt.read(window=window, out_dtype=dtype), indexes=list(range(index, index + vrt.count)), window=window)
+                    index += vrt.count
+                count_pixels(count * window.width * window.height)
+    finally:
+        for dataset in vrts + sources:
+            dataset.close()
+    return output_path
+
+@profiled()
+def post_proc(s1_path, s2_path, in_place=False):
+    """
+    in_place: only rewrite the georeferencing of the S1 mosaic when its pixels already match the S2 grid,
+    without decoding and encoding them again. Not with an output profile: updating the header of a
+    COG or of a file with overviews breaks its layout, the mosaic is rewritten through raster_output then
+    """
     s2_r = rasterio.open(s2_path)
     
     s2_meta = s2_r.meta.copy()
@@ -250,10 +692,22 @@ def post_proc(s1_path, s2_path):
                'dtype': 'float32'})
     s2_r.close()
 
+    if in_place and OutputProfile.get_profile() is None:
+        with rasterio.open(s1_path) as s1_r:
+            matches = (s1_r.count, s1_r.dtypes[0], s1_r.width, s1_r.height) == (2, 'float32', s2_meta['width'], s2_meta['height'])
+        if matches:
+            with rasterio.open(s1_path, 'r+') as s1_r:
+                s1_r.crs = s2_meta['crs']
+                s1_r.transform = s2_meta['transform']
+                if s2_meta['nodata'] is not None:
+                    s1_r.nodata = s2_meta['nodata']
+            return s1_path
+
     s1_r = rasterio.open(s1_path)
     s1_ar = s1_r.read()
     s1_r.close()
+    count_pixels(s1_ar.size)
 
-    with rasterio.open(s1_path, 'w', **s2_meta) as ff:
+    with raster_output(s1_path, s2_meta) as ff:
         ff.write(s1_ar)
-    return
+    return s1_path
@@ -0,0 +1,147 @@
+import os
+import json
+import datetime
+
+import pytest
+import shapely
+import shapely.wkt
+
+from src.AuxData import (AuxDataManager, AuxDataMissingError, ORBIT_FOLDER, DEM_FOLDER, get_srtm_tiles, get_orbit_months,
+                         get_orbit_need)
+
+SCENE = 'S1A_IW_GRDH_1SDV_20200301T053120_20200301T053145_031473_039FC6_1A2B'
+# valid from the day before the first of March, stored with the orbits of February
+ORBIT = 'S1A_OPER_AUX_POEORB_OPOD_20200321T120712_V20200229T225942_20200302T005942.EOF.zip'
+FOOTPRINT = shapely.box(10.2, 54.5, 10.8, 55.5).wkt
+
+
+def get_pairs(footprint=FOOTPRINT):
+    interval = (datetime.datetime(2020, 2, 25), datetime.datetime(2020, 3, 6))
+    return [(interval, [], [{'title': SCENE, 'footprint': footprint}, 'incomplete'])]
+
+
+@pytest.fixture
+def sources(tmp_path):
+    """
+    local orbit and DEM sources laid out as the remote ones: one orbit file, one land tile of the AOI and a tile elsewhere
+    """
+    orbits = tmp_path / 'orbits'
+    (orbits / 'S1A' / '2020' / '02').mkdir(parents=True)
+    (orbits / 'S1A' / '2020' / '02' / ORBIT).write_bytes(b'orbit')
+    dem = tmp_path / 'dem'
+    dem.mkdir()
+    for tile in ('srtm_39_02', 'srtm_01_01'):
+        (dem / (tile + '.zip')).write_bytes(b'tile')
+    return str(orbits), str(dem)
+
+
+class FailingSession(object):
+    def get(self, url, stream=False, headers=None):
+        raise ConnectionError('connection refused')
+
+
+def test_srtm_tiles_of_a_box():
+    assert get_srtm_tiles(shapely.box(10.2, 50.1, 10.8, 50.4)) == ['srtm_39_02']
+    assert get_srtm_tiles(shapely.box(9.5, 54.5, 10.5, 55.5)) == ['srtm_38_01', 'srtm_38_02', 'srtm_39_01', 'srtm_39_02']
+
+
+def test_srtm_tiles_follow_the_geometry_not_its_bounds():
+    geometry = shapely.union_all([shapely.box(9.5, 54.5, 9.9, 54.9), shapely.box(10.1, 55.1, 10.5, 55.5)])
+
+    assert get_srtm_tiles(geometry) == ['srtm_38_02', 'srtm_39_01']
+
+
+def test_srtm_tiles_stop_at_60_degrees():
+    assert get_srtm_tiles(shapely.box(10.2, 58., 10.8, 62.)) == ['srtm_39_01']
+    assert get_srtm_tiles(shapely.box(10.2, 61., 10.8, 62.)) == []
+
+
+def test_orbit_months_across_month_and_year_boundaries():
+    assert get_orbit_months(datetime.datetime(2020, 3, 15, 5, 31)) == [(2020, 3)]
+    assert get_orbit_months(datetime.datetime(2020, 3, 1, 5, 31)) == [(2020, 3), (2020, 2)]
+    assert get_orbit_months(datetime.datetime(2021, 1, 1, 0, 10)) == [(2021, 1), (2020, 12)]
+
+
+def test_find_orbit_picks_the_latest_valid_file(tmp_path):
+    mission, start, stop = get_orbit_need(SCENE)
+    later = ORBIT.replace('20200321T120712', '20200322T080000')
+    invalid = 'S1A_OPER_AUX_POEORB_OPOD_20200322T120712_V20200301T225942_20200303T005942.EOF.zip'
+    manager = AuxDataManager(str(tmp_path))
+
+    assert manager.find_orbit([ORBIT, later, invalid, 'index.html'], start, stop) == later
+    assert manager.find_orbit([invalid], start, stop) is None
+
+
+def test_orbit_of_the_first_of_a_month_found_in_the_previous_month(tmp_path, sources):
+    orbit_source, dem_source = sources
+    manager = AuxDataManager(str(tmp_path / 'cache'), orbit_source, dem_source)
+    mission, start, stop = get_orbit_need(SCENE)
+
+    status, path = manager.get_orbit(mission, start, stop)
+    assert status == 'fetched'
+    assert path == os.path.join(str(tmp_path / 'cache'), ORBIT_FOLDER, 'S1A', '2020', '02', ORBIT)
+    assert manager.get_orbit(mission, start, stop) == ('cached', path)
+
+
+def test_prefetch_from_local_sources(tmp_path, sources):
+    orbit_source, dem_source = sources
+    cache = str(tmp_path / 'cache')
+
+    report = AuxDataManager(cache, orbit_source, dem_source).prefetch(get_pairs(), FOOTPRINT)
+
+    assert report['orbits'][SCENE]['status'] == 'fetched'
+    assert report['dem']['srtm_39_02'] == {'status': 'fetched', 'path': os.path.join(cache, DEM_FOLDER, 'srtm_39_02.zip')}
+    # listed by the source without srtm_39_01: a tile of sea
+    assert report['dem']['srtm_39_01']['status'] == 'not_at_source'
+    assert os.path.exists(os.path.join(cache, DEM_FOLDER, 'srtm_39_01.zip.not_at_source'))
+    assert AuxDataManager.get_missing(report) == []
+
+    report = AuxDataManager(cache, orbit_source, dem_source).prefetch(get_pairs(), FOOTPRINT)
+    assert report['orbits'][SCENE]['status'] == 'cached'
+    assert {tile: entry['status'] for tile, entry in report['dem'].items()} == {'srtm_39_01': 'not_at_source', 'srtm_39_02': 'cached'}
+
+
+def test_prefetch_offline_uses_the_cache_only(tmp_path, sources):
+    orbit_source, dem_source = sources
+    cache = str(tmp_path / 'cache')
+    manager = AuxDataManager(cache, orbit_source, dem_source, offline=True)
+
+    report = manager.prefetch(get_pairs(), FOOTPRINT)
+
+    assert report['orbits'][SCENE]['status'] == 'missing'
+    assert {entry['status'] for entry in report['dem'].values()} == {'missing'}
+    assert not os.path.exists(os.path.join(cache, DEM_FOLDER))
+    assert len(AuxDataManager.get_missing(report)) == 3
+    with pytest.raises(AuxDataMissingError):
+        manager.check(report)
+
+    AuxDataManager(cache, orbit_source, dem_source).prefetch(get_pairs(), FOOTPRINT)
+    report = manager.prefetch(get_pairs(), FOOTPRINT)
+    assert AuxDataManager.get_missing(report) == []
+    manager.check(report)
+
+
+def test_tile_missing_from_an_unlisted_source_is_not_marked(tmp_path, sources):
+    orbit_source, _ = sources
+    cache = str(tmp_path / 'cache')
+
+    report = AuxDataManager(cache, orbit_source, str(tmp_path / 'no_dem')).prefetch(get_pairs(), FOOTPRINT)
+
+    assert {entry['status'] for entry in report['dem'].values()} == {'missing'}
+    assert not [name for name in os.listdir(os.path.join(cache, DEM_FOLDER)) if name.endswith('.not_at_source')]
+
+
+def test_fetch_errors_are_reported_missing(tmp_path):
+    cache = str(tmp_path / 'cache')
+    manager = AuxDataManager(cache, 'https://orbits.invalid', 'https://dem.invalid', session=FailingSession())
+
+    report = manager.prefetch(get_pairs(), FOOTPRINT)
+
+    assert report['orbits'][SCENE]['status'] == 'missing'
+    assert 'connection refused' in report['orbits'][SCENE]['error']
+    assert {entry['status'] for entry in report['dem'].values()} == {'missing'}
+    path = manager.write_report(report, str(tmp_path / 'auxdata_report.json'))
+    with open(path) as f:
+        assert len(json.load(f)['missing']) == 3
+    with pytest.raises(AuxDataMissingError, match='connection refused'):
+        manager.check(report)
@@ -0,0 +1,154 @@
+import os
+
+import pytest
+
+from benchmarks.synthetic import FakeSentinelAPI, FakeSession, make_catalog
+import src.Downloader
+from src.Downloader import Downloader, ChecksumError, md5_of_file
+from src.ProductStore import ProductStore
+
+
+class CountingSession(FakeSession):
+    """
+    FakeSession recording the Range header of every request
+    """
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, stream=True, headers=None):
+        self.requests.append((url, dict(headers or {})))
+        return FakeSession.get(self, url, stream=stream, headers=headers)
+
+
+class FlakyAPI(FakeSentinelAPI):
+    """
+    FakeSentinelAPI whose first failures calls to get_product_odata raise a connection error
+    """
+    def __init__(self, catalog, zips_folder, failures):
+        FakeSentinelAPI.__init__(self, catalog, zips_folder)
+        self.failures = failures
+        self.calls = 0
+
+    def get_product_odata(self, uuid):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError('hub unreachable')
+        return FakeSentinelAPI.get_product_odata(self, uuid)
+
+
+class WrongChecksumAPI(FakeSentinelAPI):
+    def get_product_odata(self, uuid):
+        return dict(FakeSentinelAPI.get_product_odata(self, uuid), md5='0' * 32)
+
+
+@pytest.fixture
+def hub(tmp_path):
+    """
+    catalog of 3 products served from a folder of zips of random content
+    """
+    catalog = make_catalog(3)
+    zips_folder = tmp_path / 'hub'
+    zips_folder.mkdir()
+    for index, title in enumerate(catalog['title']):
+        (zips_folder / (title + '.zip')).write_bytes(os.urandom(100000 + index))
+    return catalog, str(zips_folder)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+    monkeypatch.setattr(src.Downloader.time, 'sleep', waits.append)
+    return waits
+
+
+def test_fetch_retries_with_backoff(hub, tmp_path, sleeps):
+    catalog, zips_folder = hub
+    api = FlakyAPI(catalog, zips_folder, failures=2)
+    uuid = catalog.index[0]
+
+    path, transferred = Downloader(api, max_attempts=3, backoff=2.).fetch_with_retries(uuid, str(tmp_path))
+
+    assert sleeps == [2., 4.]
+    assert transferred == os.path.getsize(path)
+    assert md5_of_file(path) == md5_of_file(os.path.join(zips_folder, os.path.basename(path)))
+
+
+def test_fetch_gives_up_after_max_attempts(hub, tmp_path, sleeps):
+    catalog, zips_folder = hub
+    api = FlakyAPI(catalog, zips_folder, failures=5)
+
+    with pytest.raises(ConnectionError):
+        Downloader(api, max_attempts=3, backoff=2.).fetch_with_retries(catalog.index[0], str(tmp_path))
+    assert api.calls == 3
+    assert sleeps == [2., 4.]
+
+
+def test_fetch_resumes_partial_file_with_range(hub, tmp_path):
+    catalog, zips_folder = hub
+    api = FakeSentinelAPI(catalog, zips_folder)
+    api.session = CountingSession()
+    uuid = catalog.index[0]
+    source = os.path.join(zips_folder, catalog.loc[uuid, 'title'] + '.zip')
+    with open(source, 'rb') as f:
+        head = f.read(40000)
+    with open(os.path.join(str(tmp_path), catalog.loc[uuid, 'title'] + '.zip.incomplete'), 'wb') as f:
+        f.write(head)
+
+    path, transferred = Downloader(api).fetch(uuid, str(tmp_path))
+
+    assert api.session.requests[0][1] == {'Range': 'bytes=40000-'}
+    assert transferred == os.path.getsize(source) - 40000
+    assert md5_of_file(path) == md5_of_file(source)
+    assert not os.path.exists(path + '.incomplete')
+
+
+def test_fetch_rejects_checksum_mismatch(hub, tmp_path):
+    catalog, zips_folder = hub
+    api = WrongChecksumAPI(catalog, zips_folder)
+    directory = tmp_path / 'S2'
+    directory.mkdir()
+
+    with pytest.raises(ChecksumError):
+        Downloader(api).fetch(catalog.index[0], str(directory))
+    assert os.listdir(str(directory)) == []
+
+
+def test_download_reports_checksum_mismatch_as_failed(hub, tmp_path, sleeps):
+    catalog, zips_folder = hub
+    api = WrongChecksumAPI(catalog, zips_folder)
+
+    summary = Downloader(api, max_attempts=2).download([(uuid, str(tmp_path / 'S2')) for uuid in catalog.index])
+
+    assert sorted(summary['failed']) == sorted(catalog.index)
+    assert summary['paths'] == {}
+    assert os.listdir(str(tmp_path / 'S2')) == []
+
+
+def test_download_dedups_products_shared_by_intervals(hub, tmp_path):
+    catalog, zips_folder = hub
+    api = FakeSentinelAPI(catalog, zips_folder)
+    api.session = CountingSession()
+    shared, other = catalog.index[0], catalog.index[1]
+    first, second = str(tmp_path / '20200101_20200111' / 'S2'), str(tmp_path / '20200111_20200121' / 'S2')
+
+    summary = Downloader(api, workers=2).download([(shared, first), (other, first), (shared, second)])
+
+    assert summary['products'] == 2
+    assert summary['downloaded'] == 2
+    assert len(api.session.requests) == 2
+    title = catalog.loc[shared, 'title'] + '.zip'
+    assert os.path.samefile(os.path.join(first, title), os.path.join(second, title))
+    assert sorted(os.listdir(second)) == [title]
+
+
+def test_stored_product_is_not_asked_to_the_hub(hub, tmp_path):
+    catalog, zips_folder = hub
+    store = ProductStore(str(tmp_path / 'store'))
+    uuid = catalog.index[0]
+    path, transferred = Downloader(FakeSentinelAPI(catalog, zips_folder), store=store).fetch_into_store(uuid)
+    assert transferred == os.path.getsize(path)
+
+    # hub unreachable
+    api = FlakyAPI(catalog, zips_folder, failures=5)
+    assert Downloader(api, store=store).fetch_into_store(uuid) == (path, 0)
+    assert api.calls == 0
@@ -0,0 +1,77 @@
+import os
+import sqlite3
+
+from src.RunManifest import RunManifest
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def make_stage(tmp_path, name, content):
+    """
+    returns a stage function writing content into tmp_path/name and the list of its calls
+    """
+    calls = []
+
+    def func():
+        calls.append(name)
+        return write(str(tmp_path / name), content)
+    return func, calls
+
+
+def test_stage_skipped_on_the_same_inputs(tmp_path):
+    manifest = RunManifest(str(tmp_path / 'run_manifest.sqlite'))
+    inputs = [write(str(tmp_path / 'a.tif'), 'a'), write(str(tmp_path / 'b.tif'), 'b')]
+    merge, calls = make_stage(tmp_path, 'mosaic.tif', 'ab')
+
+    manifest.run('20200101_20200111', 'S2', 'merge', merge, inputs)
+    manifest.run('20200101_20200111', 'S2', 'merge', merge, inputs)
+
+    assert calls == ['mosaic.tif']
+
+
+def test_stage_rerun_on_other_or_changed_inputs(tmp_path):
+    manifest = RunManifest(str(tmp_path / 'run_manifest.sqlite'))
+    inputs = [write(str(tmp_path / 'a.tif'), 'a'), write(str(tmp_path / 'b.tif'), 'b')]
+    merge, calls = make_stage(tmp_path, 'mosaic.tif', 'ab')
+    manifest.run('20200101_20200111', 'S2', 'merge', merge, inputs)
+
+    # another selection of the scenes of the interval
+    inputs = inputs[:1] + [write(str(tmp_path / 'c.tif'), 'c')]
+    manifest.run('20200101_20200111', 'S2', 'merge', merge, inputs)
+    assert len(calls) == 2
+
+    # an input rewritten by its own stage
+    write(inputs[1], 'cc')
+    assert not manifest.is_done('20200101_20200111', 'S2', 'merge', inputs)
+    manifest.run('20200101_20200111', 'S2', 'merge', merge, inputs)
+    assert len(calls) == 3
+    assert manifest.is_done('20200101_20200111', 'S2', 'merge', inputs)
+
+
+def test_manifest_of_an_earlier_version_is_migrated(tmp_path):
+    path = str(tmp_path / 'run_manifest.sqlite')
+    connection = sqlite3.connect(path)
+    connection.execute('''CREATE TABLE stages (
+        interval TEXT, product TEXT, stage TEXT, status TEXT,
+        inputs TEXT, outputs TEXT, checksums TEXT, result TEXT,
+        started REAL, finished REAL, error TEXT,
+        PRIMARY KEY (interval, product, stage))''')
+    output = write(str(tmp_path / 'mosaic.tif'), 'ab')
+    stat = os.stat(output)
+    connection.execute('INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+        '20200101_20200111', 'S2', 'merge', 'done', '[]', '"{0}"'.format(output),
+        '["{0}:{1}"]'.format(stat.st_size, stat.st_mtime_ns), None, 0., 0., None))
+    connection.commit()
+    connection.close()
+
+    manifest = RunManifest(path)
+
+    # checked on its outputs only, as before
+    assert manifest.is_done('20200101_20200111', 'S2', 'merge', [output])
+    merge, calls = make_stage(tmp_path, 'other.tif', 'c')
+    manifest.run('20200101_20200111', 'S2', 'extract', merge, [output])
+    assert manifest.get('20200101_20200111', 'S2', 'extract')['input_checksums'] is not None
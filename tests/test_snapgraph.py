@@ -0,0 +1,103 @@
+import xml.etree.ElementTree as ET
+
+from src.SnapGraph import (get_s1_nodes, make_graph, get_subset_region, get_grid_origin, group_slices, get_calibration_params,
+                           get_terrain_correction_params, THERMAL_NOISE_PARAMS, TERRAIN_CORRECTION_PARAMS, SCALE_DB_PARAMS, OUTPUT_FORMAT)
+
+FOOTPRINT = 'POLYGON ((10 50, 10.5 50, 10.5 50.5, 10 50.5, 10 50))'
+SLICES = ['S1A_IW_GRDH_1SDV_20200101T053120_20200101T053145_030620_038216_3F3C.SAFE/manifest.safe',
+          'S1A_IW_GRDH_1SDV_20200101T053145_20200101T053210_030620_038216_9A1B.SAFE/manifest.safe']
+
+
+def parse_graph(nodes):
+    """
+    returns the graph XML of nodes as a list of (node id, operator, source ids, parameters as text)
+    """
+    graph = ET.fromstring(make_graph(nodes))
+    return [(node.get('id'), node.find('operator').text, [source.get('refid') for source in node.find('sources')],
+             {parameter.tag: parameter.text for parameter in node.find('parameters')}) for node in graph.findall('node')]
+
+
+def as_text(parameters):
+    return {key: 'true' if value is True else 'false' if value is False else str(value) for key, value in parameters.items()}
+
+
+def test_one_scene_graph():
+    graph = parse_graph(get_s1_nodes(SLICES[0], 'out.tif', 'VH,VV', 'DV', FOOTPRINT))
+
+    assert [node[:3] for node in graph] == [
+        ('Read', 'Read', []),
+        ('Apply-Orbit-File', 'Apply-Orbit-File', ['Read']),
+        ('ThermalNoiseRemoval', 'ThermalNoiseRemoval', ['Apply-Orbit-File']),
+        ('Calibration', 'Calibration', ['ThermalNoiseRemoval']),
+        ('Terrain-Correction', 'Terrain-Correction', ['Calibration']),
+        ('Subset', 'Subset', ['Terrain-Correction']),
+        ('LinearToFromdB', 'LinearToFromdB', ['Subset']),
+        ('Write', 'Write', ['LinearToFromdB']),
+    ]
+    parameters = {node[0]: node[3] for node in graph}
+    assert parameters['Read'] == {'file': SLICES[0]}
+    assert parameters['ThermalNoiseRemoval'] == as_text(THERMAL_NOISE_PARAMS)
+    assert parameters['Calibration'] == as_text(get_calibration_params('VH,VV', 'DV'))
+    assert parameters['Calibration']['sourceBands'] == 'Intensity_VH,Intensity_VV'
+    assert parameters['Terrain-Correction'] == as_text(TERRAIN_CORRECTION_PARAMS)
+    assert parameters['Subset'] == {'geoRegion': FOOTPRINT}
+    assert parameters['LinearToFromdB'] == as_text(SCALE_DB_PARAMS)
+    assert parameters['Write'] == {'file': 'out.tif', 'formatName': OUTPUT_FORMAT}
+
+
+def test_graph_without_footprint_has_no_subset():
+    graph = parse_graph(get_s1_nodes(SLICES[0], 'out.tif', 'VV', 'SV'))
+
+    assert 'Subset' not in [node[1] for node in graph]
+    assert dict((node[0], node[2]) for node in graph)['LinearToFromdB'] == ['Terrain-Correction']
+
+
+def test_slice_assembly_after_per_slice_corrections():
+    graph = parse_graph(get_s1_nodes(SLICES, 'out.tif', 'VH,VV', 'DV', FOOTPRINT))
+    sources = dict((node[0], node[2]) for node in graph)
+    ids = [node[0] for node in graph]
+
+    assert sources['Apply-Orbit-File'] == ['Read']
+    assert sources['Apply-Orbit-File(2)'] == ['Read(2)']
+    assert sources['ThermalNoiseRemoval'] == ['Apply-Orbit-File']
+    assert sources['ThermalNoiseRemoval(2)'] == ['Apply-Orbit-File(2)']
+    assert sources['SliceAssembly'] == ['ThermalNoiseRemoval', 'ThermalNoiseRemoval(2)']
+    assert sources['Calibration'] == ['SliceAssembly']
+    assert ids.index('SliceAssembly') > max(ids.index('ThermalNoiseRemoval'), ids.index('ThermalNoiseRemoval(2)'))
+    assert dict((node[0], node[3]) for node in graph)['SliceAssembly'] == {'selectedPolarisations': 'VH,VV'}
+
+    # the second source of a node is referenced as sourceProduct.1
+    graph_xml = ET.fromstring(make_graph(get_s1_nodes(SLICES, 'out.tif', 'VH,VV', 'DV')))
+    assembly = [node for node in graph_xml.findall('node') if node.get('id') == 'SliceAssembly'][0]
+    assert [source.tag for source in assembly.find('sources')] == ['sourceProduct', 'sourceProduct.1']
+
+
+def test_group_slices_by_pass():
+    other_pass = 'S1B_IW_GRDH_1SDV_20200101T060000_20200101T060025_019310_024790_AB12'
+    basenames = [SLICES[1].split('.')[0], other_pass, SLICES[0].split('.')[0]]
+
+    assert group_slices(basenames) == [[2, 0], [1]]
+
+
+def test_early_subset_before_terrain_correction():
+    region = get_subset_region(FOOTPRINT, 0.1)
+    graph = parse_graph(get_s1_nodes(SLICES[0], 'out.tif', 'VH,VV', 'DV', FOOTPRINT, subset_region=region))
+    sources = dict((node[0], node[2]) for node in graph)
+
+    assert sources['Subset-Radar'] == ['Calibration']
+    assert sources['Terrain-Correction'] == ['Subset-Radar']
+    assert sources['Subset'] == ['Terrain-Correction']
+    assert dict((node[0], node[3]) for node in graph)['Subset-Radar'] == {'geoRegion': region, 'copyMetadata': 'true'}
+    assert region == 'POLYGON ((9.9 49.9, 10.6 49.9, 10.6 50.6, 9.9 50.6, 9.9 49.9))'
+
+
+def test_tiles_aligned_on_the_grid_of_the_aoi():
+    origin = get_grid_origin(FOOTPRINT)
+    tile = 'POLYGON ((10.25 50, 10.5 50, 10.5 50.25, 10.25 50.25, 10.25 50))'
+    parameters = dict((node[0], node[3]) for node in parse_graph(get_s1_nodes(SLICES[0], 'out.tif', 'VH,VV', 'DV', tile, grid_origin=origin)))
+
+    assert origin == (10., 50.5)
+    assert parameters['Terrain-Correction'] == as_text(get_terrain_correction_params(origin))
+    assert parameters['Terrain-Correction']['alignToStandardGrid'] == 'true'
+    assert (parameters['Terrain-Correction']['standardGridOriginX'], parameters['Terrain-Correction']['standardGridOriginY']) == ('10.0', '50.5')
+    assert 'alignToStandardGrid' not in parse_graph(get_s1_nodes(SLICES[0], 'out.tif', 'VH,VV', 'DV', tile))[4][3]